@@ -0,0 +1,372 @@
+"""Snaplog ASGI server – /api/auto-diary 파이프라인의 asyncio 실행 경로
+
+server.py의 단계 그래프(auto_diary_graph)를 arun으로 돌리고, OpenAI를 부르는 단계는
+분석/초안/보정/모더레이션 단계 제너레이터(_analyze_images_steps 등)를 AsyncOpenAI로 구동한다.
+OpenAI 응답을 기다리는 동안 스레드를 잡지 않으므로 한 프로세스가 수백 개의 요청을 동시에 들고 있을 수 있다.
+실제 OpenAI 동시 호출 수와 RPM/TPM은 server.py의 모델별 레이트 리미터가 동기 경로와 함께 제한한다.
+
+실행 (backend/ 에서):
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5001
+    python asgi_server.py
+
+- POST /api/auto-diary: Flask 라우트의 JSON 입력과 같은 계약 (이미지 base64/data URL, analysisId 재사용, photosSummary 단서).
+  multipart 업로드는 기존 Flask 서버(server.py)의 같은 경로를 사용한다.
+- GET /health
+- GET /metrics: Prometheus 텍스트 형식 (server.metrics와 같은 레지스트리), 응답마다 Server-Timing 헤더
+"""
+
+from __future__ import annotations
+import asyncio, json, os, time, traceback
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from openai import AsyncOpenAI
+
+import server
+
+aclient = AsyncOpenAI(api_key=server.API_KEY)
+
+# ---------------- 레이트 리미터 + 재시도 (asyncio) ----------------
+async def _athrottled(kwargs: dict, attempt, can_retry=None):
+    """server._throttled의 asyncio 버전. 리미터 버킷/슬롯과 재시도 간격 규칙은 동기 경로와 공유한다."""
+    backoff = server.THROTTLE_SECONDS
+    last_error: Exception | None = None
+    total_wait = 0.0
+    model = kwargs.get("model") or ""
+    limiter = server._limiter_for(model)
+    est_tokens = server._estimate_request_tokens(kwargs)
+    while total_wait <= server.MAX_WAIT_SECONDS:
+        try:
+            waited = await limiter.acquire_async(est_tokens, server.MAX_WAIT_SECONDS - total_wait)
+        except TimeoutError:
+            server.metrics.inc("snaplog_throttle_timeouts_total", model=model)
+            break
+        total_wait += waited
+        server.metrics.observe("snaplog_throttle_wait_seconds", waited, model=model)
+
+        used_tokens = None
+        started, outcome = time.monotonic(), "error"
+        try:
+            result, used_tokens = await attempt(kwargs, limiter)
+            outcome = "ok"
+            return result
+        except server._RETRYABLE_ERRORS as e:
+            last_error = e
+            outcome = type(e).__name__
+            retry_secs = server._retry_delay(e, limiter, backoff)
+            if can_retry is not None and not can_retry():
+                raise
+            server._record_retry(model, e, retry_secs)
+        finally:
+            limiter.release(est_tokens, used_tokens)
+            server.metrics.observe("snaplog_openai_request_seconds", time.monotonic() - started, model=model, outcome=outcome)
+
+        await asyncio.sleep(retry_secs)
+        total_wait += retry_secs
+        backoff = min(backoff * 2, server.THROTTLE_SECONDS * 16)
+    if last_error is not None:
+        raise last_error
+    raise RuntimeError("Rate limit/timeout exhausted")
+
+async def _acomplete_once(kwargs: dict, limiter):
+    raw = await aclient.chat.completions.with_raw_response.create(timeout=server.REQUEST_TIMEOUT, **kwargs)
+    limiter.observe_headers(getattr(raw, "headers", None))
+    resp = raw.parse()
+    return resp, server._record_usage(kwargs.get("model") or "", getattr(resp, "usage", None))
+
+async def athrottled_chat_completion(**kwargs):
+    return await _athrottled(kwargs, _acomplete_once)
+
+async def athrottled_chat_completion_stream(on_delta, **kwargs) -> tuple[str, str | None]:
+    """server.throttled_chat_completion_stream의 asyncio 버전. 첫 조각을 내보낸 뒤에는 재시도하지 않는다."""
+    emitted: list[str] = []
+
+    async def _once(kw: dict, limiter):
+        emitted.clear()
+        raw = await aclient.chat.completions.with_raw_response.create(
+            timeout=server.REQUEST_TIMEOUT, stream=True, stream_options={"include_usage": True}, **kw)
+        limiter.observe_headers(getattr(raw, "headers", None))
+        finish, used = None, None
+        async for chunk in raw.parse():
+            usage = getattr(chunk, "usage", None)
+            if usage is not None:
+                used = server._record_usage(kw.get("model") or "", usage)
+            for ch in getattr(chunk, "choices", None) or []:
+                delta = getattr(getattr(ch, "delta", None), "content", None)
+                if delta:
+                    emitted.append(delta)
+                    on_delta(delta)
+                if getattr(ch, "finish_reason", None):
+                    finish = ch.finish_reason
+        return ("".join(emitted), finish), used
+
+    return await _athrottled(kwargs, _once, can_retry=lambda: not emitted)
+
+async def _amoderation_once(kwargs: dict):
+    started, outcome = time.monotonic(), "error"
+    try:
+        resp = await aclient.moderations.create(**kwargs)
+        outcome = "ok"
+        return resp
+    finally:
+        server.metrics.observe("snaplog_openai_request_seconds", time.monotonic() - started,
+                               model=kwargs.get("model") or "", outcome=outcome)
+
+async def _arun_steps(steps):
+    """server._run_steps의 asyncio 구동기. CPU 작업("call")은 스레드로 보내 이벤트 루프를 막지 않는다."""
+    try:
+        op = next(steps)
+        while True:
+            try:
+                kind = op[0]
+                if kind == "chat":
+                    result = await athrottled_chat_completion(**op[1])
+                elif kind == "chat_stream":
+                    result = await athrottled_chat_completion_stream(op[2], **op[1])
+                elif kind == "moderation":
+                    result = await _amoderation_once(op[1])
+                else:
+                    result = await asyncio.to_thread(op[1], *op[2])
+            except Exception as e:
+                op = steps.throw(e)
+                continue
+            op = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+# ---------------- 파이프라인 단계 (asyncio) ----------------
+async def analyze_images_async(images, photos_summary=None, contact_sheet=None) -> dict | None:
+    return await _arun_steps(server._analyze_images_steps(images, photos_summary, contact_sheet))
+
+async def analyze_journey_async(images: list[dict], photos_summary: list[dict] | None, scenes: list[list[int]]) -> dict | None:
+    if not images or not scenes:
+        return None
+    results = await asyncio.gather(*(analyze_images_async(imgs, ps) for imgs, ps in server._journey_scene_inputs(images, photos_summary, scenes)),
+                                   return_exceptions=True)
+    return server._merge_journey_parts(server._journey_scene_results(list(results)))
+
+async def is_content_safe_for_diary_async(analysis: dict | None) -> tuple[bool, dict]:
+    return await _arun_steps(server._moderation_steps(analysis))
+
+async def draft_diary_async(analysis: dict | None, tone: str, category_hint: str, text_model: str = server.MODEL_TEXT) -> str:
+    return await _arun_steps(server._draft_diary_steps(analysis, tone, category_hint, text_model))
+
+async def refine_diary_async(analysis: dict | None, draft: str, tone: str, category_hint: str, on_delta=None) -> str:
+    return await _arun_steps(server._refine_diary_steps(analysis, draft, tone, category_hint, on_delta))
+
+async def generate_from_lines_async(lines: list[str], tone: str) -> str:
+    return await _arun_steps(server._generate_from_lines_steps(lines, tone))
+
+async def enrich_food_structured_for_multi_async(analysis: dict | None, images: list | None = None,
+                                                 photos_summary: list | None = None) -> dict | None:
+    targets = server._food_enrich_targets(analysis)
+    if not targets:
+        return analysis
+    results = await asyncio.gather(*(analyze_images_async([analysis["sorted_images"][idx]], None) for idx in targets),
+                                   return_exceptions=True)
+    subs = {}
+    for idx, res in zip(targets, results):
+        if isinstance(res, Exception):
+            print(f"[enrich_food_structured_for_multi_async] sub analyze_images 실패 idx={idx}: {res}")
+            continue
+        subs[idx] = res
+    return server._merge_food_enrichment(analysis, subs)
+
+async def select_draft_via_cross_validation_async(analysis: dict, tone: str, category_hint: str) -> tuple[str, dict]:
+    """기본/ALT 초안 선택. 선택 규칙과 ALT 마감(CV_ALT_DEADLINE)은 동기 경로와 같고, 마감을 넘긴 ALT 호출은 취소된다."""
+    alt_enabled = bool(server.ALT_TEXT_MODEL and server.ALT_TEXT_MODEL != server.MODEL_TEXT)
+    debug = {"primary_len": 0, "alt_len": 0, "used": "primary", "same": None,
+             "primary_model": server.MODEL_TEXT, "alt_model": server.ALT_TEXT_MODEL}
+    if not (server.CV_PARALLEL and alt_enabled):
+        primary = await draft_diary_async(analysis, tone, category_hint, server.MODEL_TEXT)
+        debug["primary_len"] = len(primary)
+        if not alt_enabled:
+            debug["note"] = "ALT_TEXT_MODEL is same as primary or unset"
+            return primary, debug
+        try:
+            alt = await draft_diary_async(analysis, tone, category_hint, server.ALT_TEXT_MODEL)
+            return server._pick_cv_draft(primary, alt, debug)
+        except Exception as e:
+            debug["alt_error"] = str(e)
+            return primary, debug
+
+    started = time.monotonic()
+    alt_task = asyncio.create_task(draft_diary_async(analysis, tone, category_hint, server.ALT_TEXT_MODEL))
+    try:
+        primary = await draft_diary_async(analysis, tone, category_hint, server.MODEL_TEXT)
+    except BaseException:
+        alt_task.cancel()
+        raise
+    debug.update(primary_len=len(primary), mode="parallel")
+    try:
+        remaining = max(server.CV_ALT_DEADLINE_SECONDS - (time.monotonic() - started), 0.0)
+        alt = await asyncio.wait_for(alt_task, timeout=remaining)
+    except asyncio.TimeoutError:
+        debug["alt_error"] = "deadline_exceeded"
+        debug["alt_deadline_s"] = server.CV_ALT_DEADLINE_SECONDS
+        return primary, debug
+    except Exception as e:
+        debug["alt_error"] = str(e)
+        return primary, debug
+    debug["elapsed_s"] = round(time.monotonic() - started, 3)
+    return server._pick_cv_draft(primary, alt, debug)
+
+# ---------------- 단계 본체 (asyncio) ----------------
+# server.auto_diary_graph의 단계 선언/스킵 규칙은 그대로 쓰고, OpenAI를 부르는 단계 본체만 바꾼다.
+# 나머지(재사용/날짜 시프트/모더레이션 게이트/보정 판단/보관/응답)는 가벼운 동기 본체를 그대로 돈다.
+async def _stage_ingest_json(ctx: dict) -> dict:
+    # 업로드 디코드/Stage1 선택/detail 선택은 CPU 작업이라 스레드에서
+    return await asyncio.to_thread(server._stage_ingest_json, ctx)
+
+async def _stage_summary(ctx: dict) -> dict:
+    lines = server._summary_lines(ctx.get("photos") or [])
+    if lines:
+        text = await generate_from_lines_async(lines, ctx["tone"])
+        if text:
+            return {"response": (200, server._summary_payload(lines, text))}
+    return {"response": (400, server._NO_INPUT)}
+
+async def _stage_vision(ctx: dict) -> dict:
+    images, photos = ctx["images"], ctx["photos"]
+    if ctx["journey"]:
+        analysis = await analyze_journey_async(images, photos, ctx["scenes"])
+    else:
+        analysis = await analyze_images_async(images, photos_summary=photos)
+    return server._vision_outputs(ctx, analysis)
+
+async def _stage_moderation(ctx: dict) -> dict:
+    return {"moderation_verdict": await is_content_safe_for_diary_async(ctx["analysis"])}
+
+async def _stage_enrich(ctx: dict) -> dict:
+    analysis = ctx["analysis"]
+    if not server._wants_food_enrich(analysis):
+        return {"diary_analysis": analysis, "category_hint": server._default_category(analysis)}
+    analysis = server._enrich_copy(analysis)
+    try:
+        analysis = await enrich_food_structured_for_multi_async(analysis, images=ctx["images"], photos_summary=ctx["photos"])
+        return {"diary_analysis": analysis, "category_hint": "food_multi"}
+    except Exception as _e:
+        analysis["food_multi_enrich_error"] = str(_e)
+        return {"diary_analysis": analysis, "category_hint": "journey_multi"}
+
+async def _stage_draft_cv(ctx: dict) -> dict:
+    try:
+        selected_draft, cv_debug = await select_draft_via_cross_validation_async(ctx["diary_analysis"], ctx["tone"], ctx["category_hint"])
+    except Exception as e:
+        return {"draft_error": e}
+    return {"selected_draft": selected_draft, "cv_debug": cv_debug}
+
+async def _stage_draft_primary(ctx: dict) -> dict:
+    try:
+        selected_draft = await draft_diary_async(ctx["diary_analysis"], ctx["tone"], ctx["category_hint"], server.MODEL_TEXT)
+    except Exception as e:
+        return {"draft_error": e}
+    return {"selected_draft": selected_draft, "cv_debug": server._primary_only_debug(ctx["diary_analysis"])}
+
+async def _stage_refine(ctx: dict) -> dict:
+    return {"final_text": await refine_diary_async(ctx["diary_analysis"], ctx["selected_draft"], ctx["tone"], ctx["category_hint"])}
+
+_ASYNC_STAGES = {
+    "ingest_json": _stage_ingest_json,
+    "summary": _stage_summary,
+    "vision": _stage_vision,
+    "moderation": _stage_moderation,
+    "enrich": _stage_enrich,
+    "draft_cv": _stage_draft_cv,
+    "draft_primary": _stage_draft_primary,
+    "refine": _stage_refine,
+}
+
+# ---------------- 요청 처리 ----------------
+async def _run_auto_diary(ctx: dict) -> tuple[int, dict]:
+    """server.api_auto_dairy의 JSON 경로와 같은 단계 그래프/응답: analysisId 재사용 → 이미지 파이프라인 → photosSummary 단서."""
+    try:
+        await server.auto_diary_graph.arun(ctx, _ASYNC_STAGES)
+    except Exception as e:
+        handled = server._pipeline_error(ctx, e)
+        if handled is None:
+            raise
+        return handled
+    return server._pipeline_response(ctx)
+
+# ---------------- FastAPI ----------------
+_in_flight = 0
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    yield
+    await aclient.close()
+
+app = FastAPI(title="Snaplog", lifespan=_lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+@app.post("/api/auto-diary")
+async def api_auto_diary(request: Request):
+    global _in_flight
+    if (request.headers.get("content-type") or "").startswith("multipart/"):
+        return JSONResponse({"ok": False, "error": "unsupported_media_type",
+                             "message": "multipart 업로드는 Flask 서버의 /api/auto-diary를 사용하세요."}, status_code=415)
+    max_bytes = server._max_request_bytes(request.query_params.get("mode"))
+    try:
+        declared = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        return JSONResponse({"ok": False, "error": "bad_request", "message": "Content-Length 헤더가 올바르지 않습니다."}, status_code=400)
+    if declared > max_bytes:
+        return JSONResponse(server._too_large_payload(), status_code=413)
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            return JSONResponse(server._too_large_payload(), status_code=413)
+    try:
+        data = json.loads(body) if body else {}
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    _in_flight += 1
+    ctx = server._json_pipeline_ctx(data)
+    request.state.pipeline_trace = ctx.setdefault("pipeline_trace", [])  # Server-Timing용
+    try:
+        status, payload = await _run_auto_diary(ctx)
+    except Exception as e:
+        traceback.print_exc()
+        status, payload = 500, {"ok": False, "error": str(e)}
+    finally:
+        _in_flight -= 1
+    return JSONResponse(jsonable_encoder(payload), status_code=status)
+
+@app.middleware("http")
+async def _record_request_metrics(request: Request, call_next):
+    """server.py의 after_request와 같은 지표/Server-Timing."""
+    started = time.monotonic()
+    resp = await call_next(request)
+    elapsed = time.monotonic() - started
+    route = request.scope.get("route")
+    endpoint = getattr(route, "path", None) or "unmatched"
+    server.metrics.observe("snaplog_http_request_seconds", elapsed, endpoint=endpoint, method=request.method, status=str(resp.status_code))
+    resp.headers["Server-Timing"] = server._server_timing(getattr(request.state, "pipeline_trace", None), elapsed * 1000)
+    resp.headers["Timing-Allow-Origin"] = "*"
+    return resp
+
+@app.get("/health")
+async def health():
+    return {"ok": True, "in_flight": _in_flight}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # 지표 레지스트리는 프로세스 단위 (Flask 서버와 같은 server.metrics)
+    return Response(server.metrics.render(), media_type=server.METRICS_CONTENT_TYPE)
+
+# ---------------- 실행 ----------------
+if __name__ == "__main__":
+    import uvicorn
+    port = int(os.getenv("SNAPLOG_ASGI_PORT", "5001"))
+    print("\n===========================================")
+    print(f"ASGI 서버 시작 → http://127.0.0.1:{port}")
+    print("===========================================\n")
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,166 @@
+"""contact sheet 모드 vs 개별 이미지 모드 비교 (실제 OpenAI 호출)
+
+같은 로컬 이미지 세트를 두 모드로 analyze_images에 넣고
+프롬프트 토큰, 지연 시간, 프레임 단위 일치도를 비교한다. Vision 캐시는 끈다.
+
+사용법 (backend/ 에서, OPENAI_API_KEY 필요):
+    python bench/bench_contact_sheet.py --dir bench/fixtures --set-size 5 --runs 3
+  --dir 안의 이미지를 이름순으로 정렬해 set-size장씩 묶어 세트로 쓴다 (고정 순서 → 재현 가능).
+  --dir가 없거나 비어 있으면 시드 고정 합성 장면(야외/음식/실내) --synthetic장을 그려 넣고 쓴다.
+"""
+
+from __future__ import annotations
+import argparse, glob, os, random, statistics, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["SNAPLOG_VISION_CACHE"] = "0"
+
+import server  # noqa: E402
+
+_calls: list[dict] = []
+_orig_completion = server.throttled_chat_completion
+
+
+def _recording_completion(**kwargs):
+    t0 = time.perf_counter()
+    resp = _orig_completion(**kwargs)
+    usage = getattr(resp, "usage", None)
+    _calls.append({
+        "latency": time.perf_counter() - t0,
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+    })
+    return resp
+
+
+def _draw_scene(kind: str, rng: random.Random, size: tuple[int, int] = (1024, 768)):
+    from PIL import Image, ImageDraw
+    w, h = size
+    img = Image.new("RGB", size)
+    d = ImageDraw.Draw(img)
+    j = lambda c: tuple(max(0, min(255, v + rng.randint(-20, 20))) for v in c)  # noqa: E731
+    if kind == "outdoor":
+        horizon = int(h * rng.uniform(0.45, 0.6))
+        for y in range(horizon):
+            t = y / horizon
+            d.line([(0, y), (w, y)], fill=(int(90 + 80 * t), int(150 + 60 * t), 235))
+        d.rectangle([0, horizon, w, h], fill=j((80, 140, 70)))
+        d.ellipse([w * 0.75, h * 0.08, w * 0.75 + 90, h * 0.08 + 90], fill=(255, 230, 140))
+        for _ in range(rng.randint(2, 4)):
+            x = rng.randint(40, w - 120)
+            d.rectangle([x + 35, horizon - 120, x + 55, horizon + 10], fill=(100, 70, 40))
+            d.ellipse([x, horizon - 220, x + 90, horizon - 90], fill=j((40, 110, 50)))
+        d.polygon([(w * 0.4, h), (w * 0.6, h), (w * 0.52, horizon), (w * 0.48, horizon)], fill=j((150, 150, 150)))
+    elif kind == "food":
+        d.rectangle([0, 0, w, h], fill=j((150, 105, 70)))
+        cx, cy = w // 2 + rng.randint(-60, 60), h // 2 + rng.randint(-40, 40)
+        d.ellipse([cx - 300, cy - 220, cx + 300, cy + 220], fill=(245, 245, 240), outline=(210, 210, 205), width=6)
+        for _ in range(rng.randint(4, 7)):
+            x, y = cx + rng.randint(-170, 170), cy + rng.randint(-110, 110)
+            r = rng.randint(35, 70)
+            d.ellipse([x - r, y - r, x + r, y + r], fill=rng.choice([(200, 60, 40), (230, 180, 60), (90, 160, 60), (240, 220, 190), (120, 70, 40)]))
+        d.ellipse([w - 230, 60, w - 80, 210], fill=(250, 250, 250), outline=(200, 200, 200), width=5)
+        d.ellipse([w - 205, 85, w - 105, 185], fill=(110, 70, 40))
+    else:  # indoor
+        floor = int(h * rng.uniform(0.6, 0.72))
+        d.rectangle([0, 0, w, floor], fill=j((225, 215, 195)))
+        d.rectangle([0, floor, w, h], fill=j((140, 100, 65)))
+        wx = rng.randint(80, w - 380)
+        d.rectangle([wx, 80, wx + 300, 330], fill=(170, 210, 240), outline=(250, 250, 250), width=12)
+        d.line([(wx + 150, 80), (wx + 150, 330)], fill=(250, 250, 250), width=8)
+        tx = rng.randint(60, w - 460)
+        d.rectangle([tx, floor - 40, tx + 400, floor - 10], fill=j((90, 60, 40)))
+        d.rectangle([tx + 20, floor - 10, tx + 40, h - 30], fill=(70, 45, 30))
+        d.rectangle([tx + 360, floor - 10, tx + 380, h - 30], fill=(70, 45, 30))
+        d.rectangle([tx + 150, floor - 110, tx + 200, floor - 40], fill=j((60, 90, 160)))
+    return img
+
+
+def _synthetic_fixtures(path: str, n: int, seed: int = 20240301) -> None:
+    """시드 고정 합성 장면을 path에 저장 (같은 Pillow 버전이면 바이트 단위로 같다)."""
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    kinds = ("outdoor", "food", "indoor")
+    for i in range(n):
+        kind = kinds[i % len(kinds)]
+        _draw_scene(kind, rng).save(os.path.join(path, f"synthetic_{i:02d}_{kind}.jpg"), format="JPEG", quality=88)
+    print(f"합성 이미지 {n}장 생성 → {path} (seed={seed})")
+
+
+def _tokens(s: str) -> set[str]:
+    return {t for t in (s or "").split() if t}
+
+
+def _frame_agreement(a: dict, b: dict) -> dict:
+    fa, fb = a.get("frames") or [], b.get("frames") or []
+    if len(fa) != len(fb) or not fa:
+        return {"count_match": False}
+    same_food = sum(1 for x, y in zip(fa, fb) if bool(x.get("has_food")) == bool(y.get("has_food"))) / len(fa)
+    same_io = sum(1 for x, y in zip(fa, fb) if (x.get("indoor_outdoor") or "unknown") == (y.get("indoor_outdoor") or "unknown")) / len(fa)
+    jac = []
+    for x, y in zip(fa, fb):
+        tx, ty = _tokens(x.get("summary")), _tokens(y.get("summary"))
+        jac.append(len(tx & ty) / len(tx | ty) if (tx | ty) else 1.0)
+    return {"count_match": True, "has_food": same_food, "indoor_outdoor": same_io, "summary_jaccard": statistics.mean(jac)}
+
+
+def _run(images: list, sheet: bool) -> tuple[dict | None, dict]:
+    _calls.clear()
+    t0 = time.perf_counter()
+    out = server.analyze_images(images, contact_sheet=sheet)
+    wall = time.perf_counter() - t0
+    return out, {
+        "wall": wall,
+        "calls": len(_calls),
+        "prompt_tokens": sum(c["prompt_tokens"] for c in _calls),
+        "completion_tokens": sum(c["completion_tokens"] for c in _calls),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+    ap.add_argument("--set-size", type=int, default=5)
+    ap.add_argument("--runs", type=int, default=1)
+    ap.add_argument("--synthetic", type=int, default=10, help="--dir가 비어 있을 때 생성할 합성 이미지 수")
+    args = ap.parse_args()
+
+    if not glob.glob(os.path.join(args.dir, "*.*")):
+        _synthetic_fixtures(args.dir, args.synthetic)
+    paths = sorted(p for ext in ("jpg", "jpeg", "png", "webp") for p in glob.glob(os.path.join(args.dir, f"*.{ext}")))
+    sets = [paths[i:i + args.set_size] for i in range(0, len(paths), args.set_size)]
+    sets = [s for s in sets if len(s) >= 2]
+    if not sets:
+        sys.exit(f"{args.dir} 에 이미지가 2장 이상 필요합니다.")
+
+    server.throttled_chat_completion = _recording_completion
+    rows = {"per_image": [], "sheet": []}
+    agreements = []
+    for run in range(args.runs):
+        for idx, group in enumerate(sets):
+            handles = []
+            for p in group:
+                raw = open(p, "rb").read()
+                data, mime = server._prepare_vision_image(raw, "image/jpeg", "low")
+                handles.append(server.ImageHandle(raw=data, mime=mime, filename=os.path.basename(p)))
+            base, m_base = _run(handles, sheet=False)
+            sheet, m_sheet = _run(handles, sheet=True)
+            rows["per_image"].append(m_base)
+            rows["sheet"].append(m_sheet)
+            agr = _frame_agreement(base or {}, sheet or {})
+            agreements.append(agr)
+            print(f"[run {run} set {idx}] n={len(group)} per_image={m_base} sheet={m_sheet} agreement={agr}")
+
+    print("\n=== 요약 ===")
+    for mode, ms in rows.items():
+        print(f"{mode:<10} prompt_tokens(avg)={statistics.mean(m['prompt_tokens'] for m in ms):8.1f} "
+              f"wall(avg)={statistics.mean(m['wall'] for m in ms):6.2f}s calls(avg)={statistics.mean(m['calls'] for m in ms):.2f}")
+    ok = [a for a in agreements if a.get("count_match")]
+    print(f"frame count match: {len(ok)}/{len(agreements)}")
+    if ok:
+        for key in ("has_food", "indoor_outdoor", "summary_jaccard"):
+            print(f"  {key:<16} {statistics.mean(a[key] for a in ok):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""EXIF 추출 마이크로벤치마크: 헤더 전용 리더 vs 기존 PIL 경로
+
+사용법 (backend/ 에서):
+    python bench/bench_exif.py                 # 합성 12MP JPEG 5장
+    python bench/bench_exif.py --dir ~/Photos  # 실제 사진 폴더
+"""
+
+from __future__ import annotations
+import argparse, glob, hashlib, io, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench-not-used")
+
+import server  # noqa: E402
+import legacy  # noqa: E402
+
+
+def _synthetic_jpegs(n: int, size: tuple[int, int]) -> list[bytes]:
+    from PIL import Image
+    out = []
+    for i in range(n):
+        img = Image.effect_noise(size, 64 + i).convert("RGB")
+        exif = Image.Exif()
+        exif[0x0112] = 1
+        exif.get_ifd(0x8769)[0x9003] = f"2024:03:0{i + 1} 12:00:00"
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=90, exif=exif.tobytes())
+        out.append(buf.getvalue())
+    return out
+
+
+def _load_dir(path: str) -> list[bytes]:
+    files = []
+    for ext in ("jpg", "jpeg", "png", "webp", "heic", "JPG", "JPEG", "PNG", "HEIC"):
+        files.extend(glob.glob(os.path.join(os.path.expanduser(path), f"*.{ext}")))
+    return [open(f, "rb").read() for f in sorted(set(files))]
+
+
+def _bench(label: str, fn, blobs: list[bytes], repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for b in blobs:
+            fn(b)
+    per = (time.perf_counter() - t0) / (repeat * len(blobs))
+    print(f"{label:<28} {per * 1e3:8.3f} ms/image")
+    return per
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dir", help="실제 이미지 폴더")
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+
+    blobs = _load_dir(args.dir) if args.dir else _synthetic_jpegs(5, (4000, 3000))
+    if not blobs:
+        sys.exit("이미지가 없습니다.")
+    print(f"{len(blobs)}장, 평균 {sum(map(len, blobs)) / len(blobs) / 1e6:.2f} MB")
+
+    mismatches = 0
+    for b in blobs:
+        server._meta_cache.clear()
+        if server.read_image_meta(b).get("datetime") != legacy.read_exif_datetime_pil(b):
+            mismatches += 1
+    print(f"datetime 불일치: {mismatches}/{len(blobs)}")
+
+    pil = _bench("PIL (Image.open + _getexif)", legacy.read_exif_datetime_pil, blobs, args.repeat)
+
+    def _uncached(b: bytes):
+        server._meta_cache.clear()
+        return server.read_image_meta(b)
+
+    hdr = _bench("header-only (no cache)", _uncached, blobs, args.repeat)
+    # 캐시는 전체 sha256을 아는 호출자(ImageHandle/업로드 스풀)만 쓴다 → 해시는 미리 계산된 것으로 본다
+    digests = {id(b): hashlib.sha256(b).hexdigest() for b in blobs}
+    _bench("header-only (cached)", lambda b: server.read_image_meta(b, digests[id(b)]), blobs, args.repeat)
+
+    import base64
+    urls = ["data:image/jpeg;base64," + base64.b64encode(b).decode("ascii") for b in blobs]
+
+    def _pil_data_url(u: str):
+        return legacy.read_exif_datetime_pil(base64.b64decode(u.split(",", 1)[1]))
+
+    def _hdr_data_url(u: str):
+        server._meta_cache.clear()
+        return server.read_image_meta_from_data_url(u)
+
+    _bench("PIL data URL (full b64decode)", _pil_data_url, urls, args.repeat)
+    _bench("header-only data URL", _hdr_data_url, urls, args.repeat)
+    print(f"speedup (bytes, uncached): {pil / hdr:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""5장 multipart 요청의 피크 메모리 측정 (tracemalloc)
+
+OpenAI 호출은 고정 응답으로 대체하고, 업로드 → EXIF → 전처리 → analyze_images → 초안/보정
+경로를 Flask test client로 그대로 통과시킨다.
+
+사용법 (backend/ 에서):
+    python bench/bench_memory.py
+    python bench/bench_memory.py --max-peak-mb 40   # 초과 시 exit 1 (회귀 감지용)
+"""
+
+from __future__ import annotations
+import argparse, io, json, os, sys, tempfile, tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench-not-used")
+os.environ.setdefault("SNAPLOG_UPLOAD_DIR", tempfile.mkdtemp(prefix="snaplog-bench-"))
+os.environ.setdefault("SNAPLOG_VISION_CACHE", "0")
+
+import server  # noqa: E402
+
+
+def _fake_completion(**kwargs):
+    n = sum(1 for m in kwargs.get("messages") or [] if isinstance(m.get("content"), list)
+            for part in m["content"] if part.get("type") == "image_url")
+    if n:
+        frames = [{"index": i + 1, "summary": "길을 걸었다", "elements": ["나무"], "has_food": False} for i in range(n)]
+        content = json.dumps({"frames": frames, "global": {"movement": "있음"}}, ensure_ascii=False)
+    else:
+        content = "천천히 걸었다. " * 20
+    msg = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(message=msg, finish_reason="stop")], usage=None)
+
+
+def _fixtures(n: int) -> list[bytes]:
+    from PIL import Image
+    out = []
+    for i in range(n):
+        img = Image.effect_noise((4000, 3000), 40 + i).convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=92)
+        out.append(buf.getvalue())
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--images", type=int, default=5)
+    ap.add_argument("--max-peak-mb", type=float, default=0.0)
+    args = ap.parse_args()
+
+    server.throttled_chat_completion = _fake_completion
+    server.is_content_safe_for_diary = lambda analysis: (True, {"reason": "bench"})
+    blobs = _fixtures(args.images)
+    input_mb = sum(map(len, blobs)) / 1e6
+    client = server.app.test_client()
+
+    def _post():
+        data = {"tone": "중립", "images": [(io.BytesIO(b), f"IMG_{i}.jpg", "image/jpeg") for i, b in enumerate(blobs)]}
+        return client.post("/api/auto-diary", data=data, content_type="multipart/form-data")
+
+    _post()  # 워밍업 (모듈 import, 캐시 등)
+    tracemalloc.start()
+    resp = _post()
+    _cur, peak = tracemalloc.get_traced_memory()
+    top = tracemalloc.take_snapshot().statistics("lineno")[:5]
+    tracemalloc.stop()
+
+    peak_mb = peak / 1e6
+    print(f"status={resp.status_code} images={args.images} input={input_mb:.1f} MB")
+    print(f"peak traced memory: {peak_mb:.1f} MB ({peak_mb / max(input_mb, 1e-9):.2f}x input)")
+    for stat in top:
+        print("  ", stat)
+    if args.max_peak_mb and peak_mb > args.max_peak_mb:
+        print(f"FAIL: peak {peak_mb:.1f} MB > {args.max_peak_mb} MB")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
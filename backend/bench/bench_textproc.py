@@ -0,0 +1,104 @@
+"""후처리 마이크로벤치마크: 규칙표 엔진(초안 후처리 3번 스캔) vs 기존 다중 패스(규칙마다 1번)
+
+초안/보정 출력이 거치는 clean_inline → 고유명사 교체 → 음식 나열 축약 → 보고서형 완화 → 태그 재배열을
+합성 일기 코퍼스에 대해 두 경로로 돌려 결과 일치 여부와 처리량을 비교한다.
+
+사용법 (backend/ 에서):
+    python bench/bench_textproc.py               # 합성 일기 2000편
+    python bench/bench_textproc.py --n 10000 --frames 5
+"""
+
+from __future__ import annotations
+import argparse, os, random, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench-not-used")
+
+import server  # noqa: E402
+import legacy as ref  # noqa: E402
+
+_PLAIN = [
+    "골목을 따라 천천히 걸었다.", "창가 자리에 앉아 잠깐 쉬었다.", "바람이 조금 불어서 겉옷을 여몄다.",
+    "국물 한 숟갈에 몸이 풀렸다.", "오후 햇빛이 테이블 끝에 걸려 있었다.", "계산을 마치고 밖으로 나왔다.",
+    "따뜻한 라떼를 두 손으로 감쌌다.", "역까지는 생각보다 가까웠다.",
+]
+_NOISY = [
+    "사진 속 {brand} 간판 앞에서 잠시 멈췄다.", "IMG_2024{mm}{dd}_1203.jpg 에 담긴 장면이었다.",
+    "2024-{mm}-{dd} 점심은 {brand}에서 해결했다.", "국, 밥, 반찬, 김치가 차례로 나왔다.",
+    "테이블 위에 반찬 여러 개가 준비되어 있었다.", "창밖 풍경이 눈에 들어왔다.",
+    "향이 진하게 올라와 식욕을 자극했다.", "한 입 먹고 나니 금세 배가 불렀다.",
+    "일상적인 분위기로 가득 차 있었다.", "조용히 앉아 있었다.   있었다.", "현재 시각 확인되지   않음 상태였다.",
+    "찍은 장면을 다시 떠올렸다.", "2024년 {m}월 {d}일 오후였다.",
+]
+_BRANDS = ["스타벅스", "이디야", "투썸", "파리바게뜨", "맥도날드", "롯데리아", "동네 분식"]
+
+
+def _sentence(rnd: random.Random) -> str:
+    if rnd.random() < 0.45:
+        m, d = rnd.randint(1, 12), rnd.randint(1, 28)
+        return rnd.choice(_NOISY).format(brand=rnd.choice(_BRANDS), mm=f"{m:02d}", dd=f"{d:02d}", m=m, d=d)
+    return rnd.choice(_PLAIN)
+
+
+def _corpus(n: int, frames: int, seed: int = 11) -> list[tuple[str, list[str], dict]]:
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        k = rnd.randint(1, frames)
+        blocks = [" ".join(_sentence(rnd) for _ in range(rnd.randint(1, 3))) for _ in range(k)]
+        order = list(range(k))
+        rnd.shuffle(order)  # 모델이 순서를 섞어 쓴 경우
+        text = "\n".join(f"<f{i + 1}>{blocks[i]}</f{i + 1}>" for i in order)
+        days = sorted(rnd.choice(["2024-05-01", "2024-05-02", "2024-05-04"]) for _ in range(k))
+        analysis = {"frames": [{"visible_text": "스타벅스" if rnd.random() < 0.2 else ""} for _ in range(k)]}
+        out.append((text, days, analysis))
+    return out
+
+
+def _pipeline_new(text: str, days: list[str], analysis: dict) -> str:
+    t = server._postprocess_draft(analysis, text)
+    return server._reorder_by_tags(t, len(days), days) or server._TAG_RE.sub("", t)
+
+
+def _pipeline_legacy(text: str, days: list[str], analysis: dict) -> str:
+    t = ref.clean_inline(text)
+    t = ref.replace_proper_nouns(analysis, t)
+    t = server.GENERIC_LIST_RE.sub("반찬 몇 가지", t)
+    t = ref.soften_report_tone(t)
+    return ref.reorder_by_tags(t, len(days), days) or server._TAG_RE.sub("", t)
+
+
+def _bench(label: str, fn, corpus: list, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for row in corpus:
+            fn(*row)
+    per = (time.perf_counter() - t0) / (repeat * len(corpus))
+    print(f"{label:<30} {per * 1e6:8.1f} us/diary  ({1 / per:,.0f} diaries/s)")
+    return per
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=2000)
+    ap.add_argument("--frames", type=int, default=5)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    corpus = _corpus(args.n, args.frames)
+    print(f"일기 {len(corpus)}편, 평균 {sum(len(t) for t, _, _ in corpus) / len(corpus):.0f}자")
+
+    mismatches = [row for row in corpus if _pipeline_new(*row) != _pipeline_legacy(*row)]
+    elems = [s for t, _, _ in corpus for s in t.split(".")]
+    mismatches_inline = sum(server.clean_inline(s) != ref.clean_inline(s) for s in elems)
+    print(f"결과 불일치: 파이프라인 {len(mismatches)}, clean_inline {mismatches_inline}")
+    if mismatches:
+        print("  예:", repr(mismatches[0][0][:200]))
+
+    legacy = _bench("legacy (multi-pass)", _pipeline_legacy, corpus, args.repeat)
+    new = _bench("rule-table engine", _pipeline_new, corpus, args.repeat)
+    print(f"speedup: {legacy / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
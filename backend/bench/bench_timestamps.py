@@ -0,0 +1,104 @@
+"""시각 해석 마이크로벤치마크: 모양 분류 리졸버 vs 기존 strptime 순차 시도
+
+사용법 (backend/ 에서):
+    python bench/bench_timestamps.py                # 합성 KakaoTalk/EXIF/파일명 시각 5000개
+    python bench/bench_timestamps.py --n 20000 --unique 0.3
+"""
+
+from __future__ import annotations
+import argparse, os, random, sys, time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench-not-used")
+
+import server  # noqa: E402
+from legacy import dt_from_filename as dt_from_filename_legacy, parse_any_dt as parse_any_dt_legacy  # noqa: E402
+
+# 실제 업로드에서 보이는 모양: photosSummary(카카오톡 내보내기/클라이언트 ISO), imagesMeta.shotAt, EXIF, epoch
+_VALUE_FORMATS = [
+    "%Y-%m-%d %H:%M:%S",        # photosSummary.time
+    "%Y.%m.%d. %H:%M",          # 카카오톡 내보내기
+    "%Y-%m-%dT%H:%M:%S.%f",     # JS toISOString (Z 없는 변형)
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%dT%H:%M:%S+09:00",
+    "%Y:%m:%d %H:%M:%S",        # EXIF DateTimeOriginal
+    "%Y%m%d_%H%M%S",
+]
+_NAME_FORMATS = [
+    "KakaoTalk_%Y%m%d_%H%M%S123.jpg",
+    "IMG_%Y%m%d_%H%M%S.jpg",
+    "Screenshot_%Y-%m-%d-%H-%M-%S.png",
+    "PXL_%Y%m%d_%H%M%S456.MP.jpg",
+    "%Y.%m.%d %H.%M.%S.jpg",
+]
+
+
+def _corpus(n: int, unique: float, seed: int = 7) -> tuple[list, list[str]]:
+    rnd = random.Random(seed)
+    base = datetime(2024, 1, 1)
+    pool_n = max(1, int(n * unique))
+    stamps = [base + timedelta(seconds=rnd.randrange(0, 400 * 86400)) for _ in range(pool_n)]
+    values, names = [], []
+    for _ in range(n):
+        d = rnd.choice(stamps)
+        if rnd.random() < 0.15:
+            values.append(int(d.timestamp() * 1000))
+        else:
+            values.append(d.strftime(rnd.choice(_VALUE_FORMATS)))
+        names.append(d.strftime(rnd.choice(_NAME_FORMATS)))
+    return values, names
+
+
+def _bench(label: str, fn, items: list, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for x in items:
+            fn(x)
+    per = (time.perf_counter() - t0) / (repeat * len(items))
+    print(f"{label:<34} {per * 1e6:8.2f} us/value")
+    return per
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=5000)
+    ap.add_argument("--unique", type=float, default=0.5, help="서로 다른 시각의 비율 (메모 적중률 조절)")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    values, names = _corpus(args.n, args.unique)
+    print(f"값 {len(values)}개, 파일명 {len(names)}개")
+
+    mismatches = sum(server._parse_any_dt(v) != parse_any_dt_legacy(v) for v in values)
+    mismatches += sum(server._dt_from_filename(x) != dt_from_filename_legacy(x) for x in names)
+    print(f"결과 불일치: {mismatches}")
+
+    legacy = _bench("legacy _parse_any_dt (strptime)", parse_any_dt_legacy, values, args.repeat)
+
+    # 메모 없이 해석 자체만 (lru_cache 래퍼를 건너뛴다)
+    parse_str = server._parse_dt_str.__wrapped__
+
+    def _no_memo(v):
+        return server._epoch_dt(float(v)) if isinstance(v, (int, float)) else parse_str(str(v).strip())
+
+    fresh = _bench("resolver (no memo)", _no_memo, values, args.repeat)
+    _bench("resolver (memo warm)", server._parse_any_dt, values, args.repeat)
+
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        server._parse_dt_str.cache_clear()
+        server._parse_many_dt(values)
+    print(f"{'resolver batch (_parse_many_dt)':<34} {(time.perf_counter() - t0) / (args.repeat * len(values)) * 1e6:8.2f} us/value")
+
+    fn_legacy = _bench("legacy _dt_from_filename", dt_from_filename_legacy, names, args.repeat)
+
+    from_basename = server._dt_from_basename.__wrapped__
+    fn_new = _bench("resolver filename (no memo)", lambda x: from_basename(os.path.basename(x)), names, args.repeat)
+    server._dt_from_basename.cache_clear()
+    _bench("resolver filename (memo warm)", server._dt_from_filename, names, args.repeat)
+    print(f"speedup (values, no memo): {legacy / fresh:.1f}x, (filenames, no memo): {fn_legacy / fn_new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
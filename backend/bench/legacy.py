@@ -0,0 +1,170 @@
+"""벤치마크 비교 기준: server.py에서 교체되기 전의 구현
+
+bench_*.py가 새 경로와 결과 일치/속도를 비교할 때만 쓴다. 서버 코드에서는 import하지 않는다.
+"""
+
+from __future__ import annotations
+import io, os, re, sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench-not-used")
+
+import server  # noqa: E402
+
+
+# ============ 시각 해석 (strptime 순차 시도 / 파일명 정규식 4개) ============
+def parse_any_dt(x: str | int | float) -> datetime | None:
+    if x is None:
+        return None
+    # epoch-like
+    if isinstance(x, (int, float)):
+        try:
+            ts = float(x)
+            if ts > 10_000_000_000:  # ms
+                ts /= 1000.0
+            return datetime.fromtimestamp(ts)
+        except Exception:
+            pass
+    xs = str(x).strip()
+    if re.fullmatch(r"\d{10,13}", xs):
+        try:
+            ts = int(xs)
+            if len(xs) >= 13:
+                ts = ts / 1000.0
+            return datetime.fromtimestamp(ts)
+        except Exception:
+            pass
+    if xs.endswith("Z"):
+        xs = xs[:-1] + "+00:00"
+    fmts = (
+        "%Y-%m-%d %H:%M:%S%z",
+        "%Y-%m-%d %H:%M%z",
+        "%Y-%m-%dT%H:%M:%S.%f%z",
+        "%Y-%m-%dT%H:%M:%S%z",
+        "%Y-%m-%dT%H:%M%z",
+        "%Y-%m-%d %H:%M:%S",
+        "%Y-%m-%d %H:%M",
+        "%Y-%m-%d",
+        "%Y.%m.%d %H:%M:%S",
+        "%Y.%m.%d %H:%M",
+        "%Y.%m.%d.",
+        "%Y.%m.%d. %H:%M:%S",
+        "%Y.%m.%d. %H:%M",
+        "%Y/%m/%d %H:%M:%S",
+        "%Y/%m/%d %H:%M",
+        "%Y-%m-%d-%H-%M-%S",
+        "%Y.%m.%d-%H-%M-%S",
+        "%Y:%m:%d %H:%M:%S",
+        "%Y%m%d_%H%M%S",
+        "%Y%m%d%H%M%S",
+        "%Y-%m-%d %H:%M:%S.%f",
+    )
+    for fmt in fmts:
+        try:
+            return datetime.strptime(xs, fmt)
+        except Exception:
+            pass
+    try:
+        return datetime.fromisoformat(xs)
+    except Exception:
+        return None
+
+_FILENAME_DT_PATTERNS = [
+    re.compile(r".*?(?P<y>\d{4})(?P<m>\d{2})(?P<d>\d{2})[_\- ](?P<H>\d{2})(?P<M>\d{2})(?P<S>\d{2}).*", re.I),
+    re.compile(r".*?(?P<y>\d{4})[-_.](?P<m>\d{2})[-_.](?P<d>\d{2})[-_ ](?P<H>\d{2})[-_.:](?P<M>\d{2})(?:[-_.:](?P<S>\d{2}))?.*", re.I),
+    re.compile(r".*?(?P<y>\d{4})[.](?P<m>\d{2})[.](?P<d>\d{2})[ _](?P<H>\d{2})[.](?P<M>\d{2})(?:[.](?P<S>\d{2}))?.*", re.I),
+    re.compile(r".*?(?P<y>\d{4})(?P<m>\d{2})(?P<d>\d{2})[_-](?P<H>\d{2})(?P<M>\d{2})(?P<S>\d{2}).*", re.I),
+]
+
+def dt_from_filename(name: str) -> datetime | None:
+    if not name:
+        return None
+    base = os.path.basename(name)
+    for pat in _FILENAME_DT_PATTERNS:
+        m = pat.match(base)
+        if m:
+            try:
+                y = int(m.group("y")); mth = int(m.group("m")); d = int(m.group("d"))
+                H = int(m.group("H")); M = int(m.group("M")); S = int(m.group("S") or 0)
+                return datetime(y, mth, d, H, M, S)
+            except Exception:
+                continue
+    return None
+
+
+# ============ 텍스트 후처리 (규칙별 다중 패스) ============
+def clean_inline(s: str) -> str:
+    if not s:
+        return ""
+    t = re.sub(r"\s+", " ", s).strip()
+    t = server.FILE_RE.sub("", t)
+    t = server.DATE_RE.sub("", t)
+    for w in server.BAN_WORDS_INLINE:
+        t = t.replace(w, "")
+    return t.strip()
+
+
+def replace_proper_nouns(analysis: dict, draft: str) -> str:
+    if not analysis or not draft:
+        return draft
+    if any(f.get("visible_text", "").strip() for f in analysis.get("frames") or []):
+        return draft
+    text = draft
+    for pat, rep in server.PROPER_NOUN_MAP.items():
+        text = re.sub(pat, rep, text, flags=re.I)
+    return text
+
+
+def reorder_by_tags(text: str, n_frames: int, date_sequence: list[str]) -> str | None:
+    if not text or n_frames <= 0:
+        return None
+    blocks = {}
+    for i in range(1, n_frames + 1):
+        m = re.search(rf"<f{i}>(.*?)</f{i}>", text, re.I | re.S)
+        if not m or not m.group(1).strip(): return None
+        blocks[i] = m.group(1).strip()
+    breaks = {pos: diff for (pos, diff) in server._day_break_positions(date_sequence or [])}
+    out_parts = []
+    for i in range(1, n_frames + 1):
+        if i in breaks:
+            out_parts.append(server._label_for_days(breaks[i]))
+        out_parts.append(blocks[i].strip())
+    return clean_inline(server._TAG_RE.sub("", " ".join(out_parts).strip()))
+
+
+def soften_report_tone(text: str) -> str:
+    if not text:
+        return text
+    t = text
+    for p in server.TRIM_PHRASES:
+        t = t.replace(p, "")
+    for pat, rep in server.REPORT_PATTERNS:
+        t = re.sub(pat, rep, t)
+    t = re.sub(r"(있었다\.)\s+(있었다\.)", r"\1 ", t)
+    return t.strip()
+
+
+# ============ EXIF (PIL로 전체 이미지를 연다) ============
+def read_exif_datetime_pil(raw: bytes) -> datetime | None:
+    try:
+        from PIL import Image
+        from PIL.ExifTags import TAGS
+        img = Image.open(io.BytesIO(raw))
+        exif = getattr(img, "_getexif", lambda: None)() or {}
+        for tag_id, value in exif.items():
+            tag = TAGS.get(tag_id, tag_id)
+            if tag in ("DateTimeOriginal", "DateTime"):
+                dt = server._parse_any_dt(str(value))
+                if dt:
+                    return dt
+        info = getattr(img, "info", {}) or {}
+        for k in ("Creation Time", "date:create", "date:modify"):
+            v = info.get(k)
+            if v:
+                dt = server._parse_any_dt(str(v))
+                if dt:
+                    return dt
+    except Exception as e:
+        print(f"EXIF 추출 실패: {e}")
+    return None
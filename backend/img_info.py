@@ -1,15 +1,46 @@
 from flask import Flask, request, jsonify
+from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
 
 app = Flask(__name__)
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# 요청 전체 한도는 werkzeug가 413으로 막고, 파일별 한도는 저장하면서 검사
+MAX_FILE_BYTES = int(float(os.getenv('SNAPLOG_MAX_FILE_MB', '25')) * 1024 * 1024)
+app.config['MAX_CONTENT_LENGTH'] = int(float(os.getenv('SNAPLOG_MAX_REQUEST_MB', '100')) * 1024 * 1024)
+CHUNK = 256 * 1024
+
+def _save_limited(f, path):
+    """청크 단위로 저장, 파일별 한도를 넘으면 지우고 413"""
+    written = 0
+    try:
+        with open(path, 'wb') as out:
+            while True:
+                chunk = f.stream.read(CHUNK)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > MAX_FILE_BYTES:
+                    raise RequestEntityTooLarge()
+                out.write(chunk)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return written
+
+@app.errorhandler(RequestEntityTooLarge)
+def too_large(e):
+    return jsonify({'message': 'File too large', 'max_file_bytes': MAX_FILE_BYTES}), 413
+
 @app.route('/upload', methods=['POST'])
 def upload():
     files = request.files.getlist('files')
     for f in files:
-        f.save(os.path.join(UPLOAD_FOLDER, f.filename))
+        name = secure_filename(f.filename or '') or 'upload.bin'
+        _save_limited(f, os.path.join(UPLOAD_FOLDER, name))
     return jsonify({'message': 'Files uploaded successfully'})
 
 if __name__ == '__main__':
@@ -1,14 +1,19 @@
 """Snaplog server – 3단계(분석→초안→보정) + 교차검증(모델 이중생성)"""
 
 from __future__ import annotations
-import os, re, json, random, traceback, time, io, base64, uuid
-from threading import Lock
-from flask import Flask, request, jsonify, send_file
+import os, re, json, random, traceback, time, io, base64, uuid, hashlib, shutil, tempfile, sqlite3, queue, asyncio, struct
+from collections import OrderedDict
+from contextlib import closing
+from functools import lru_cache
+from threading import Condition, Event, Lock, Thread, local
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from flask import Flask, Request, Response, request, jsonify, send_file, stream_with_context, copy_current_request_context
 from flask_cors import CORS
 from openai import OpenAI, RateLimitError
 from openai import APIConnectionError, APITimeoutError
-from datetime import datetime, timedelta  # [추가] timedelta
+from datetime import datetime, timedelta, timezone  # [추가] timedelta
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # ---------------- Flask ---------------
 
@@ -20,6 +25,12 @@ CORS(app)
 UPLOAD_DIR = os.getenv("SNAPLOG_UPLOAD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads"))
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# 업로드 한도: 요청 전체는 MAX_CONTENT_LENGTH(werkzeug가 413), 파일별은 _UploadSpool이 스트리밍 중 검사
+UPLOAD_MAX_REQUEST_BYTES = int(float(os.getenv("SNAPLOG_MAX_REQUEST_MB", "100")) * 1024 * 1024)
+UPLOAD_MAX_FILE_BYTES = int(float(os.getenv("SNAPLOG_MAX_FILE_MB", "25")) * 1024 * 1024)
+UPLOAD_SPOOL_MEMORY_BYTES = int(float(os.getenv("SNAPLOG_UPLOAD_SPOOL_KB", "1024")) * 1024)  # 이보다 크면 디스크로
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_REQUEST_BYTES
+
 # ---------------- OpenAI ----------------
 
 API_KEY = os.getenv("OPENAI_OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
@@ -39,8 +50,15 @@ MAX_IMAGES   = 5
 THROTTLE_SECONDS = float(os.getenv("OPENAI_THROTTLE_SECONDS", "0.5"))
 MAX_WAIT_SECONDS = float(os.getenv("OPENAI_MAX_WAIT_SECONDS", "30"))
 REQUEST_TIMEOUT = float(os.getenv("OPENAI_REQUEST_TIMEOUT", "30"))
-_last_call_ts = 0.0
-_throttle_lock = Lock()
+
+# === 모델별 레이트 리미터 설정 ===
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))                 # 모델별 분당 요청 수
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "200000"))              # 모델별 분당 토큰 수
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "4")) # 모델별 동시 요청 수 상한
+PACE_LOW_WATERMARK = float(os.getenv("OPENAI_PACE_LOW_WATERMARK", "0.1"))  # 남은 한도 비율이 이 아래면 감속
+PACE_STEP_SECONDS = float(os.getenv("OPENAI_PACE_STEP_SECONDS", "0.05"))   # 여유 있을 때 간격을 줄이는 폭(가산)
+PACE_MAX_SECONDS = float(os.getenv("OPENAI_PACE_MAX_SECONDS", "10"))       # 적응 간격 상한
+ASYNC_SLOT_POLL_SECONDS = float(os.getenv("OPENAI_ASYNC_SLOT_POLL_SECONDS", "0.05"))  # ASGI 경로: 동시 요청 슬롯 재확인 간격
 
 # === Call-budget switches (추가) ===
 STAGE1_TOP_N = int(os.getenv("SNAPLOG_STAGE1_TOPN", "5"))  # Stage1에 투입할 최대 이미지 수 (<= MAX_IMAGES)
@@ -48,43 +66,687 @@ ALT_SKIP_IF_LOW_FOOD = int(os.getenv("SNAPLOG_ALT_SKIP_IF_LOW_FOOD", "1"))  # 
 ALT_LOW_FOOD_THRESH = float(os.getenv("SNAPLOG_LOW_FOOD_THRESH", "0.4"))    # 0~1 사이, 낮을수록 ALT 더 자주 스킵
 REFINE_SKIP_IF_SHORT = int(os.getenv("SNAPLOG_REFINE_SKIP_IF_SHORT", "1"))  # 초안이 짧으면 보정 스킵
 REFINE_MIN_CHARS = int(os.getenv("SNAPLOG_REFINE_MIN_CHARS", "280"))        # 이 길이 미만이면 보정 생략
+REFINE_SKIP_IF_VALID = int(os.getenv("SNAPLOG_REFINE_SKIP_IF_VALID", "1"))  # 로컬 문체 검사에 위반이 없으면 보정 생략
+CV_PARALLEL = int(os.getenv("SNAPLOG_CV_PARALLEL", "1"))                    # 기본/ALT 초안 동시 실행
+CV_ALT_DEADLINE_SECONDS = float(os.getenv("SNAPLOG_CV_ALT_DEADLINE", "20"))  # 이 시간 안에 ALT가 없으면 기본 채택
+
+# OpenAI 하위 호출(초안 병렬 등)용 공용 스레드 풀. 동시성 자체는 레이트 리미터가 제한한다.
+_io_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SNAPLOG_IO_WORKERS", "16")), thread_name_prefix="snaplog-io")
+
+# ---------------- 지표 (Prometheus /metrics) ----------------
+METRICS_BUCKETS = tuple(sorted(float(x) for x in os.getenv(
+    "SNAPLOG_METRICS_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,20,40").split(",") if x.strip()))
+
+class _Metrics:
+    """
+    프로세스 단위 지표 레지스트리. prometheus_client 없이 텍스트 노출 형식(0.0.4)만 구현한다.
+    - counter: inc()로 누적, histogram: observe()로 고정 버킷(초) 누적 분포
+    - 다른 객체가 이미 세고 있는 값(vision_cache.stats 등)은 collect()로 등록해 긁을 때 읽는다
+    """
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self._lock = Lock()
+        self._meta: dict[str, tuple[str, str]] = {}               # 이름 → (type, help)
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._hists: dict[str, dict[tuple, list[float]]] = {}    # 라벨 → [버킷별 개수..., 합, 개수]
+        self._collectors: list = []
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            row = self._hists.setdefault(name, {}).get(key)
+            if row is None:
+                row = self._hists[name][key] = [0.0] * (len(self.buckets) + 2)
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    row[i] += 1
+            row[-2] += seconds
+            row[-1] += 1
+
+    def collect(self, fn) -> None:
+        """fn() -> [(이름, {라벨}, 값), ...]. 이름은 describe로 type/help를 등록해 둔다."""
+        self._collectors.append(fn)
+
+    @staticmethod
+    def _labels(key, extra: str = "") -> str:
+        parts = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in key]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        samples: dict[str, list[str]] = {}
+        with self._lock:
+            for name, series in self._counters.items():
+                samples[name] = [f"{name}{self._labels(k)} {v:g}" for k, v in series.items()]
+            for name, series in self._hists.items():
+                lines = samples[name] = []
+                for k, row in series.items():
+                    for le, n in zip(self.buckets + (float("inf"),), row[:-2] + row[-1:]):
+                        le_label = 'le="%s"' % ("+Inf" if le == float("inf") else f"{le:g}")
+                        lines.append(f"{name}_bucket{self._labels(k, le_label)} {n:g}")
+                    lines.append(f"{name}_sum{self._labels(k)} {row[-2]:.6f}")
+                    lines.append(f"{name}_count{self._labels(k)} {row[-1]:g}")
+        for fn in self._collectors:
+            try:
+                for name, labels, value in fn():
+                    samples.setdefault(name, []).append(f"{name}{self._labels(tuple(sorted(labels.items())))} {value:g}")
+            except Exception as e:
+                print(f"[metrics] collector 실패: {e}")
+        out = []
+        for name in sorted(samples):
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(samples[name])
+        return "\n".join(out) + "\n"
+
+metrics = _Metrics(METRICS_BUCKETS)
+for _name, _kind, _help in (
+    ("snaplog_http_request_seconds", "histogram", "HTTP request latency by endpoint/method/status"),
+    ("snaplog_stage_seconds", "histogram", "Pipeline stage latency by stage/status"),
+    ("snaplog_stage_skipped_total", "counter", "Pipeline stages skipped by their skip predicate"),
+    ("snaplog_openai_request_seconds", "histogram", "OpenAI call latency per attempt by model/outcome"),
+    ("snaplog_throttle_wait_seconds", "histogram", "Time spent waiting for a rate limiter slot by model"),
+    ("snaplog_openai_tokens_total", "counter", "Tokens reported by response.usage by model/type"),
+    ("snaplog_openai_retries_total", "counter", "Retried OpenAI attempts by model/error"),
+    ("snaplog_openai_backoff_seconds_total", "counter", "Seconds slept before retries by model"),
+    ("snaplog_throttle_timeouts_total", "counter", "Calls abandoned after OPENAI_MAX_WAIT_SECONDS by model"),
+):
+    metrics.describe(_name, _kind, _help)
+
+def _record_usage(model: str, usage) -> int | None:
+    """response.usage → 모델별 토큰 카운터. 리미터 보정용 total_tokens를 돌려준다."""
+    if usage is None:
+        return None
+    prompt = getattr(usage, "prompt_tokens", None) or 0
+    completion = getattr(usage, "completion_tokens", None) or 0
+    cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+    if prompt:
+        metrics.inc("snaplog_openai_tokens_total", prompt, model=model, type="prompt")
+    if completion:
+        metrics.inc("snaplog_openai_tokens_total", completion, model=model, type="completion")
+    if cached:
+        metrics.inc("snaplog_openai_tokens_total", cached, model=model, type="cached_prompt")
+    return getattr(usage, "total_tokens", None)
+
+# ---------------- 레이트 리미터 ----------------
+CANCEL_POLL_SECONDS = 0.1  # 취소 가능한 호출이 리미터 대기 중 취소 여부를 확인하는 간격
+
+class _StepsCancelled(Exception):
+    """_run_steps(cancel=...)의 이벤트가 설정됨: 다음 OpenAI 호출을 보내거나 재시도하기 전에 멈춘다."""
+
+class _ModelRateLimiter:
+    """
+    모델 하나에 대한 토큰 버킷 리미터.
+    - 요청 버킷(RPM)과 토큰 버킷(TPM)을 각각 초당 비율로 리필
+    - 동시 요청 수(in-flight)는 max_in_flight로 제한
+    - 요청 시작 간격은 최소 THROTTLE_SECONDS 유지, 429 등에서는 penalize()로 쿨다운
+    - 응답 헤더(x-ratelimit-*)로 버킷을 서버 상태에 맞추고, 적응 간격(pace)을 AIMD로 조절
+    API 호출 자체는 락 밖에서 이루어지므로 서로 다른 요청이 겹쳐서 실행된다.
+    """
+
+    def __init__(self, model: str, rpm: float, tpm: float, max_in_flight: int, min_interval: float):
+        self.model = model
+        self.rpm = max(rpm, 1.0)
+        self.tpm = max(tpm, 1.0)
+        self.max_in_flight = max(max_in_flight, 1)
+        self.min_interval = max(min_interval, 0.0)
+        self._cond = Condition(Lock())
+        self._req_tokens = self.rpm
+        self._tok_tokens = self.tpm
+        self._refill_ts = time.monotonic()
+        self._next_start = 0.0
+        self._in_flight = 0
+        self._pace = 0.0  # 헤더 기반 추가 간격(초)
+        self._avg_tokens = 1000.0  # 요청당 토큰 이동평균(토큰 잔량 → 남은 요청 수 환산용)
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._refill_ts
+        if elapsed > 0:
+            self._req_tokens = min(self.rpm, self._req_tokens + elapsed * self.rpm / 60.0)
+            self._tok_tokens = min(self.tpm, self._tok_tokens + elapsed * self.tpm / 60.0)
+            self._refill_ts = now
+
+    def _wait_needed(self, now: float, tokens: float) -> float | None:
+        """지금 시작할 수 있으면 0, 시간이 지나면 가능하면 대기초, 슬롯 반납을 기다려야 하면 None."""
+        if self._in_flight >= self.max_in_flight:
+            return None
+        wait = max(self._next_start - now, 0.0)
+        if self._req_tokens < 1.0:
+            wait = max(wait, (1.0 - self._req_tokens) * 60.0 / self.rpm)
+        if self._tok_tokens < tokens:
+            wait = max(wait, (tokens - self._tok_tokens) * 60.0 / self.tpm)
+        return wait
+
+    def _take(self, now: float, tokens: float) -> None:
+        self._req_tokens -= 1.0
+        self._tok_tokens -= tokens
+        self._avg_tokens = 0.8 * self._avg_tokens + 0.2 * tokens
+        self._in_flight += 1
+        self._next_start = now + max(self.min_interval, self._pace)
+
+    def acquire(self, tokens: float, max_wait: float, cancel: Event | None = None) -> float:
+        """
+        슬롯을 확보할 때까지 대기. 실제 대기한 초를 반환, max_wait 초과 시 TimeoutError.
+        cancel이 설정되면 슬롯을 잡기 전에 _StepsCancelled (대기는 CANCEL_POLL_SECONDS 단위로 끊어 확인).
+        """
+        tokens = min(max(tokens, 1.0), self.tpm)  # 버킷 용량보다 큰 요청은 용량으로 클램프
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise _StepsCancelled()
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_needed(now, tokens)
+                if wait is not None and wait <= 0:
+                    self._take(now, tokens)
+                    return now - started
+                remaining = max_wait - (now - started)
+                if remaining <= 0:
+                    raise TimeoutError(f"rate limiter wait exceeded for {self.model}")
+                timeout = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(timeout if cancel is None else min(timeout, CANCEL_POLL_SECONDS))
+
+    async def acquire_async(self, tokens: float, max_wait: float) -> float:
+        """
+        acquire의 asyncio 버전 (ASGI 경로). 버킷/슬롯은 동기 경로와 공유하고,
+        락은 계산하는 순간만 잡으며 대기는 이벤트 루프에서 asyncio.sleep으로 한다.
+        """
+        tokens = min(max(tokens, 1.0), self.tpm)
+        started = time.monotonic()
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_needed(now, tokens)
+                if wait is not None and wait <= 0:
+                    self._take(now, tokens)
+                    return now - started
+            remaining = max_wait - (now - started)
+            if remaining <= 0:
+                raise TimeoutError(f"rate limiter wait exceeded for {self.model}")
+            # 슬롯 반납은 notify로 알 수 없으므로 짧게 다시 확인한다
+            await asyncio.sleep(min(ASYNC_SLOT_POLL_SECONDS if wait is None else wait, remaining))
+
+    def release(self, reserved_tokens: float = 0.0, used_tokens: float | None = None) -> None:
+        """슬롯 반납. 실제 사용량(used_tokens)을 알면 예약분과의 차이를 정산한다."""
+        with self._cond:
+            self._in_flight = max(self._in_flight - 1, 0)
+            if used_tokens is not None:
+                reserved = min(max(reserved_tokens, 1.0), self.tpm)
+                self._tok_tokens = min(self.tpm, self._tok_tokens + reserved - used_tokens)
+            self._cond.notify_all()
+
+    def penalize(self, seconds: float, rate_limited: bool = False) -> None:
+        """레이트 리밋/타임아웃 이후 해당 모델의 다음 시작 시각을 뒤로 민다."""
+        with self._cond:
+            self._next_start = max(self._next_start, time.monotonic() + seconds)
+            if rate_limited:
+                # 429는 곱셈 감속 (MD)
+                self._pace = min(PACE_MAX_SECONDS, max(self._pace * 2, self.min_interval, PACE_STEP_SECONDS))
+            self._cond.notify_all()
+
+    def observe_headers(self, headers) -> None:
+        """
+        응답 헤더로 버킷/간격 갱신.
+        - x-ratelimit-limit-*: 실제 계정 한도로 RPM/TPM 보정
+        - x-ratelimit-remaining-*: 로컬 버킷을 서버 잔량 이하로 맞춤
+        - 잔량 비율이 PACE_LOW_WATERMARK 미만이면 reset까지 남은 요청을 고르게 펼치도록 간격을 늘리고(MD),
+          여유가 있으면 PACE_STEP_SECONDS씩 줄인다(AI).
+        """
+        if not headers:
+            return
+        rl = _parse_ratelimit_headers(headers)
+        if not rl:
+            return
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            if rl.get("limit_requests"):
+                self.rpm = rl["limit_requests"]
+            if rl.get("limit_tokens"):
+                self.tpm = rl["limit_tokens"]
+            if "remaining_requests" in rl:
+                self._req_tokens = min(self._req_tokens, rl["remaining_requests"])
+            if "remaining_tokens" in rl:
+                self._tok_tokens = min(self._tok_tokens, rl["remaining_tokens"])
+
+            low_pace = 0.0
+            for kind, limit in (("requests", self.rpm), ("tokens", self.tpm)):
+                remaining = rl.get(f"remaining_{kind}")
+                reset = rl.get(f"reset_{kind}")
+                if remaining is None or not limit:
+                    continue
+                if remaining / limit < PACE_LOW_WATERMARK and reset:
+                    # 남은 요청 수(토큰이면 평균 요청 크기로 환산)로 reset 구간을 고르게 나눈다
+                    calls_left = remaining if kind == "requests" else remaining / max(self._avg_tokens, 1.0)
+                    low_pace = max(low_pace, reset / max(calls_left, 1.0))
+            if low_pace > 0:
+                self._pace = min(PACE_MAX_SECONDS, max(self._pace * 2, low_pace))
+            else:
+                self._pace = max(0.0, self._pace - PACE_STEP_SECONDS)
+
+            retry_after = rl.get("retry_after")
+            if retry_after:
+                self._next_start = max(self._next_start, now + retry_after)
+            self._cond.notify_all()
+
+    def pace(self) -> float:
+        with self._cond:
+            return self._pace
+
+_DURATION_PART_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+
+def _parse_reset_duration(value) -> float | None:
+    """'1s', '6m0s', '20ms', '0.5' 같은 reset 값을 초로 변환."""
+    if value is None:
+        return None
+    v = str(value).strip()
+    if not v:
+        return None
+    try:
+        return float(v)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for num, unit in _DURATION_PART_RE.findall(v):
+        matched = True
+        total += float(num) * {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}[unit]
+    return total if matched else None
+
+def _parse_ratelimit_headers(headers) -> dict:
+    """OpenAI 응답의 x-ratelimit-* / Retry-After 헤더를 dict로 정리 (없으면 빈 dict)."""
+    out: dict = {}
+    def _get(name):
+        try:
+            return headers.get(name)
+        except Exception:
+            return None
+    for kind in ("requests", "tokens"):
+        for field in ("limit", "remaining"):
+            raw = _get(f"x-ratelimit-{field}-{kind}")
+            if raw is None:
+                continue
+            try:
+                out[f"{field}_{kind}"] = float(raw)
+            except (TypeError, ValueError):
+                pass
+        reset = _parse_reset_duration(_get(f"x-ratelimit-reset-{kind}"))
+        if reset is not None:
+            out[f"reset_{kind}"] = reset
+    retry_ms = _get("retry-after-ms")
+    retry_s = _get("retry-after")
+    try:
+        if retry_ms is not None:
+            out["retry_after"] = float(retry_ms) / 1000.0
+        elif retry_s is not None:
+            out["retry_after"] = float(retry_s)
+    except (TypeError, ValueError):
+        pass
+    return out
 
-def throttled_chat_completion(**kwargs):
-    global _last_call_ts
+_limiters: dict[str, _ModelRateLimiter] = {}
+_limiters_lock = Lock()
+
+def _limiter_for(model: str) -> _ModelRateLimiter:
+    with _limiters_lock:
+        lim = _limiters.get(model)
+        if lim is None:
+            lim = _ModelRateLimiter(model, OPENAI_RPM, OPENAI_TPM, OPENAI_MAX_IN_FLIGHT, THROTTLE_SECONDS)
+            _limiters[model] = lim
+        return lim
+
+def _estimate_request_tokens(kwargs: dict) -> int:
+    """TPM 버킷 예약용 대략적 토큰 추정 (텍스트 글자수 + 이미지 detail + max_tokens)."""
+    total = int(kwargs.get("max_tokens") or 0)
+    for m in kwargs.get("messages") or []:
+        content = m.get("content") if isinstance(m, dict) else None
+        if isinstance(content, str):
+            total += len(content) // 2
+        elif isinstance(content, list):
+            for part in content:
+                if not isinstance(part, dict):
+                    continue
+                if part.get("type") == "text":
+                    total += len(part.get("text") or "") // 2
+                elif part.get("type") == "image_url":
+                    detail = (part.get("image_url") or {}).get("detail")
+                    total += 85 if detail == "low" else 765
+    return max(total, 1)
+
+_RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError)
+
+def _retry_delay(e: Exception, limiter: _ModelRateLimiter, backoff: float) -> float:
+    """재시도 가능한 오류 후 다음 시도까지 쉴 초. 응답 헤더/쿨다운을 리미터에도 반영한다."""
+    retry_secs = THROTTLE_SECONDS
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    rl = _parse_ratelimit_headers(headers) if headers else {}
+    limiter.observe_headers(headers)
+    msg = str(e) or ""
+    retry_ms_match = re.search(r"try again in\s+(\d+)\s*ms", msg, re.I)
+    if rl.get("retry_after"):
+        retry_secs = max(retry_secs, rl["retry_after"])
+    elif retry_ms_match:
+        retry_secs = max(retry_secs, float(retry_ms_match.group(1)) / 1000.0)
+    else:
+        retry_secs = max(retry_secs, backoff)
+    limiter.penalize(retry_secs, rate_limited=isinstance(e, RateLimitError))
+    return retry_secs
+
+def _record_retry(model: str, e: Exception, retry_secs: float) -> None:
+    metrics.inc("snaplog_openai_retries_total", model=model, error=type(e).__name__)
+    metrics.inc("snaplog_openai_backoff_seconds_total", retry_secs, model=model)
+
+def _throttled(kwargs: dict, attempt, can_retry=None, cancel: Event | None = None):
+    """
+    레이트 리미터 + 재시도 루프. attempt(kwargs, limiter) -> (결과, 사용 토큰|None).
+    can_retry()가 False면(예: 스트림이 이미 토큰을 내보냄) 재시도하지 않고 오류를 올린다.
+    cancel이 설정되면 슬롯 확보 전/재시도 전에 _StepsCancelled (이미 보낸 요청은 끝날 때까지 기다린다).
+    """
     backoff = THROTTLE_SECONDS
     last_error: Exception | None = None
     total_wait = 0.0
+    model = kwargs.get("model") or ""
+    limiter = _limiter_for(model)
+    est_tokens = _estimate_request_tokens(kwargs)
     while total_wait <= MAX_WAIT_SECONDS:
-        with _throttle_lock:
-            wait = THROTTLE_SECONDS - (time.monotonic() - _last_call_ts)
-        if wait > 0:
-            time.sleep(wait)
-            total_wait += wait
-
-        retry_secs = THROTTLE_SECONDS
-        with _throttle_lock:
-            try:
-                # 요청 타임아웃 명시
-                resp = client.chat.completions.create(timeout=REQUEST_TIMEOUT, **kwargs)
-                _last_call_ts = time.monotonic()
-                return resp
-            except (RateLimitError, APITimeoutError, APIConnectionError) as e:
-                last_error = e
-                msg = str(e) or ""
-                retry_ms_match = re.search(r"try again in\s+(\d+)\s*ms", msg, re.I)
-                if retry_ms_match:
-                    retry_secs = max(retry_secs, float(retry_ms_match.group(1)) / 1000.0)
-                else:
-                    retry_secs = max(retry_secs, backoff)
-                _last_call_ts = time.monotonic() + retry_secs
+        try:
+            waited = limiter.acquire(est_tokens, MAX_WAIT_SECONDS - total_wait, cancel)
+        except TimeoutError:
+            metrics.inc("snaplog_throttle_timeouts_total", model=model)
+            break
+        total_wait += waited
+        metrics.observe("snaplog_throttle_wait_seconds", waited, model=model)
 
-        time.sleep(retry_secs)
+        used_tokens = None
+        started, outcome = time.monotonic(), "error"
+        try:
+            result, used_tokens = attempt(kwargs, limiter)
+            outcome = "ok"
+            return result
+        except _RETRYABLE_ERRORS as e:
+            last_error = e
+            outcome = type(e).__name__
+            retry_secs = _retry_delay(e, limiter, backoff)
+            if can_retry is not None and not can_retry():
+                raise
+            _record_retry(model, e, retry_secs)
+        finally:
+            limiter.release(est_tokens, used_tokens)
+            metrics.observe("snaplog_openai_request_seconds", time.monotonic() - started, model=model, outcome=outcome)
+
+        if cancel is not None:
+            if cancel.wait(retry_secs):
+                raise _StepsCancelled()
+        else:
+            time.sleep(retry_secs)
         total_wait += retry_secs
         backoff = min(backoff * 2, THROTTLE_SECONDS * 16)
     if last_error is not None:
         raise last_error
     raise RuntimeError("Rate limit/timeout exhausted")
 
+def _complete_once(kwargs: dict, limiter: "_ModelRateLimiter"):
+    # 요청 타임아웃 명시, 헤더를 읽기 위해 raw response로 호출
+    raw = client.chat.completions.with_raw_response.create(timeout=REQUEST_TIMEOUT, **kwargs)
+    limiter.observe_headers(getattr(raw, "headers", None))
+    resp = raw.parse()
+    return resp, _record_usage(kwargs.get("model") or "", getattr(resp, "usage", None))
+
+def throttled_chat_completion(cancel: Event | None = None, **kwargs):
+    return _throttled(kwargs, _complete_once, cancel=cancel)
+
+def throttled_chat_completion_stream(on_delta, cancel: Event | None = None, **kwargs) -> tuple[str, str | None]:
+    """
+    stream=True 호출. 텍스트 조각마다 on_delta(조각)을 부르고 (전체 텍스트, finish_reason)을 반환.
+    리미터 슬롯은 스트림이 끝날 때까지 잡고 있으며, 첫 조각을 내보낸 뒤의 오류는 재시도하지 않는다.
+    """
+    emitted: list[str] = []
+
+    def _once(kw: dict, limiter: "_ModelRateLimiter"):
+        emitted.clear()
+        raw = client.chat.completions.with_raw_response.create(
+            timeout=REQUEST_TIMEOUT, stream=True, stream_options={"include_usage": True}, **kw)
+        limiter.observe_headers(getattr(raw, "headers", None))
+        finish, used = None, None
+        for chunk in raw.parse():
+            usage = getattr(chunk, "usage", None)
+            if usage is not None:
+                used = _record_usage(kw.get("model") or "", usage)
+            for ch in getattr(chunk, "choices", None) or []:
+                delta = getattr(getattr(ch, "delta", None), "content", None)
+                if delta:
+                    emitted.append(delta)
+                    on_delta(delta)
+                if getattr(ch, "finish_reason", None):
+                    finish = ch.finish_reason
+        return ("".join(emitted), finish), used
+
+    return _throttled(kwargs, _once, can_retry=lambda: not emitted, cancel=cancel)
+
+# ---------------- 호출 단계 (동기/비동기 공용) ----------------
+# analyze/draft/refine/moderation 본체는 OpenAI 호출 지점에서 요청을 yield하는 제너레이터로 두고,
+# 동기 경로는 _run_steps가, ASGI 경로(asgi_server.py)는 같은 제너레이터를 await로 구동한다.
+#   ("chat", kwargs)               → 응답 객체
+#   ("chat_stream", kwargs, on_delta) → (전체 텍스트, finish_reason)
+#   ("moderation", kwargs)         → 모더레이션 응답
+#   ("call", fn, args)             → fn(*args) (CPU 작업: 비동기 경로에서는 스레드로 보낸다)
+# 호출 중 예외는 제너레이터 안으로 다시 던져지므로 본체의 try/except가 그대로 동작한다.
+# 단, cancel 이벤트로 멈춘 경우(_StepsCancelled)는 본체의 폴백을 타지 않도록 제너레이터를 닫고 바로 올린다.
+
+def _moderation_once(kwargs: dict):
+    # 모더레이션은 리미터를 거치지 않으므로 호출 시간만 기록
+    started, outcome = time.monotonic(), "error"
+    try:
+        resp = client.moderations.create(**kwargs)
+        outcome = "ok"
+        return resp
+    finally:
+        metrics.observe("snaplog_openai_request_seconds", time.monotonic() - started, model=kwargs.get("model") or "", outcome=outcome)
+
+def _run_steps(steps, cancel: Event | None = None):
+    try:
+        op = next(steps)
+        while True:
+            try:
+                if cancel is not None and cancel.is_set():
+                    raise _StepsCancelled()
+                kind = op[0]
+                if kind == "chat":
+                    result = throttled_chat_completion(cancel=cancel, **op[1])
+                elif kind == "chat_stream":
+                    result = throttled_chat_completion_stream(op[2], cancel=cancel, **op[1])
+                elif kind == "moderation":
+                    result = _moderation_once(op[1])
+                else:
+                    result = op[1](*op[2])
+            except _StepsCancelled:
+                steps.close()
+                raise
+            except Exception as e:
+                op = steps.throw(e)
+                continue
+            op = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+# ---------------- Vision 분석 캐시 ----------------
+VISION_CACHE_ENABLED = int(os.getenv("SNAPLOG_VISION_CACHE", "1"))
+VISION_CACHE_DIR = os.getenv("SNAPLOG_VISION_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "vision"))
+VISION_CACHE_MEM_ITEMS = int(os.getenv("SNAPLOG_VISION_CACHE_MEM_ITEMS", "256"))
+VISION_CACHE_DISK_MB = float(os.getenv("SNAPLOG_VISION_CACHE_DISK_MB", "200"))
+VISION_CACHE_TTL_SECONDS = float(os.getenv("SNAPLOG_VISION_CACHE_TTL", str(7 * 24 * 3600)))
+
+class _VisionCache:
+    """
+    Vision 분석 결과 캐시 (메모리 LRU + 디스크).
+    - 키: 정렬된 이미지 바이트 해시 + 프롬프트 변형(single/multi) + 모델
+    - 값: 모델 출력 JSON (frames/global 등). 날짜 시퀀스/정렬 디버그는 요청마다 다시 계산한다.
+    - 디스크는 <dir>/<키 앞 2자>/<키>.json, 크기 초과 시 mtime(최근 사용) 오래된 순으로 삭제
+    """
+
+    def __init__(self, directory: str, mem_items: int, disk_bytes: int, ttl: float):
+        self.directory = directory
+        self.mem_items = max(mem_items, 0)
+        self.disk_bytes = max(disk_bytes, 0)
+        self.ttl = ttl
+        self._mem: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = Lock()
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl > 0 and (time.time() - stored_at) > self.ttl
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None:
+                stored_at, value = item
+                if not self._expired(stored_at):
+                    self._mem.move_to_end(key)
+                    self.hits_mem += 1
+                    return json.loads(json.dumps(value))  # 호출자가 수정해도 캐시가 오염되지 않게 복사
+                del self._mem[key]
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as fp:
+                rec = json.load(fp)
+            stored_at = float(rec.get("stored_at") or 0)
+            if self._expired(stored_at):
+                os.remove(path)
+            else:
+                value = rec.get("value")
+                os.utime(path, None)  # 디스크 LRU용 최근 사용 표시
+                with self._lock:
+                    self._remember(key, stored_at, value)
+                    self.hits_disk += 1
+                return json.loads(json.dumps(value))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[vision_cache] 읽기 실패 {key}: {e}")
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: dict) -> None:
+        stored_at = time.time()
+        with self._lock:
+            self._remember(key, stored_at, json.loads(json.dumps(value)))
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "w", encoding="utf-8") as fp:
+                json.dump({"stored_at": stored_at, "value": value}, fp, ensure_ascii=False)
+            os.replace(tmp, path)
+            self._evict_disk()
+        except Exception as e:
+            print(f"[vision_cache] 쓰기 실패 {key}: {e}")
+
+    def _remember(self, key: str, stored_at: float, value: dict) -> None:
+        if self.mem_items <= 0:
+            return
+        self._mem[key] = (stored_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_items:
+            self._mem.popitem(last=False)
+            self.evictions += 1
+
+    def _evict_disk(self) -> None:
+        if self.disk_bytes <= 0 or not os.path.isdir(self.directory):
+            return
+        entries = []
+        total = 0
+        for root, _dirs, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                fp = os.path.join(root, name)
+                try:
+                    st = os.stat(fp)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fp))
+                total += st.st_size
+        if total <= self.disk_bytes:
+            return
+        entries.sort()
+        for _mtime, size, fp in entries:
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(fp)
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits_mem + self.hits_disk + self.misses
+            return {
+                "hits_mem": self.hits_mem,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round((self.hits_mem + self.hits_disk) / lookups, 4) if lookups else 0.0,
+                "mem_items": len(self._mem),
+            }
+
+vision_cache = _VisionCache(VISION_CACHE_DIR, VISION_CACHE_MEM_ITEMS, int(VISION_CACHE_DISK_MB * 1024 * 1024), VISION_CACHE_TTL_SECONDS)
+
+def _vision_cache_samples() -> list:
+    st = vision_cache.stats()
+    return [
+        ("snaplog_cache_lookups_total", {"cache": "vision", "result": "hit_mem"}, st["hits_mem"]),
+        ("snaplog_cache_lookups_total", {"cache": "vision", "result": "hit_disk"}, st["hits_disk"]),
+        ("snaplog_cache_lookups_total", {"cache": "vision", "result": "miss"}, st["misses"]),
+        ("snaplog_cache_hit_ratio", {"cache": "vision"}, st["hit_ratio"]),
+        ("snaplog_vision_cache_evictions_total", {}, st["evictions"]),
+    ]
+
+metrics.describe("snaplog_cache_lookups_total", "counter", "Cache lookups by cache/result")
+metrics.describe("snaplog_cache_hit_ratio", "gauge", "Cache hit ratio since process start")
+metrics.describe("snaplog_vision_cache_evictions_total", "counter", "Vision cache disk evictions")
+metrics.collect(_vision_cache_samples)
+
+def _vision_cache_key(sorted_images: list, variant: str, model: str) -> str:
+    """정렬된 이미지 순서 그대로 바이트(base64 본문) 해시 + 변형 + 모델."""
+    h = hashlib.sha256()
+    h.update(f"{model}|{variant}|{len(sorted_images)}".encode("utf-8"))
+    for img in sorted_images:
+        h.update(b"|")
+        if isinstance(img, ImageHandle):
+            h.update(img.digest().encode("ascii"))
+            h.update((img.detail or "").encode("ascii"))
+            continue
+        payload = img if isinstance(img, str) else str(img)
+        if payload.startswith("data:") and "," in payload:
+            payload = payload.split(",", 1)[1]
+        h.update(hashlib.sha256(payload.encode("ascii", "ignore")).hexdigest().encode("ascii"))
+    return h.hexdigest()
+
 # ---------------- 금지/정리 유틸 ----------------
 
 FILE_RE = re.compile(r"\b[\w\-]+\.(jpg|jpeg|png|webp|heic)\b", re.I)
@@ -95,18 +757,131 @@ BAN_WORDS_INLINE = [
     "미상", "확인되지 않음", "unknown", "현재 시각",
 ]
 
+# ---------------- 규칙표 기반 단일 패스 치환 엔진 ----------------
+_RE_LITERAL_HEAD = re.compile(r"[^\\\[\](){}.*+?^$|]+")
+
+def _rule_guard(kind: str, pat: str, flex_space: bool) -> tuple[str, ...] | None:
+    """규칙이 맞으려면 텍스트에 반드시 있어야 하는 소문자 부분문자열 (모르면 None = 항상 검사)."""
+    if kind == "lit":
+        head = pat.split(" ")[0] if flex_space else pat
+    else:
+        m = _RE_LITERAL_HEAD.match(pat)
+        head = m.group(0) if m else ""
+        if m and m.end() < len(pat) and pat[m.end()] in "*?{":
+            head = head[:-1]  # 수량자가 붙은 마지막 글자는 없을 수도 있다
+    return (head.lower(),) if head.strip() else None
+
+class _RewriteEngine:
+    """
+    규칙 목록을 하나의 컴파일된 alternation으로 합쳐 왼쪽부터 한 번만 훑는다.
+    규칙 = (종류 "lit"|"re", 패턴, 치환, 대소문자무시[, 가드]). 같은 위치에서는 규칙표 순서가 우선.
+    - 각 가지 끝에 빈 표식 그룹(?P<rK>)을 붙여 어떤 규칙이 맞았는지 알아낸다.
+      가지가 리터럴로 시작하면 sre가 첫 글자 집합으로 위치를 건너뛰므로 빠르다.
+    - 가드(소문자 부분문자열 튜플)가 있는 규칙은 텍스트에 가드가 하나라도 있을 때만 alternation에 넣는다.
+      가드를 주지 않으면 리터럴/패턴 앞머리 리터럴에서 만든다(없으면 항상 포함). 대부분의 텍스트는
+      str 포함 검사만으로 규칙이 거의 다 빠져 짧은 alternation(또는 스캔 없음)으로 끝난다. 조합별 컴파일 결과는 캐시.
+    flex_space=True면 리터럴의 공백이 연속 공백에도 맞는다(공백 정리와 같은 패스에서 돌 때).
+    """
+
+    def __init__(self, rules: list[tuple], flex_space: bool = False):
+        self._rules: list[tuple[str, str, re.Pattern | None, tuple | None]] = []
+        for kind, pat, rep, ignore_case, *rest in rules:
+            guard = rest[0] if rest else _rule_guard(kind, pat, flex_space)
+            if kind == "lit":
+                pat = re.escape(pat)
+                if flex_space:
+                    pat = pat.replace("\\ ", r"\s+")
+            if ignore_case and pat != pat.swapcase():
+                pat = f"(?i:{pat})"
+            elif "|" in pat:
+                pat = f"(?:{pat})"
+            single = re.compile(pat) if "\\" in rep else None  # 역참조 치환은 매치 구간에 원래 패턴을 다시 적용
+            self._rules.append((pat, rep, single, guard))
+        self._always = tuple(k for k, r in enumerate(self._rules) if not r[3])
+        self._guarded = [(g, k) for k, r in enumerate(self._rules) for g in (r[3] or ())]  # 가드 문자열별로 펼침
+        self._compiled: dict[tuple, re.Pattern] = {}
+
+    def _pattern(self, active: tuple) -> re.Pattern:
+        p = self._compiled.get(active)
+        if p is None:
+            if len(active) == 1:
+                p = re.compile(self._rules[active[0]][0])
+            else:
+                p = re.compile("|".join(f"{self._rules[k][0]}(?P<r{k}>)" for k in active))
+            self._compiled[active] = p
+        return p
+
+    def _sub(self, m: re.Match) -> str:
+        _, rep, single, _ = self._rules[int(m.lastgroup[1:])]
+        return single.sub(rep, m.group(0), count=1) if single else rep
+
+    def apply(self, text: str) -> str:
+        if not text:
+            return text
+        active = self._always
+        if self._guarded:
+            low = text.lower()
+            hit = {k for g, k in self._guarded if g in low}
+            if hit:
+                active = tuple(sorted(hit.union(active)))
+        if not active:
+            return text
+        if len(active) == 1:
+            return self._pattern(active).sub(self._rules[active[0]][1], text)
+        return self._pattern(active).sub(self._sub, text)
+
+def _text_rules() -> dict[str, tuple[list, bool]]:
+    """
+    단계별 규칙표. _text_engine(*stages)가 여러 단계를 한 엔진(한 번의 스캔)으로 합친다.
+    서로의 출력에 영향을 주지 않는 단계만 합칠 수 있어 완전한 단일 스캔은 아니다:
+    - clean은 앞에서 따로: 금지어 삭제/공백 정리 뒤 인접 관계가 바뀌어야 나열·보고서형 패턴이 기존처럼 맞는다
+    - proper/food/trim은 합친다: 치환 결과(카페/빵집/반찬 몇 가지/삭제)가 서로의 패턴을 만들거나 깨지 않는다
+    - report는 trim 뒤에 따로: 금지구 삭제 결과를 보고서형 패턴이 봐야 기존 결과와 같다
+    → 초안 후처리는 5단계 대신 3번 스캔 (_postprocess_draft)
+    """
+    # 공백 정리(\s+ → " ")는 결과가 바뀌는 경우(연속 공백, 스페이스가 아닌 공백문자)만 맞춘다
+    ws_rules = [("re", r"\s{2,}|[^\S ]", " ", False)]
+    return {
+        "clean": (ws_rules
+                  + [("re", FILE_RE.pattern, "", True, (".jpg", ".jpeg", ".png", ".webp", ".heic")),
+                     ("re", DATE_RE.pattern, "", False, ("20",))]
+                  + [("lit", w, "", False) for w in BAN_WORDS_INLINE], True),
+        "proper": ([("re", pat, rep, True) for pat, rep in PROPER_NOUN_MAP.items()], False),
+        "food": ([("re", GENERIC_LIST_RE.pattern, "반찬 몇 가지", False, ("국", "찌개", "탕", "면", "밥", "반찬", "김치"))], False),
+        "trim": ([("lit", p, "", False) for p in TRIM_PHRASES], False),
+        "report": ([("re", pat, rep, False) for pat, rep in REPORT_PATTERNS]
+                   + [("re", r"(있었다\.)\s+(있었다\.)", r"\1 ", False, ("있었다.",))], False),
+    }
+
+_text_engines: dict[tuple[str, ...], _RewriteEngine] = {}
+
+def _text_engine(*stages: str) -> _RewriteEngine:
+    """stages의 규칙을 순서대로 이어 붙인 엔진 (같은 위치에서는 앞 단계 규칙이 우선)."""
+    eng = _text_engines.get(stages)
+    if eng is None:
+        table = _text_rules()
+        rules = [r for st in stages for r in table[st][0]]
+        eng = _text_engines[stages] = _RewriteEngine(rules, flex_space=any(table[st][1] for st in stages))
+    return eng
+
 def clean_inline(s: str) -> str:
     if not s:
         return ""
-    t = re.sub(r"\s+", " ", s).strip()
-    t = FILE_RE.sub("", t)
-    t = DATE_RE.sub("", t)
-    for w in BAN_WORDS_INLINE:
-        t = t.replace(w, "")
-    return t.strip()
+    return _text_engine("clean").apply(s).strip()
 
 # ----------------교체 유틸 함수 추가----------------
 
+# 교체 사전 (필요시 확장 가능)
+PROPER_NOUN_MAP = {
+    r"스타벅스": "카페",
+    r"이디야": "카페",
+    r"투썸": "카페",
+    r"던킨": "카페",
+    r"파리바게뜨": "빵집",
+    r"맥도날드": "패스트푸드점",
+    r"롯데리아": "패스트푸드점",
+}
+
 def replace_proper_nouns_if_no_visible_text(analysis: dict, draft: str) -> str:
     """
     visible_text나 명확한 증거가 없을 경우,
@@ -114,34 +889,19 @@ def replace_proper_nouns_if_no_visible_text(analysis: dict, draft: str) -> str:
     """
     if not analysis or not draft:
         return draft
-
-    frames = analysis.get("frames") or []
-    any_visible_text = any(f.get("visible_text", "").strip() for f in frames)
-    if any_visible_text:
+    if _any_visible_text(analysis):
         return draft  # 실제 글자가 보였다면 그대로 둠
 
-    # 교체 사전 (필요시 확장 가능)
-    replace_map = {
-        r"스타벅스": "카페",
-        r"이디야": "카페",
-        r"투썸": "카페",
-        r"던킨": "카페",
-        r"파리바게뜨": "빵집",
-        r"맥도날드": "패스트푸드점",
-        r"롯데리아": "패스트푸드점",
-    }
+    return _text_engine("proper").apply(draft)
 
-    text = draft
-    for pat, rep in replace_map.items():
-        text = re.sub(pat, rep, text, flags=re.I)
-
-    return text
+def _any_visible_text(analysis: dict | None) -> bool:
+    return any(f.get("visible_text", "").strip() for f in (analysis or {}).get("frames") or [])
 
 # ---- 보고서형/나열/오타/시제/시점/시점/리듬/감정 교정 ----
 GENERIC_LIST_RE = re.compile(r"(국|찌개|탕|면|밥|반찬|김치)(?:[ ,과와및]+(국|찌개|탕|면|밥|반찬|김치))+", re.U)
 def simplify_food_enumeration(text: str) -> str:
     if not text: return text
-    return GENERIC_LIST_RE.sub("반찬 몇 가지", text)
+    return _text_engine("food").apply(text)
 
 # ---------------- 카테고리 ----------------
 FOOD_RE = re.compile(r"(음식|식당|카페|요리|coffee|cafe|cake|bread|meal|lunch|dinner|brunch|dessert|커피|빵|케이크|디저트)", re.I)
@@ -150,110 +910,1257 @@ def decide_category_from_lines(lines: list[str]) -> str:
         return "food_single" if FOOD_RE.search(lines[0]) else "general_single"
     return "journey_multi"
 
-# ============ 다양한 시각 포맷 파서 ============
+# ============ 시각 문자열 해석 (모양 분류 정규식 1회 → 파서 1개) ============
+# 받아들이는 범위는 기존 strptime 목록 + datetime.fromisoformat과 같다 (넓히지 않음, tests/test_timeparse.py).
+# 모양 정규식은 후보를 넓게 잡고 _legacy_shape()가 기존 strptime 형식에 있는 조합만 통과시킨다.
+# 나머지는 기존과 마찬가지로 fromisoformat이 판단한다.
+#   epoch(10~13자리), 압축형 YYYYMMDD[_]HHMMSS
+#   YYYY-M-D [공백 H:M[:S[.f]] | 공백 H:M[:S][tz] | T H:M[:S[.f]]tz | -H-M-S]
+#   YYYY.M.D. | YYYY.M.D[.] 공백 H:M[:S] | YYYY.M.D-H-M-S
+#   YYYY/M/D 공백 H:M[:S],  EXIF YYYY:M:D 공백 H:M:S
+# (strptime처럼 형식의 공백은 연속 공백에도 맞고 'T'는 대소문자 무시)
+_DT_SHAPE = re.compile(
+    r"(?P<epoch>\d{10,13})"
+    r"|(?P<cy>\d{4})(?P<cm>\d{2})(?P<cd>\d{2})_?(?P<cH>\d{2})(?P<cM>\d{2})(?P<cS>\d{2})"
+    r"|(?P<y>\d{4})(?P<ds>[-./:])(?P<m>\d{1,2})(?P=ds)(?P<d>\d{1,2})(?P<dot>\.)?"
+    r"(?:(?P<tsep>\s+|[Tt-])?(?P<H>\d{1,2})(?P<ts>[:-])(?P<M>\d{1,2})(?:(?P=ts)(?P<S>\d{1,2})(?:\.(?P<f>\d{1,6}))?)?"
+    r"(?P<tz>Z|[+-]\d{2}:?\d{2})?)?"
+)
+
+def _legacy_shape(g: dict) -> bool:
+    """구분자형 매치가 기존 strptime 형식 목록 중 하나에 해당하는지."""
+    ds, dot, tsep = g["ds"], g["dot"], g["tsep"]
+    if g["H"] is None:                                   # 날짜만: %Y-%m-%d, %Y.%m.%d.
+        return (ds == "-" and not dot) or (ds == "." and bool(dot))
+    if tsep is None:
+        return False
+    if g["ts"] == "-":                                   # %Y-%m-%d-%H-%M-%S, %Y.%m.%d-%H-%M-%S
+        return tsep == "-" and ds in "-." and not dot and g["S"] is not None and not g["f"] and not g["tz"]
+    if tsep == "-":
+        return False
+    if tsep in "Tt":                                     # %Y-%m-%dT%H:%M[:%S[.%f]]%z
+        return ds == "-" and not dot and bool(g["tz"])
+    if ds == "-":                                        # 공백: %H:%M[:%S]%z?, %H:%M:%S.%f
+        return not dot and not (g["f"] and g["tz"])
+    if ds == ".":                                        # %Y.%m.%d[.] %H:%M[:%S]
+        return not g["f"] and not g["tz"]
+    if ds == "/":
+        return not dot and not g["f"] and not g["tz"]
+    return not dot and g["S"] is not None and not g["f"] and not g["tz"]  # EXIF %Y:%m:%d %H:%M:%S
+
+# 파일명: 기존 4개 패턴을 같은 순서로 search (기존의 ".*?" 접두 match와 같은 결과, 접두 백트래킹 없음).
+# 기존처럼 앞 패턴이 어느 위치에서든 맞으면 그 결과를 쓰고, 날짜가 틀릴 때만 다음 패턴을 본다.
+_FILENAME_DT_PATTERNS = tuple(re.compile(p) for p in (
+    r"(\d{4})(\d{2})(\d{2})[_\- ](\d{2})(\d{2})(\d{2})",
+    r"(\d{4})[-_.](\d{2})[-_.](\d{2})[-_ ](\d{2})[-_.:](\d{2})(?:[-_.:](\d{2}))?",
+    r"(\d{4})[.](\d{2})[.](\d{2})[ _](\d{2})[.](\d{2})(?:[.](\d{2}))?",
+    r"(\d{4})(\d{2})(\d{2})[_-](\d{2})(\d{2})(\d{2})",
+))
+
+_DT_MEMO_SIZE = int(os.getenv("SNAPLOG_DT_MEMO_SIZE", "4096"))
+
+def _epoch_dt(ts: float) -> datetime | None:
+    try:
+        if ts > 10_000_000_000:  # ms
+            ts /= 1000.0
+        return datetime.fromtimestamp(ts)
+    except Exception:
+        return None
+
+@lru_cache(maxsize=_DT_MEMO_SIZE)
+def _parse_dt_str(xs: str) -> datetime | None:
+    m = _DT_SHAPE.fullmatch(xs)
+    g = m.groupdict() if m is not None else None
+    try:
+        if g is None or (g["y"] and not _legacy_shape(g)):
+            return datetime.fromisoformat(xs[:-1] + "+00:00" if xs.endswith("Z") else xs)
+        if g["epoch"]:
+            return _epoch_dt(int(xs))
+        if g["cy"]:
+            return datetime(int(g["cy"]), int(g["cm"]), int(g["cd"]), int(g["cH"]), int(g["cM"]), int(g["cS"]))
+        if g["H"] is None:
+            return datetime(int(g["y"]), int(g["m"]), int(g["d"]))
+        tzinfo = None
+        tz = g["tz"]
+        if tz:
+            if tz == "Z":
+                tzinfo = timezone.utc
+            else:
+                sign = -1 if tz[0] == "-" else 1
+                hh, mm = int(tz[1:3]), int(tz[-2:])
+                tzinfo = timezone(sign * timedelta(hours=hh, minutes=mm))
+        frac = g["f"]
+        return datetime(int(g["y"]), int(g["m"]), int(g["d"]), int(g["H"]), int(g["M"]), int(g["S"] or 0),
+                        int(frac.ljust(6, "0")) if frac else 0, tzinfo)
+    except (ValueError, OverflowError):
+        return None
+
 def _parse_any_dt(x: str | int | float) -> datetime | None:
+    """숫자(epoch 초/밀리초) 또는 시각 문자열 → datetime. 문자열 결과는 LRU로 메모이즈."""
     if x is None:
         return None
-    # epoch-like
     if isinstance(x, (int, float)):
-        try:
-            ts = float(x)
-            if ts > 10_000_000_000:  # ms
-                ts /= 1000.0
-            return datetime.fromtimestamp(ts)
-        except Exception:
-            pass
+        return _epoch_dt(float(x))
     xs = str(x).strip()
-    if re.fullmatch(r"\d{10,13}", xs):
-        try:
-            ts = int(xs)
-            if len(xs) >= 13:
-                ts = ts / 1000.0
-            return datetime.fromtimestamp(ts)
-        except Exception:
-            pass
-    if xs.endswith("Z"):
-        xs = xs[:-1] + "+00:00"
-    fmts = (
-        "%Y-%m-%d %H:%M:%S%z",
-        "%Y-%m-%d %H:%M%z",
-        "%Y-%m-%dT%H:%M:%S.%f%z",
-        "%Y-%m-%dT%H:%M:%S%z",
-        "%Y-%m-%dT%H:%M%z",
-        "%Y-%m-%d %H:%M:%S",
-        "%Y-%m-%d %H:%M",
-        "%Y-%m-%d",
-        "%Y.%m.%d %H:%M:%S",
-        "%Y.%m.%d %H:%M",
-        "%Y.%m.%d.",
-        "%Y.%m.%d. %H:%M:%S",
-        "%Y.%m.%d. %H:%M",
-        "%Y/%m/%d %H:%M:%S",
-        "%Y/%m/%d %H:%M",
-        "%Y-%m-%d-%H-%M-%S",
-        "%Y.%m.%d-%H-%M-%S",
-        "%Y:%m:%d %H:%M:%S",
-        "%Y%m%d_%H%M%S",
-        "%Y%m%d%H%M%S",
-        "%Y-%m-%d %H:%M:%S.%f",
-    )
-    for fmt in fmts:
-        try:
-            return datetime.strptime(xs, fmt)
-        except Exception:
-            pass
-    try:
-        return datetime.fromisoformat(xs)
-    except Exception:
-        return None
+    return _parse_dt_str(xs) if xs else None
 
-# ============ 파일명에서 날짜/시간 추출 ============
-_FILENAME_DT_PATTERNS = [
-    re.compile(r".*?(?P<y>\d{4})(?P<m>\d{2})(?P<d>\d{2})[_\- ](?P<H>\d{2})(?P<M>\d{2})(?P<S>\d{2}).*", re.I),
-    re.compile(r".*?(?P<y>\d{4})[-_.](?P<m>\d{2})[-_.](?P<d>\d{2})[-_ ](?P<H>\d{2})[-_.:](?P<M>\d{2})(?:[-_.:](?P<S>\d{2}))?.*", re.I),
-    re.compile(r".*?(?P<y>\d{4})[.](?P<m>\d{2})[.](?P<d>\d{2})[ _](?P<H>\d{2})[.](?P<M>\d{2})(?:[.](?P<S>\d{2}))?.*", re.I),
-    re.compile(r".*?(?P<y>\d{4})(?P<m>\d{2})(?P<d>\d{2})[_-](?P<H>\d{2})(?P<M>\d{2})(?P<S>\d{2}).*", re.I),
-]
+def _parse_many_dt(values) -> list[datetime | None]:
+    """여러 값을 한 번에 해석. 같은 문자열은 한 번만 파싱한다."""
+    seen: dict = {}
+    out = []
+    for v in values:
+        key = (type(v), v) if isinstance(v, (int, float, str)) else None
+        if key is None:
+            out.append(_parse_any_dt(v))
+            continue
+        if key not in seen:
+            seen[key] = _parse_any_dt(v)
+        out.append(seen[key])
+    return out
 
-def _dt_from_filename(name: str) -> datetime | None:
-    if not name:
-        return None
-    base = os.path.basename(name)
+@lru_cache(maxsize=_DT_MEMO_SIZE)
+def _dt_from_basename(base: str) -> datetime | None:
     for pat in _FILENAME_DT_PATTERNS:
-        m = pat.match(base)
+        m = pat.search(base)
         if m:
+            y, mth, d, H, M, S = m.groups()
             try:
-                y = int(m.group("y")); mth = int(m.group("m")); d = int(m.group("d"))
-                H = int(m.group("H")); M = int(m.group("M")); S = int(m.group("S") or 0)
-                return datetime(y, mth, d, H, M, S)
-            except Exception:
+                return datetime(int(y), int(mth), int(d), int(H), int(M), int(S or 0))
+            except ValueError:
                 continue
     return None
 
+def _dt_from_filename(name: str) -> datetime | None:
+    if not name:
+        return None
+    return _dt_from_basename(os.path.basename(name))
+
+def _dt_memo_samples() -> list:
+    out = []
+    for cache, fn in (("dt_parse", _parse_dt_str), ("dt_filename", _dt_from_basename)):
+        info = fn.cache_info()
+        lookups = info.hits + info.misses
+        out += [
+            ("snaplog_cache_lookups_total", {"cache": cache, "result": "hit"}, info.hits),
+            ("snaplog_cache_lookups_total", {"cache": cache, "result": "miss"}, info.misses),
+            ("snaplog_cache_hit_ratio", {"cache": cache}, round(info.hits / lookups, 4) if lookups else 0.0),
+        ]
+    return out
+
+metrics.collect(_dt_memo_samples)
+
 # ============ EXIF 메타데이터 추출 (bytes 기준) ============
 def _read_exif_datetime_from_bytes(raw: bytes) -> datetime | None:
-    """이미지 바이트에서 EXIF datetime 추출 → datetime 객체 반환"""
+    """이미지 바이트에서 EXIF datetime 추출 → datetime 객체 반환 (헤더만 읽는 경량 파서 사용)"""
+    return read_image_meta(raw).get("datetime")
+
+# ============ 헤더 전용 메타데이터 리더 (JPEG/PNG/WebP/HEIC) ============
+# 픽셀 데이터는 건드리지 않고 APP1(EXIF/XMP), PNG eXIf/tEXt/iTXt, WebP EXIF/XMP 청크,
+# HEIC meta 박스가 가리키는 Exif 아이템만 읽는다. read(offset, length) 콜러블 기반이라
+# data URL은 필요한 구간만 base64 디코드한다.
+META_HEAD_BYTES = 64 * 1024
+META_CACHE_ITEMS = int(os.getenv("SNAPLOG_META_CACHE_ITEMS", "1024"))
+
+_XMP_DT_RE = re.compile(
+    rb"(?:exif:DateTimeOriginal|photoshop:DateCreated|xmp:CreateDate)\s*(?:=\s*[\"']|>)\s*([0-9][0-9:\-T .+Z]{9,32})"
+)
+
+def _tiff_meta(buf: bytes) -> dict:
+    """TIFF(EXIF) 블록에서 DateTimeOriginal/DateTime, GPS, Orientation만 추출."""
+    out: dict = {}
+    if len(buf) < 8:
+        return out
+    if buf[:2] == b"II":
+        end = "<"
+    elif buf[:2] == b"MM":
+        end = ">"
+    else:
+        return out
+    u16 = lambda o: struct.unpack_from(end + "H", buf, o)[0]
+    u32 = lambda o: struct.unpack_from(end + "I", buf, o)[0]
+    type_size = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+    def _ifd(off: int) -> dict:
+        tags = {}
+        if off <= 0 or off + 2 > len(buf):
+            return tags
+        n = u16(off)
+        for i in range(min(n, 512)):
+            e = off + 2 + i * 12
+            if e + 12 > len(buf):
+                break
+            tag, typ, cnt = u16(e), u16(e + 2), u32(e + 4)
+            size = type_size.get(typ, 1) * cnt
+            voff = e + 8 if size <= 4 else u32(e + 8)
+            if voff + size > len(buf):
+                continue
+            if typ == 2:
+                tags[tag] = buf[voff:voff + size].split(b"\x00", 1)[0].decode("ascii", "ignore")
+            elif typ == 3:
+                tags[tag] = u16(voff)
+            elif typ == 4:
+                tags[tag] = u32(voff)
+            elif typ == 5:
+                tags[tag] = [
+                    (u32(voff + k * 8) / u32(voff + k * 8 + 4)) if u32(voff + k * 8 + 4) else 0.0
+                    for k in range(cnt)
+                ]
+        return tags
+
+    ifd0 = _ifd(u32(4))
+    if 0x0112 in ifd0:
+        out["orientation"] = ifd0[0x0112]
+    exif_ifd = _ifd(ifd0[0x8769]) if 0x8769 in ifd0 else {}
+    dt_raw = exif_ifd.get(0x9003) or exif_ifd.get(0x9004) or ifd0.get(0x0132)
+    if dt_raw:
+        dt = _parse_any_dt(dt_raw)
+        if dt:
+            out["datetime"] = dt
+    if 0x8825 in ifd0:
+        gps = _ifd(ifd0[0x8825])
+        lat, lon = gps.get(2), gps.get(4)
+        if isinstance(lat, list) and isinstance(lon, list) and len(lat) == 3 and len(lon) == 3:
+            la = lat[0] + lat[1] / 60.0 + lat[2] / 3600.0
+            lo = lon[0] + lon[1] / 60.0 + lon[2] / 3600.0
+            if str(gps.get(1, "N")).upper().startswith("S"):
+                la = -la
+            if str(gps.get(3, "E")).upper().startswith("W"):
+                lo = -lo
+            if la or lo:
+                out["gps"] = (round(la, 7), round(lo, 7))
+    return out
+
+def _merge_meta(out: dict, found: dict, source: str) -> None:
+    for k, v in found.items():
+        if v is not None and k not in out:
+            out[k] = v
+            if k == "datetime":
+                out["source"] = source
+
+def _xmp_meta(buf: bytes) -> dict:
+    m = _XMP_DT_RE.search(buf)
+    if m:
+        dt = _parse_any_dt(m.group(1).decode("ascii", "ignore").strip())
+        if dt:
+            return {"datetime": dt}
+    return {}
+
+def _meta_jpeg(read) -> dict:
+    out: dict = {}
+    pos = 2
+    for _ in range(64):
+        hdr = read(pos, 4)
+        if len(hdr) < 4 or hdr[0] != 0xFF:
+            break
+        marker = hdr[1]
+        if marker in (0xD9, 0xDA):  # EOI / SOS → 이후는 픽셀 데이터
+            break
+        seg_len = (hdr[2] << 8) | hdr[3]
+        if marker == 0xE1:
+            seg = read(pos + 4, seg_len - 2)
+            if seg.startswith(b"Exif\x00\x00"):
+                _merge_meta(out, _tiff_meta(seg[6:]), "exif")
+            elif seg.startswith(b"http://ns.adobe.com/xap/1.0/"):
+                _merge_meta(out, _xmp_meta(seg), "xmp")
+        pos += 2 + seg_len
+    return out
+
+def _meta_png(read) -> dict:
+    out: dict = {}
+    pos = 8
+    for _ in range(256):
+        hdr = read(pos, 8)
+        if len(hdr) < 8:
+            break
+        length = int.from_bytes(hdr[:4], "big")
+        ctype = hdr[4:8]
+        if ctype in (b"IDAT", b"IEND"):
+            break
+        if ctype == b"eXIf":
+            _merge_meta(out, _tiff_meta(read(pos + 8, length)), "exif")
+        elif ctype in (b"tEXt", b"iTXt"):
+            body = read(pos + 8, length)
+            key, _, val = body.partition(b"\x00")
+            if key == b"XML:com.adobe.xmp":
+                _merge_meta(out, _xmp_meta(val), "xmp")
+            elif key in (b"Creation Time", b"date:create", b"date:modify"):
+                text = val.lstrip(b"\x00").decode("utf-8", "ignore")
+                if ctype == b"iTXt":
+                    text = text.split("\x00")[-1]
+                dt = _parse_any_dt(text.strip())
+                if dt:
+                    _merge_meta(out, {"datetime": dt}, "png_text")
+        pos += 12 + length
+    return out
+
+def _meta_webp(read, total: int) -> dict:
+    out: dict = {}
+    pos = 12
+    while pos + 8 <= total:
+        hdr = read(pos, 8)
+        if len(hdr) < 8:
+            break
+        ctype = hdr[:4]
+        length = int.from_bytes(hdr[4:8], "little")
+        if ctype == b"EXIF":
+            body = read(pos + 8, length)
+            if body.startswith(b"Exif\x00\x00"):
+                body = body[6:]
+            _merge_meta(out, _tiff_meta(body), "exif")
+        elif ctype == b"XMP ":
+            _merge_meta(out, _xmp_meta(read(pos + 8, length)), "xmp")
+        pos += 8 + length + (length & 1)
+    return out
+
+def _meta_heic(read, total: int) -> dict:
+    """ISO-BMFF: meta 박스의 iinf에서 Exif 아이템 id, iloc에서 위치를 찾아 그 구간만 읽는다."""
+    def _boxes(start: int, end: int):
+        pos = start
+        while pos + 8 <= end:
+            hdr = read(pos, 16)
+            if len(hdr) < 8:
+                return
+            size = int.from_bytes(hdr[:4], "big")
+            btype = hdr[4:8]
+            hlen = 8
+            if size == 1:
+                size = int.from_bytes(hdr[8:16], "big"); hlen = 16
+            elif size == 0:
+                size = end - pos
+            if size < hlen:
+                return
+            yield btype, pos + hlen, pos + size
+            pos += size
+
+    meta = next(((b, e) for t, b, e in _boxes(0, min(total, 1 << 20)) if t == b"meta"), None)
+    if not meta:
+        return {}
+    mb, me = meta[0] + 4, meta[1]  # FullBox(version/flags) 건너뜀
+    body = read(mb, me - mb)
+    local = lambda off, n: body[off - mb: off - mb + n]
+    exif_id = None
+    locs: dict[int, tuple[int, int]] = {}
+    for t, b, e in ((t, b, e) for t, b, e in _iter_local_boxes(body, mb)):
+        if t == b"iinf":
+            ver = body[b - mb]
+            pos = b + 4
+            cnt_len = 2 if ver == 0 else 4
+            pos += cnt_len
+            for et, eb, ee in _iter_local_boxes(body[pos - mb:e - mb], pos):
+                if et != b"infe":
+                    continue
+                ever = local(eb, 1)[0]
+                if ever >= 2:
+                    id_len = 2 if ever == 2 else 4
+                    item_id = int.from_bytes(local(eb + 4, id_len), "big")
+                    item_type = local(eb + 4 + id_len + 2, 4)
+                    if item_type == b"Exif":
+                        exif_id = item_id
+        elif t == b"iloc":
+            ver = body[b - mb]
+            p0 = b + 4
+            sz = local(p0, 2)
+            off_size, len_size, base_size = sz[0] >> 4, sz[0] & 0xF, sz[1] >> 4
+            idx_size = (sz[1] & 0xF) if ver in (1, 2) else 0
+            p0 += 2
+            n_len = 2 if ver < 2 else 4
+            count = int.from_bytes(local(p0, n_len), "big"); p0 += n_len
+            rd = lambda o, n: int.from_bytes(local(o, n), "big") if n else 0
+            for _ in range(count):
+                item_id = rd(p0, n_len); p0 += n_len
+                if ver in (1, 2):
+                    p0 += 2  # construction_method
+                p0 += 2  # data_reference_index
+                base = rd(p0, base_size); p0 += base_size
+                ext_count = rd(p0, 2); p0 += 2
+                for k in range(ext_count):
+                    p0 += idx_size
+                    eoff = rd(p0, off_size); p0 += off_size
+                    elen = rd(p0, len_size); p0 += len_size
+                    if k == 0:
+                        locs[item_id] = (base + eoff, elen)
+    if exif_id is None or exif_id not in locs:
+        return {}
+    off, length = locs[exif_id]
+    blob = read(off, min(length, 256 * 1024))
+    if len(blob) < 4:
+        return {}
+    tiff_off = 4 + int.from_bytes(blob[:4], "big")  # Exif 아이템은 TIFF 헤더 오프셋으로 시작
+    out: dict = {}
+    _merge_meta(out, _tiff_meta(blob[tiff_off:]), "exif")
+    return out
+
+def _iter_local_boxes(buf: bytes, base: int):
+    """이미 읽어둔 버퍼 안의 ISO-BMFF 박스 순회 (절대 오프셋 base 기준)."""
+    pos = 0
+    while pos + 8 <= len(buf):
+        size = int.from_bytes(buf[pos:pos + 4], "big")
+        btype = buf[pos + 4:pos + 8]
+        hlen = 8
+        if size == 1 and pos + 16 <= len(buf):
+            size = int.from_bytes(buf[pos + 8:pos + 16], "big"); hlen = 16
+        elif size == 0:
+            size = len(buf) - pos
+        if size < hlen:
+            return
+        yield btype, base + pos + hlen, base + pos + size
+        pos += size
+
+def _read_meta_with(read, total: int) -> dict:
+    head = read(0, 16)
     try:
+        if head[:2] == b"\xff\xd8":
+            return _meta_jpeg(read)
+        if head[:8] == b"\x89PNG\r\n\x1a\n":
+            return _meta_png(read)
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return _meta_webp(read, total)
+        if head[4:8] == b"ftyp":
+            return _meta_heic(read, total)
+    except Exception as e:
+        print(f"메타데이터 헤더 파싱 실패: {e}")
+    return {}
+
+_meta_cache: OrderedDict[str, dict] = OrderedDict()
+_meta_cache_lock = Lock()
+
+def _meta_cache_lookup(key: str, compute) -> dict:
+    with _meta_cache_lock:
+        hit = _meta_cache.get(key)
+        if hit is not None:
+            _meta_cache.move_to_end(key)
+            return dict(hit)
+    meta = compute()
+    with _meta_cache_lock:
+        _meta_cache[key] = meta
+        while len(_meta_cache) > META_CACHE_ITEMS:
+            _meta_cache.popitem(last=False)
+    return dict(meta)
+
+def read_image_meta(raw: bytes, digest: str | None = None) -> dict:
+    """
+    이미지 바이트 → {"datetime", "gps": (lat, lon), "orientation", "source"} (있는 것만).
+    digest(전체 바이트의 sha256)를 주면 그 값으로 캐시한다. 없으면 캐시하지 않고 헤더만 파싱한다:
+    헤더 파싱이 전체 해시보다 싸고, 앞부분과 길이만 같은 다른 파일이 결과를 나눠 쓰면 안 되기 때문.
+    """
+    if not raw:
+        return {}
+    view = memoryview(raw)
+    compute = lambda: _read_meta_with(lambda o, n: bytes(view[o:o + n]), len(raw))
+    return compute() if digest is None else _meta_cache_lookup("sha256:" + digest, compute)
+
+def read_image_meta_from_data_url(data_url: str, digest: str | None = None) -> dict:
+    """
+    data URL/base64 문자열에서 필요한 바이트 구간만 디코드해 메타데이터를 읽는다.
+    digest는 base64 본문의 sha256(ImageHandle.digest)이며, 주어질 때만 캐시한다.
+    """
+    if not data_url:
+        return {}
+    b64 = data_url.split(",", 1)[1] if data_url.startswith("data:") and "," in data_url else data_url
+    total = len(b64) * 3 // 4
+
+    def _read(offset: int, length: int) -> bytes:
+        if length <= 0 or offset >= total:
+            return b""
+        c0 = (offset // 3) * 4
+        c1 = min(((offset + length + 2) // 3) * 4, len(b64))
+        try:
+            chunk = base64.b64decode(b64[c0:c1])
+        except Exception:
+            return b""
+        skip = offset - (c0 // 4) * 3
+        return chunk[skip:skip + length]
+
+    compute = lambda: _read_meta_with(_read, total)
+    return compute() if digest is None else _meta_cache_lookup("b64sha256:" + digest, compute)
+
+# ============ 원본 업로드 저장소 (content-addressed) ============
+UPLOAD_STORE_MAX_BYTES = int(float(os.getenv("SNAPLOG_UPLOAD_MAX_MB", "2048")) * 1024 * 1024)  # 0이면 무제한
+UPLOAD_STORE_MAX_AGE_SECONDS = float(os.getenv("SNAPLOG_UPLOAD_MAX_AGE_DAYS", "30")) * 86400     # 0이면 무제한
+UPLOAD_STORE_MIN_KEEP_SECONDS = float(os.getenv("SNAPLOG_UPLOAD_MIN_KEEP_SECONDS", "3600"))      # 최근 사용분은 보호
+UPLOAD_STORE_COMPACT_INTERVAL = float(os.getenv("SNAPLOG_UPLOAD_COMPACT_INTERVAL", "600"))       # 0이면 컴팩터 끔
+
+class _UploadStore:
+    """
+    UPLOAD_DIR을 sha256 기반 저장소로 사용.
+    - 경로: <UPLOAD_DIR>/<aa>/<bb>/<sha256><ext>, 같은 이미지는 한 번만 저장
+    - index.sqlite3: blobs(해시별 크기/최근 사용), refs(요청 ↔ blob 연결, 원래 파일명)
+    - compact(): 최대 나이 초과분 삭제 후, 총 용량 초과 시 최근 사용이 오래된 순(LRU)으로 삭제
+      단, UPLOAD_STORE_MIN_KEEP_SECONDS 안에 쓰인 blob은 응답의 saved_files가 유효하도록 남긴다
+    - _lock은 sqlite 행 갱신과 blob 이름 바꾸기만 감싼다. 파일 쓰기(tmp → os.replace)와 삭제는 락 밖에서
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.db_path = os.path.join(root, "index.sqlite3")
+        self._lock = Lock()
+        with closing(self._connect()) as db, db:
+            db.execute("CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS refs (request_id TEXT NOT NULL, sha256 TEXT NOT NULL, filename TEXT, created_at REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS refs_sha ON refs(sha256)")
+            db.execute("CREATE INDEX IF NOT EXISTS blobs_lru ON blobs(last_used_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def blob_path(self, sha256: str, ext: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256 + (ext or "").lower())
+
+    @staticmethod
+    def _write(spool: "_UploadSpool", path: str) -> None:
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        spool.save_to(tmp)
+        os.replace(tmp, path)  # 같은 해시를 동시에 써도 내용이 같으므로 원자적 교체로 충분
+
+    def put(self, spool: "_UploadSpool", ext: str, request_id: str, filename: str) -> str:
+        """스풀된 업로드를 저장(이미 있으면 재사용)하고 요청 참조를 기록. 저장 경로 반환."""
+        sha = spool.sha256
+        with self._lock, closing(self._connect()) as db, db:
+            row = db.execute("SELECT path FROM blobs WHERE sha256 = ?", (sha,)).fetchone()
+            if row and os.path.exists(row[0]):
+                now = time.time()
+                db.execute("UPDATE blobs SET last_used_at = ? WHERE sha256 = ?", (now, sha))
+                db.execute("INSERT INTO refs (request_id, sha256, filename, created_at) VALUES (?, ?, ?, ?)",
+                           (request_id, sha, filename, now))
+                return row[0]
+
+        path = self.blob_path(sha, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            self._write(spool, path)
+        with self._lock, closing(self._connect()) as db, db:
+            if not os.path.exists(path):  # 쓰는 사이 compact()가 치운 경우 (드묾)
+                self._write(spool, path)
+            now = time.time()
+            db.execute("INSERT OR REPLACE INTO blobs (sha256, path, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                       (sha, path, spool.size, now, now))
+            db.execute("INSERT INTO refs (request_id, sha256, filename, created_at) VALUES (?, ?, ?, ?)",
+                       (request_id, sha, filename, now))
+        return path
+
+    def refcount(self, sha256: str) -> int:
+        with closing(self._connect()) as db:
+            return db.execute("SELECT COUNT(*) FROM refs WHERE sha256 = ?", (sha256,)).fetchone()[0]
+
+    def _delete(self, db, sha256: str, path: str, trash: list[str]) -> None:
+        # 락 안에서는 이름만 바꾼다 (put()이 락 안에서 본 blob은 그대로 유지됨). 실제 삭제는 compact()가 락 밖에서
+        doomed = f"{path}.{uuid.uuid4().hex}.del"
+        try:
+            os.rename(path, doomed)
+            trash.append(doomed)
+        except FileNotFoundError:
+            pass
+        db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        db.execute("DELETE FROM refs WHERE sha256 = ?", (sha256,))
+
+    def compact(self) -> dict:
+        now = time.time()
+        protect_after = now - UPLOAD_STORE_MIN_KEEP_SECONDS
+        removed = {"aged": 0, "lru": 0, "bytes": 0}
+        trash: list[str] = []
+        with self._lock, closing(self._connect()) as db, db:
+            if UPLOAD_STORE_MAX_AGE_SECONDS > 0:
+                cutoff = min(now - UPLOAD_STORE_MAX_AGE_SECONDS, protect_after)
+                for sha, path, size in db.execute("SELECT sha256, path, size FROM blobs WHERE last_used_at < ?", (cutoff,)).fetchall():
+                    self._delete(db, sha, path, trash)
+                    removed["aged"] += 1
+                    removed["bytes"] += size
+            if UPLOAD_STORE_MAX_BYTES > 0:
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+                if total > UPLOAD_STORE_MAX_BYTES:
+                    rows = db.execute(
+                        "SELECT b.sha256, b.path, b.size FROM blobs b WHERE b.last_used_at < ? "
+                        "ORDER BY b.last_used_at ASC, (SELECT COUNT(*) FROM refs r WHERE r.sha256 = b.sha256) ASC",
+                        (protect_after,),
+                    ).fetchall()
+                    for sha, path, size in rows:
+                        if total <= UPLOAD_STORE_MAX_BYTES:
+                            break
+                        self._delete(db, sha, path, trash)
+                        total -= size
+                        removed["lru"] += 1
+                        removed["bytes"] += size
+        for doomed in trash:
+            try:
+                os.remove(doomed)
+            except OSError as e:
+                print(f"[upload_store] 삭제 실패 {doomed}: {e}")
+        return removed
+
+    def stats(self) -> dict:
+        with closing(self._connect()) as db:
+            blobs, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            refs = db.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+        return {"blobs": blobs, "bytes": size, "refs": refs}
+
+upload_store = _UploadStore(UPLOAD_DIR)
+
+def _upload_compactor_loop() -> None:
+    while True:
+        time.sleep(UPLOAD_STORE_COMPACT_INTERVAL)
+        try:
+            removed = upload_store.compact()
+            if removed["aged"] or removed["lru"]:
+                print(f"[upload_store] compact: {removed}")
+        except Exception as e:
+            print(f"[upload_store] compact 실패: {e}")
+
+if UPLOAD_STORE_COMPACT_INTERVAL > 0:
+    Thread(target=_upload_compactor_loop, name="snaplog-upload-compactor", daemon=True).start()
+
+# ============ 이미지 핸들 ============
+class ImageHandle:
+    """
+    요청 파이프라인 전체에서 쓰는 이미지 하나의 단일 표현.
+    - raw(바이트) 또는 b64(클라이언트가 보낸 base64/data URL 문자열) 중 하나를 원본으로 보관
+    - data URL/바이트/메타데이터/해시는 필요할 때 계산 (data URL은 캐시하지 않음 → 요청 동안 사본이 남지 않음)
+    - images_with_time / sorted_images / analysis["sorted_images"]에는 이 객체의 참조만 들어간다
+    """
+
+    __slots__ = ("_raw", "_b64", "mime", "filename", "saved_path", "_meta", "_digest", "detail", "_pinned")
+
+    def __init__(self, raw: bytes | None = None, b64: str | None = None, mime: str | None = None,
+                 filename: str = "", saved_path: str = "", meta: dict | None = None, detail: str | None = None):
+        self.detail = detail  # Vision detail(low/high). None이면 analyze_images 기본 규칙
+        self._raw = raw
+        self._b64 = b64
+        self.mime = mime or "image/jpeg"
+        self.filename = filename
+        self.saved_path = saved_path
+        self._meta = meta
+        self._digest: str | None = None
+        self._pinned: bytes | None = None
+
+    @classmethod
+    def from_b64(cls, value: str, **kw) -> "ImageHandle":
+        """data URL 또는 순수 base64 문자열 (기존 규칙대로 순수 base64는 JPEG로 간주)."""
+        mime = None
+        if value.startswith("data:") and ";" in value[:64]:
+            mime = value[5:value.index(";")]
+        return cls(b64=value, mime=mime, **kw)
+
+    def _b64_payload_start(self) -> int:
+        b = self._b64 or ""
+        return b.index(",") + 1 if b.startswith("data:") and "," in b[:128] else 0
+
+    @property
+    def data_url(self) -> str:
+        if self._b64 is not None:
+            if self._b64_payload_start():
+                return self._b64  # 이미 data URL이면 그대로 (복사 없음)
+            return f"data:{self.mime};base64,{self._b64}"
+        return f"data:{self.mime};base64,{base64.b64encode(self._raw or b'').decode('ascii')}"
+
+    @property
+    def raw(self) -> bytes:
+        if self._raw is not None:
+            return self._raw
+        if self._pinned is not None:
+            return self._pinned
+        return base64.b64decode(self._b64[self._b64_payload_start():]) if self._b64 else b""
+
+    def pin_raw(self) -> bytes:
+        """
+        b64 원본을 한 번만 디코드해 unpin_raw()까지 보관한다 (Stage1 선택과 detail 선택이 같은 바이트를 읽음).
+        digest/meta/nbytes는 원본 표현 기준 그대로라 고정 여부와 무관하다.
+        """
+        if self._raw is None and self._pinned is None:
+            self._pinned = self.raw
+        return self.raw
+
+    def unpin_raw(self) -> None:
+        self._pinned = None
+
+    @property
+    def meta(self) -> dict:
+        if self._meta is None:
+            if self._raw is not None:
+                self._meta = read_image_meta(self._raw, self.digest())
+            else:
+                self._meta = read_image_meta_from_data_url(self._b64 or "", self.digest())
+        return self._meta
+
+    def digest(self) -> str:
+        """원본 표현 기준 sha256 (b64 원본은 1MB 단위로 해시해 전체 사본을 만들지 않음)."""
+        if self._digest is None:
+            h = hashlib.sha256()
+            if self._raw is not None:
+                h.update(self._raw)
+            elif self._b64:
+                start, step = self._b64_payload_start(), 1 << 20
+                for i in range(start, len(self._b64), step):
+                    h.update(self._b64[i:i + step].encode("ascii", "ignore"))
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def nbytes(self) -> int:
+        return len(self._raw) if self._raw is not None else len(self._b64 or "") * 3 // 4
+
+    def __repr__(self) -> str:
+        return f"ImageHandle({self.filename or '-'}, {self.mime}, {self.nbytes()}B)"
+
+# ============ Vision 전송용 이미지 축소/재압축 ============
+VISION_DOWNSCALE = int(os.getenv("SNAPLOG_VISION_DOWNSCALE", "1"))
+VISION_LOW_MAX_SIDE = int(os.getenv("SNAPLOG_VISION_LOW_MAX_SIDE", "512"))     # detail=low: 512x512 안에 맞춤
+VISION_HIGH_MAX_SIDE = int(os.getenv("SNAPLOG_VISION_HIGH_MAX_SIDE", "2048"))  # detail=high: 2048 안에 맞춘 뒤
+VISION_HIGH_MIN_SIDE = int(os.getenv("SNAPLOG_VISION_HIGH_MIN_SIDE", "768"))   #   짧은 변 768로 축소(OpenAI 규칙)
+VISION_JPEG_QUALITY = int(os.getenv("SNAPLOG_VISION_JPEG_QUALITY", "85"))
+
+def _vision_target_scale(w: int, h: int, detail: str) -> float:
+    long_side, short_side = max(w, h), min(w, h)
+    if long_side <= 0 or short_side <= 0:
+        return 1.0
+    if detail == "low":
+        return min(VISION_LOW_MAX_SIDE / long_side, 1.0)
+    return min(VISION_HIGH_MAX_SIDE / long_side, VISION_HIGH_MIN_SIDE / short_side, 1.0)
+
+def _read_all(src) -> bytes:
+    if isinstance(src, (bytes, bytearray)):
+        return bytes(src)
+    src.seek(0)
+    return src.read()
+
+def _prepare_vision_image(raw, mime: str | None, detail: str) -> tuple[bytes, str]:
+    """
+    Vision API가 실제로 쓰는 해상도로 줄이고 JPEG로 재압축한다.
+    - raw는 bytes 또는 seek 가능한 파일 객체(스풀된 업로드)
+    - JPEG은 draft 모드로 축소 디코딩(DCT 스케일링)해서 풀 해상도 디코딩을 피함
+    - EXIF 방향은 반영, 원본 파일 저장은 호출자가 따로 한다
+    - Pillow가 없거나 실패하면 원본 그대로 반환
+    """
+    if not VISION_DOWNSCALE or not raw:
+        return _read_all(raw) if raw else b"", mime or "image/jpeg"
+    try:
+        from PIL import Image, ImageOps
+        if isinstance(raw, (bytes, bytearray)):
+            fp, src_len = io.BytesIO(raw), len(raw)
+        else:
+            fp = raw
+            src_len = fp.seek(0, 2)
+            fp.seek(0)
+        img = Image.open(fp)
+        w, h = img.size
+        scale = _vision_target_scale(w, h, detail)
+        tw, th = max(int(w * scale), 1), max(int(h * scale), 1)
+        if img.format == "JPEG":
+            img.draft("RGB", (tw, th))
+        img = ImageOps.exif_transpose(img)
+        if (img.size[0] >= img.size[1]) != (w >= h):
+            tw, th = th, tw  # EXIF 회전으로 가로/세로가 바뀐 경우
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        if img.size != (tw, th):
+            img = img.resize((tw, th), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+        data = out.getvalue()
+        if scale >= 1.0 and len(data) >= src_len and (mime or "").lower() in ("image/jpeg", "image/jpg"):
+            return _read_all(raw), mime or "image/jpeg"  # 이미 작은 JPEG이면 원본 유지
+        return data, "image/jpeg"
+    except Exception as e:
+        print(f"Vision 전처리 실패(원본 사용): {e}")
+        return _read_all(raw), mime or "image/jpeg"
+
+# ============ 스트리밍 업로드 수집 ============
+class _UploadSpool:
+    """
+    multipart 파트 하나를 받는 스풀 파일.
+    werkzeug 파서가 청크 단위로 write()할 때마다 파일별 한도 검사 + sha256 갱신 + 헤더 보관을 한다.
+    UPLOAD_SPOOL_MEMORY_BYTES를 넘으면 SpooledTemporaryFile이 디스크로 넘긴다.
+    """
+
+    def __init__(self, limit: int = UPLOAD_MAX_FILE_BYTES):
+        self._f = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY_BYTES)
+        self._sha = hashlib.sha256()
+        self._head = bytearray()
+        self._limit = limit
+        self.size = 0
+        self._meta: dict | None = None
+        self._held = False
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self._limit and self.size > self._limit:
+            raise RequestEntityTooLarge(f"file exceeds {self._limit} bytes")
+        self._sha.update(data)
+        if len(self._head) < META_HEAD_BYTES:
+            self._head += data[:META_HEAD_BYTES - len(self._head)]
+        return self._f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __iter__(self):
+        return iter(self._f)
+
+    @property
+    def sha256(self) -> str:
+        return self._sha.hexdigest()
+
+    def _read_at(self, offset: int, length: int) -> bytes:
+        if offset + length <= len(self._head):
+            return bytes(self._head[offset:offset + length])
+        pos = self._f.tell()
+        try:
+            self._f.seek(offset)
+            return self._f.read(length)
+        finally:
+            self._f.seek(pos)
+
+    def meta(self) -> dict:
+        """받은 헤더 구간(+HEIC면 해당 구간만 seek)으로 EXIF/XMP 메타 추출, 파일 해시로 캐시."""
+        if self._meta is None:
+            self._meta = _meta_cache_lookup("sha256:" + self.sha256, lambda: _read_meta_with(self._read_at, self.size))
+        return self._meta
+
+    def save_to(self, path: str) -> None:
+        self._f.seek(0)
+        with open(path, "wb") as out:
+            shutil.copyfileobj(self._f, out, 256 * 1024)
+        self._f.seek(0)
+
+    def fileobj(self):
+        self._f.seek(0)
+        return self._f
+
+    def close(self) -> None:
+        if not self._held:
+            self._f.close()
+
+    def hold(self) -> None:
+        """요청 컨텍스트가 닫혀도(스트리밍 응답) release() 전까지 파일을 닫지 않는다."""
+        self._held = True
+
+    def release(self) -> None:
+        self._held = False
+        self._f.close()
+
+class _SnaplogRequest(Request):
+    """업로드 파일 파트를 _UploadSpool로 받도록 werkzeug 스트림 팩토리를 교체."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return _UploadSpool()
+
+    @property
+    def max_content_length(self) -> int | None:
+        # journey 업로드(?mode=journey)는 사진 수에 맞춘 별도 상한
+        return _max_request_bytes(self.args.get("mode"))
+
+app.request_class = _SnaplogRequest
+
+def _spool_upload(f) -> _UploadSpool:
+    """FileStorage → _UploadSpool. 다른 경로로 들어온 스트림이면 청크 단위로 옮겨 담는다."""
+    stream = getattr(f, "stream", None)
+    if isinstance(stream, _UploadSpool):
+        return stream
+    spool = _UploadSpool()
+    while True:
+        chunk = f.stream.read(256 * 1024)
+        if not chunk:
+            break
+        spool.write(chunk)
+    f.stream = spool  # 다시 호출돼도 같은 스풀을 쓰도록
+    return spool
+
+# ============ Stage1 프레임 선택 (근접 중복 제거 + 정보량 기반 선택) ============
+UPLOAD_MAX_FILES = int(os.getenv("SNAPLOG_MAX_UPLOAD_FILES", "50"))      # Stage1 후보로 살펴볼 최대 업로드 수
+DEDUPE_ENABLED = int(os.getenv("SNAPLOG_DEDUPE", "1"))
+DEDUPE_DHASH_MAX = int(os.getenv("SNAPLOG_DEDUPE_DHASH_MAX", "10"))       # 64비트 중 허용 해밍 거리
+DEDUPE_PHASH_MAX = int(os.getenv("SNAPLOG_DEDUPE_PHASH_MAX", "12"))
+SELECT_W_QUALITY = float(os.getenv("SNAPLOG_SELECT_W_QUALITY", "1.0"))    # 선명도/노출
+SELECT_W_DIVERSITY = float(os.getenv("SNAPLOG_SELECT_W_DIVERSITY", "1.0"))  # 색 히스토그램 차이
+SELECT_W_TIME = float(os.getenv("SNAPLOG_SELECT_W_TIME", "1.0"))          # 시간 분산
+
+PHOTOS_SUMMARY_TIME_KEYS = ["time","takenAt","timestamp","fileCreatedAt","createdAt","created_at","sentAt","sent_at","messageTime","message_time","kakaoTime","kakao_time"]
+
+_DCT32 = None
+
+def _dct_matrix(n: int):
+    import numpy as np
+    k = np.arange(n)[:, None]
+    m = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0, :] = np.sqrt(1.0 / n)
+    return m
+
+def _frame_features(src) -> dict | None:
+    """
+    128px로 축소 디코딩한 한 장에서 선택용 특징을 한 번에 계산 (NumPy 벡터 연산).
+    - dhash/phash: 64비트 지각 해시
+    - sharpness: 라플라시안 분산, exposure: 0~1 (중간 밝기·클리핑 적을수록 높음)
+    - hist: RGB 4x4x4 결합 히스토그램(합 1)
+    """
+    global _DCT32
+    try:
+        import numpy as np
         from PIL import Image
-        from PIL.ExifTags import TAGS
-        img = Image.open(io.BytesIO(raw))
-        exif = getattr(img, "_getexif", lambda: None)() or {}
-        for tag_id, value in exif.items():
-            tag = TAGS.get(tag_id, tag_id)
-            if tag in ("DateTimeOriginal", "DateTime"):
-                dt = _parse_any_dt(str(value))
-                if dt:
-                    return dt
-        info = getattr(img, "info", {}) or {}
-        for k in ("Creation Time", "date:create", "date:modify"):
-            v = info.get(k)
-            if v:
-                dt = _parse_any_dt(str(v))
-                if dt:
-                    return dt
+        fp = io.BytesIO(src) if isinstance(src, (bytes, bytearray)) else src
+        img = Image.open(fp)
+        if img.format == "JPEG":
+            img.draft("RGB", (128, 128))
+        img = img.convert("RGB")
+        img.thumbnail((128, 128))
+        gray_img = img.convert("L")
+        rgb = np.asarray(img, dtype=np.uint8)
+        gray = np.asarray(gray_img, dtype=np.float64)
+
+        d = np.asarray(gray_img.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+        dbits = (d[:, 1:] > d[:, :-1]).ravel()
+        if _DCT32 is None:
+            _DCT32 = _dct_matrix(32)
+        a = np.asarray(gray_img.resize((32, 32), Image.BILINEAR), dtype=np.float64)
+        block = (_DCT32 @ a @ _DCT32.T)[:8, :8].ravel()
+        pbits = block > np.median(block[1:])
+        to_int = lambda bits: int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+        lap = gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4.0 * gray[1:-1, 1:-1]
+        mean = float(gray.mean()) / 255.0
+        clip = float(((gray < 8) | (gray > 247)).mean())
+        q = (rgb // 64).reshape(-1, 3).astype(np.int64)
+        hist = np.bincount(q[:, 0] * 16 + q[:, 1] * 4 + q[:, 2], minlength=64).astype(np.float64)
+        return {
+            "dhash": to_int(dbits),
+            "phash": to_int(pbits),
+            "sharpness": float(lap.var()) if lap.size else 0.0,
+            "exposure": max(0.0, 1.0 - abs(mean - 0.5) * 2.0 - clip),
+            "hist": hist / max(hist.sum(), 1.0),
+        }
     except Exception as e:
-        print(f"EXIF 추출 실패: {e}")
-    return None
+        print(f"프레임 특징 계산 실패: {e}")
+        return None
+
+def _candidate_time(meta_dt: datetime | None = None, ps: dict | None = None, name: str = "", shot=None) -> datetime | None:
+    """선택 단계용 시각: shotAt → EXIF → photosSummary → 파일명 순."""
+    if shot is not None:
+        dt = _parse_any_dt(shot)
+        if dt:
+            return dt
+    if meta_dt:
+        return meta_dt
+    if ps:
+        v = next((ps.get(k) for k in PHOTOS_SUMMARY_TIME_KEYS if ps.get(k)), None)
+        dt = _parse_any_dt(v) if v else None
+        if dt:
+            return dt
+    return _dt_from_filename(name) if name else None
+
+def _candidate_times(rows: list[tuple]) -> list[datetime | None]:
+    """
+    업로드 전체의 후보 시각을 한 번에 해석. rows[i] = (meta_dt, ps, name, shot).
+    shotAt/photosSummary 문자열은 _parse_many_dt로 모아 중복 없이 파싱한다 (우선순위는 _candidate_time과 동일).
+    """
+    shots = _parse_many_dt([r[3] if len(r) > 3 else None for r in rows])
+    ps_vals = _parse_many_dt([
+        next((ps.get(k) for k in PHOTOS_SUMMARY_TIME_KEYS if ps.get(k)), None) if isinstance(ps, dict) else None
+        for _, ps, *_ in rows
+    ])
+    out = []
+    for (meta_dt, _ps, name, *_), shot_dt, ps_dt in zip(rows, shots, ps_vals):
+        out.append(shot_dt or meta_dt or ps_dt or (_dt_from_filename(name) if name else None))
+    return out
+
+def _select_stage1_frames(sources: list, limit: int, times: list | None = None) -> tuple[list[int], dict]:
+    """
+    전체 업로드 후보에서 Stage1(Vision)에 보낼 limit장을 고른다.
+    1) 근접 중복(dHash/pHash 둘 다 가까움)을 묶고, 묶음마다 품질이 가장 좋은 한 장만 남김
+    2) 남은 후보가 limit보다 많으면 탐욕적으로 선택:
+       점수 = 품질 + 이미 고른 사진과의 색 분포 차이 + 이미 고른 시각과의 거리(전체 구간 대비)
+       → 하루 전체를 고르게 덮는 쪽으로 뽑힌다
+    sources[i]는 bytes/파일 객체 또는 그것을 돌려주는 0-인자 콜러블, times[i]는 datetime|None.
+    반환 인덱스는 업로드 순서 기준 오름차순. NumPy/Pillow가 없으면 앞에서부터 limit개.
+    """
+    n = len(sources)
+    debug: dict = {"stage": "select", "candidates": n, "kept": [], "collapsed": [], "scores": []}
+    if not DEDUPE_ENABLED:
+        kept = list(range(min(n, limit)))
+        debug["kept"] = kept
+        debug["note"] = "disabled"
+        return kept, debug
+
+    feats = [_frame_features(src() if callable(src) else src) for src in sources]
+    if not any(feats):
+        kept = list(range(min(n, limit)))
+        debug["kept"] = kept
+        debug["note"] = "features_unavailable"
+        return kept, debug
+
+    import math
+    max_sharp = max((math.log1p(f["sharpness"]) for f in feats if f), default=0.0) or 1.0
+    quality = [
+        (0.6 * math.log1p(f["sharpness"]) / max_sharp + 0.4 * f["exposure"]) if f else 0.0
+        for f in feats
+    ]
+
+    # 1) 근접 중복 묶기 (업로드 순서대로, 대표는 품질 높은 쪽)
+    reps: list[int] = []
+    for i, f in enumerate(feats):
+        match = None
+        if f:
+            for k in reps:
+                fk = feats[k]
+                if not fk:
+                    continue
+                dd = bin(f["dhash"] ^ fk["dhash"]).count("1")
+                pd = bin(f["phash"] ^ fk["phash"]).count("1")
+                if dd <= DEDUPE_DHASH_MAX and pd <= DEDUPE_PHASH_MAX:
+                    match = (k, dd, pd)
+                    break
+        if match is None:
+            reps.append(i)
+            continue
+        k, dd, pd = match
+        if quality[i] > quality[k]:
+            reps[reps.index(k)] = i
+            for c in debug["collapsed"]:
+                if c["dup_of"] == k:
+                    c["dup_of"] = i
+            debug["collapsed"].append({"i": k, "dup_of": i, "dhash": dd, "phash": pd})
+        else:
+            debug["collapsed"].append({"i": i, "dup_of": k, "dhash": dd, "phash": pd})
+
+    # 2) 정보량 기반 탐욕 선택
+    ts = [(t.timestamp() if isinstance(t, datetime) else None) for t in (times or [None] * n)]
+    rep_ts = [ts[i] for i in reps if ts[i] is not None]
+    span = (max(rep_ts) - min(rep_ts)) if len(rep_ts) >= 2 else 0.0
+    if len(reps) <= limit:
+        selected = list(reps)
+    else:
+        selected = []
+        remaining = list(reps)
+        while remaining and len(selected) < limit:
+            best, best_score = None, -1.0
+            for i in remaining:
+                div = 1.0
+                if selected and feats[i] is not None:
+                    dists = [0.5 * float(abs(feats[i]["hist"] - feats[j]["hist"]).sum()) for j in selected if feats[j] is not None]
+                    div = min(dists) if dists else 1.0
+                tgap = 0.5
+                if span > 0 and ts[i] is not None:
+                    sel_ts = [ts[j] for j in selected if ts[j] is not None]
+                    tgap = min(abs(ts[i] - t) for t in sel_ts) / span if sel_ts else 1.0
+                score = SELECT_W_QUALITY * quality[i] + SELECT_W_DIVERSITY * div + SELECT_W_TIME * tgap
+                if score > best_score:
+                    best, best_score = i, score
+            selected.append(best)
+            remaining.remove(best)
+        debug["pick_order"] = list(selected)
+    selected.sort()
+
+    debug["kept"] = selected
+    debug["time_span_s"] = round(span, 1)
+    debug["scores"] = [
+        {"i": i, "quality": round(quality[i], 3),
+         "sharpness": round(f["sharpness"], 1) if f else None,
+         "exposure": round(f["exposure"], 3) if f else None}
+        for i, f in enumerate(feats)
+    ]
+    return selected, debug
+
+# ============ 이미지별 Vision detail 선택 ============
+DETAIL_ADAPTIVE = int(os.getenv("SNAPLOG_DETAIL_ADAPTIVE", "1"))
+DETAIL_TOKEN_BUDGET = int(os.getenv("SNAPLOG_DETAIL_TOKEN_BUDGET", "1600"))     # 요청당 이미지 토큰 예산
+DETAIL_HIGH_THRESH = float(os.getenv("SNAPLOG_DETAIL_HIGH_THRESH", "0.35"))     # 다중: 이 점수 이상만 high 후보
+DETAIL_SINGLE_LOW_THRESH = float(os.getenv("SNAPLOG_DETAIL_SINGLE_LOW_THRESH", "0.12"))  # 단일: 이 미만이면 low
+
+def _vision_tokens(w: int, h: int, detail: str) -> int:
+    """OpenAI 이미지 토큰 규칙: low=85, high=2048 안에 맞춘 뒤 짧은 변 768, 512 타일당 170 + 85."""
+    if detail == "low" or w <= 0 or h <= 0:
+        return 85
+    import math
+    s1 = min(2048 / max(w, h), 1.0)
+    w1, h1 = w * s1, h * s1
+    s2 = min(768 / min(w1, h1), 1.0)
+    w2, h2 = w1 * s2, h1 * s2
+    return 85 + 170 * math.ceil(w2 / 512) * math.ceil(h2 / 512)
+
+def _text_density_score(src) -> tuple[float, tuple[int, int]] | None:
+    """
+    256px 흑백 축소본에서 '글자/세부가 많은 정도'를 0~1로 추정. (점수, 원본 크기) 반환.
+    - 에지 밀도: 밝기 기울기가 큰 픽셀 비율
+    - 글줄 변동: 행별 (가로 방향) 에지 비율의 변동계수. 글줄과 행간이 번갈아 나오는 메뉴판/간판/문서는 크고,
+      질감(잔디·노이즈)이나 일반 사진은 행마다 고르게 퍼져 작다
+    점수 = 에지 밀도(0.1에서 포화) × 글줄 변동(1.5에서 포화)
+    """
+    try:
+        import numpy as np
+        from PIL import Image
+        fp = io.BytesIO(src) if isinstance(src, (bytes, bytearray)) else src
+        img = Image.open(fp)
+        size = img.size
+        if img.format == "JPEG":
+            img.draft("L", (256, 256))
+        img = img.convert("L")
+        img.thumbnail((256, 256))
+        g = np.asarray(img, dtype=np.float64)
+        if g.shape[0] < 3 or g.shape[1] < 3:
+            return 0.0, size
+        gx = np.abs(np.diff(g, axis=1))[:-1, :]
+        gy = np.abs(np.diff(g, axis=0))[:, :-1]
+        edge_density = float((np.hypot(gx, gy) > 40).mean())
+        rows = (gx > 40).mean(axis=1)
+        row_cv = float(rows.std() / rows.mean()) if rows.mean() > 0 else 0.0
+        score = min(edge_density / 0.1, 1.0) * min(row_cv / 1.5, 1.0)
+        return score, size
+    except Exception as e:
+        print(f"detail 분류 실패: {e}")
+        return None
+
+def _choose_vision_details(sources: list, groups: list[list[int]] | None = None) -> tuple[list[str | None], dict]:
+    """
+    요청 단위 토큰 예산 안에서 이미지별 detail을 고른다.
+    - 단일 이미지: 기본 high, 단순한 장면(점수 < DETAIL_SINGLE_LOW_THRESH)이나 high가 예산을 넘으면 low
+    - 다중 이미지: 기본 low, 점수가 DETAIL_HIGH_THRESH 이상인 것부터 예산이 허락하는 만큼 high
+    groups가 주어지면(journey 장면) Vision 호출 단위인 그룹마다 따로 예산을 적용한다.
+    분류가 불가능하면 None(기존 규칙)을 돌려준다.
+    """
+    if groups is not None:
+        details: list[str | None] = [None] * len(sources)
+        debug: dict = {"stage": "detail", "budget": DETAIL_TOKEN_BUDGET, "choices": [], "estimated_tokens": 0}
+        for k, g in enumerate(groups):
+            sub, sub_debug = _choose_vision_details([sources[i] for i in g])
+            for i, d in zip(g, sub):
+                details[i] = d
+            for c in sub_debug.get("choices") or []:
+                debug["choices"].append({**c, "i": g[c["i"]], "scene": k + 1})
+            debug["estimated_tokens"] += sub_debug.get("estimated_tokens", 0)
+            if sub_debug.get("note"):
+                debug["note"] = sub_debug["note"]
+        return details, debug
+
+    n = len(sources)
+    debug: dict = {"stage": "detail", "budget": DETAIL_TOKEN_BUDGET, "choices": []}
+    if not DETAIL_ADAPTIVE or n == 0:
+        debug["note"] = "disabled"
+        return [None] * n, debug
+    scored = [_text_density_score(src() if callable(src) else src) for src in sources]
+    if any(x is None for x in scored):
+        debug["note"] = "classifier_unavailable"
+        return [None] * n, debug
+
+    details = ["low"] * n
+    spent = 85 * n
+    if n == 1:
+        score, (w, h) = scored[0]
+        high = _vision_tokens(w, h, "high")
+        if score >= DETAIL_SINGLE_LOW_THRESH:
+            if high <= DETAIL_TOKEN_BUDGET:
+                details[0] = "high"
+                spent = high
+            else:
+                debug["note"] = "single_over_budget"
+    else:
+        order = sorted(range(n), key=lambda i: scored[i][0], reverse=True)
+        for i in order:
+            score, (w, h) = scored[i]
+            if score < DETAIL_HIGH_THRESH:
+                break
+            extra = _vision_tokens(w, h, "high") - 85
+            if spent + extra <= DETAIL_TOKEN_BUDGET:
+                details[i] = "high"
+                spent += extra
+    debug["estimated_tokens"] = spent
+    debug["choices"] = [
+        {"i": i, "score": round(scored[i][0], 3), "detail": details[i], "tokens": _vision_tokens(*scored[i][1], details[i])}
+        for i in range(n)
+    ]
+    return details, debug
+
+# ============ 대용량 앨범(journey) 모드: 장면 군집 → 장면별 병렬 분석 → 병합 ============
+JOURNEY_AUTO_MIN = int(os.getenv("SNAPLOG_JOURNEY_AUTO_MIN", "0"))          # 업로드가 이 수 이상이면 자동 journey (0=명시적 mode만)
+JOURNEY_MAX_FILES = int(os.getenv("SNAPLOG_JOURNEY_MAX_FILES", "300"))      # journey 모드에서 살펴볼 최대 업로드 수
+JOURNEY_GAP_MINUTES = float(os.getenv("SNAPLOG_JOURNEY_GAP_MINUTES", "90"))  # 이 이상 비면 새 장면
+JOURNEY_GPS_KM = float(os.getenv("SNAPLOG_JOURNEY_GPS_KM", "3.0"))          # 연속 두 장이 이만큼 떨어지면 새 장면
+JOURNEY_MAX_SCENES = int(os.getenv("SNAPLOG_JOURNEY_MAX_SCENES", "12"))
+JOURNEY_FRAMES_PER_SCENE = int(os.getenv("SNAPLOG_JOURNEY_FRAMES_PER_SCENE", "3"))  # 장면당 Vision 투입 수 (<= MAX_IMAGES)
+# journey 요청 본문 상한: 기본은 JOURNEY_MAX_FILES × 사진당 예산. 요청 URL에 ?mode=journey가 있어야 적용된다
+# (MAX_CONTENT_LENGTH 검사는 폼을 읽기 전에 하므로 폼의 mode 필드로는 올릴 수 없다).
+# 클라이언트는 긴 변 2048px 안팎의 JPEG로 줄여 보내는 것을 권장 (Vision은 그보다 작은 크기만 쓴다).
+JOURNEY_PHOTO_MB = float(os.getenv("SNAPLOG_JOURNEY_PHOTO_MB", "4"))
+JOURNEY_MAX_REQUEST_BYTES = int(float(os.getenv("SNAPLOG_JOURNEY_MAX_REQUEST_MB", str(JOURNEY_MAX_FILES * JOURNEY_PHOTO_MB))) * 1024 * 1024)
+
+def _max_request_bytes(mode: str | None) -> int:
+    """요청 본문 상한. ?mode=journey면 journey 상한(기본 상한보다 작아지지는 않음)."""
+    if (mode or "").strip().lower() == "journey":
+        return max(JOURNEY_MAX_REQUEST_BYTES, UPLOAD_MAX_REQUEST_BYTES)
+    return UPLOAD_MAX_REQUEST_BYTES
+
+def _is_journey(mode: str | None, n_uploads: int) -> bool:
+    if (mode or "").strip().lower() == "journey":
+        return True
+    return JOURNEY_AUTO_MIN > 0 and n_uploads >= JOURNEY_AUTO_MIN
+
+def _gps_km(a, b) -> float:
+    import math
+    la1, lo1, la2, lo2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((la2 - la1) / 2) ** 2 + math.cos(la1) * math.cos(la2) * math.sin((lo2 - lo1) / 2) ** 2
+    return 12742.0 * math.asin(min(1.0, math.sqrt(h)))
+
+def _cluster_scenes(times: list, gps: list | None = None) -> list[list[int]]:
+    """
+    촬영시각 순으로 늘어놓고 시간 간격(JOURNEY_GAP_MINUTES) 또는 GPS 거리(JOURNEY_GPS_KM)가 크면 장면을 끊는다.
+    장면이 JOURNEY_MAX_SCENES보다 많으면 시간 간격이 가장 짧은 이웃 장면끼리 합친다.
+    시각이 없는 사진은 업로드 순서상 바로 앞 사진의 장면에 붙인다. 반환은 장면별 인덱스 목록(시간순).
+    """
+    n = len(times)
+    gps = gps or [None] * n
+    dated = sorted((i for i in range(n) if isinstance(times[i], datetime)), key=lambda i: (times[i], i))
+    scenes: list[list[int]] = []
+    for i in dated:
+        if scenes:
+            j = scenes[-1][-1]
+            gap = (times[i] - times[j]).total_seconds() / 60.0
+            far = bool(gps[i] and gps[j]) and _gps_km(gps[i], gps[j]) > JOURNEY_GPS_KM
+            if gap <= JOURNEY_GAP_MINUTES and not far:
+                scenes[-1].append(i)
+                continue
+        scenes.append([i])
+
+    while len(scenes) > max(1, JOURNEY_MAX_SCENES):
+        gaps = [(times[scenes[k + 1][0]] - times[scenes[k][-1]]).total_seconds() for k in range(len(scenes) - 1)]
+        k = gaps.index(min(gaps))
+        scenes[k] = scenes[k] + scenes.pop(k + 1)
+
+    home = {i: k for k, sc in enumerate(scenes) for i in sc}
+    for i in range(n):
+        if i in home:
+            continue
+        prev = next((home[j] for j in range(i - 1, -1, -1) if j in home), None)
+        if prev is None:
+            if not scenes:
+                scenes.append([])
+            prev = 0
+        scenes[prev].append(i)
+        home[i] = prev
+    return [sc for sc in scenes if sc]
+
+def _plan_journey(sources: list, times: list, gps: list | None = None) -> tuple[list[int], list[list[int]], dict]:
+    """
+    journey 모드 Stage1 선택: 장면으로 묶고, 장면마다 _select_stage1_frames로 JOURNEY_FRAMES_PER_SCENE장을 고른다.
+    반환: (kept 업로드 인덱스(장면 순서대로), kept 기준 장면별 위치 목록, 디버그)
+    """
+    scenes = _cluster_scenes(times, gps)
+    per_scene = max(1, min(JOURNEY_FRAMES_PER_SCENE, MAX_IMAGES))
+    picks = list(_io_pool.map(
+        lambda sc: _select_stage1_frames([sources[i] for i in sc], per_scene, [times[i] for i in sc])[0],
+        scenes))
+
+    kept: list[int] = []
+    groups: list[list[int]] = []
+    debug: dict = {"stage": "journey", "candidates": len(sources), "scenes": []}
+    for k, (sc, local) in enumerate(zip(scenes, picks)):
+        chosen = [sc[j] for j in local]
+        groups.append(list(range(len(kept), len(kept) + len(chosen))))
+        kept.extend(chosen)
+        ts = [times[i] for i in sc if isinstance(times[i], datetime)]
+        debug["scenes"].append({
+            "scene": k + 1, "photos": len(sc), "kept": chosen,
+            "start": min(ts).isoformat() if ts else "", "end": max(ts).isoformat() if ts else "",
+        })
+    return kept, groups, debug
+
+def _attach_stage1_debug(analysis: dict | None, entry: dict | None) -> None:
+    """Stage1 이전 선택 단계(중복 제거 등) 기록을 ordering_debug에 덧붙인다."""
+    if analysis and entry and not analysis.get("unsafe"):
+        analysis.setdefault("ordering_debug", []).append(entry)
 
 # ---------------- 날짜 경계 유틸 + 스티처 ----------------
 def _day_break_positions(date_sequence: list[str]) -> list[tuple[int,int]]:
@@ -307,17 +2214,18 @@ _TIME_SHIFT_PAT = re.compile(r"(다음\s*날|이틀\s*뒤|사흘\s*뒤|\d+\s*일
 
 # ======== 태그 기반 재배열 보정기 ========
 _TAG_RE = re.compile(r"</?f(\d+)>", re.I)
+_TAG_BLOCK_RE = re.compile(r"<f(\d+)>(.*?)</f\1>", re.I | re.S)
 
 def _reorder_by_tags(text: str, n_frames: int, date_sequence: list[str]) -> str | None:
     if not text or n_frames <= 0:
         return None
     blocks = {}
+    for m in _TAG_BLOCK_RE.finditer(text):  # 한 번 훑어서 프레임별 첫 블록만
+        i = int(m.group(1))
+        if 1 <= i <= n_frames and i not in blocks:
+            blocks[i] = m.group(2).strip()
     for i in range(1, n_frames + 1):
-        m = re.search(rf"<f{i}>(.*?)</f{i}>", text, re.I | re.S)
-        if not m: return None
-        blk = m.group(1).strip()
-        if not blk: return None
-        blocks[i] = blk
+        if not blocks.get(i): return None
     breaks = {pos: diff for (pos, diff) in _day_break_positions(date_sequence or [])}
     out_parts = []
     for i in range(1, n_frames + 1):
@@ -443,6 +2351,9 @@ def is_content_safe_for_diary(analysis: dict | None) -> tuple[bool, dict]:
     - frames.summary / elements / visible_text를 모아서 모더레이션 API에 보냄
     - 문제가 있으면 False 반환
     """
+    return _run_steps(_moderation_steps(analysis))
+
+def _moderation_steps(analysis: dict | None):
     if not analysis:
         return True, {"reason": "no_analysis"}
 
@@ -467,10 +2378,10 @@ def is_content_safe_for_diary(analysis: dict | None) -> tuple[bool, dict]:
         return True, {"reason": "empty_text"}
 
     try:
-        resp = client.moderations.create(
+        resp = yield ("moderation", dict(
             model=MODERATION_MODEL,
             input=joined[:4000],
-        )
+        ))
         result = resp.results[0]
         flagged = bool(getattr(result, "flagged", False))
         categories = getattr(result, "categories", {})
@@ -511,32 +2422,36 @@ def enrich_food_structured_for_multi(analysis: dict | None,
     - 기존 analyze_images의 단일 이미지 분기(프롬프트)를 그대로 재사용하기 위해
       내부적으로 analyze_images([data_url])를 호출한다.
     - prompts, 기존 로직을 변경하지 않고 '추가 호출'만 수행.
+    - 프레임별 호출은 _io_pool에서 동시에 실행되며 결과 반영 순서는 프레임 순서를 따른다.
     """
-    if not analysis:
-        return analysis
-    frames = analysis.get("frames") or []
-    if not frames:
-        return analysis
-
-    sorted_images = analysis.get("sorted_images") or []
-    if not sorted_images or len(sorted_images) != len(frames):
+    targets = _food_enrich_targets(analysis)
+    if not targets:
         return analysis
 
-    for idx, f in enumerate(frames):
-        if not f.get("has_food"):
-            continue
-        if f.get("food_structured"):
-            continue
-        if idx >= len(sorted_images):
-            continue
-
-        img_data_url = sorted_images[idx]
+    # 프레임별 단일 분석은 서로 독립이므로 동시에 요청 (동시성은 레이트 리미터가 제한)
+    futures = {idx: _io_pool.submit(analyze_images, [analysis["sorted_images"][idx]], None) for idx in targets}
+    subs = {}
+    for idx, fut in futures.items():
         try:
-            sub_analysis = analyze_images([img_data_url], photos_summary=None)
+            subs[idx] = fut.result()
         except Exception as e:
             print(f"[enrich_food_structured_for_multi] sub analyze_images 실패 idx={idx}: {e}")
-            continue
+    return _merge_food_enrichment(analysis, subs)
 
+def _food_enrich_targets(analysis: dict | None) -> list[int]:
+    """단일 분석으로 food_structured를 채울 프레임 인덱스 (보강 불가면 빈 목록)."""
+    if not analysis:
+        return []
+    frames = analysis.get("frames") or []
+    sorted_images = analysis.get("sorted_images") or []
+    if not frames or not sorted_images or len(sorted_images) != len(frames):
+        return []
+    return [idx for idx, f in enumerate(frames) if f.get("has_food") and not f.get("food_structured") and sorted_images[idx] is not None]
+
+def _merge_food_enrichment(analysis: dict, subs: dict) -> dict:
+    frames = analysis.get("frames") or []
+    for idx, sub_analysis in subs.items():
+        f = frames[idx]
         if not sub_analysis:
             continue
         sub_frames = sub_analysis.get("frames") or []
@@ -552,14 +2467,71 @@ def enrich_food_structured_for_multi(analysis: dict | None,
     analysis["food_fusion"] = fuse_food_candidates(analysis)
     return analysis
 
+# ---------------- contact sheet (다중 사진 토큰 절감) ----------------
+VISION_CONTACT_SHEET = int(os.getenv("SNAPLOG_VISION_CONTACT_SHEET", "0"))
+CONTACT_SHEET_DETAIL = os.getenv("SNAPLOG_CONTACT_SHEET_DETAIL", "low")
+CONTACT_SHEET_MAX_TILES = int(os.getenv("SNAPLOG_CONTACT_SHEET_MAX_TILES", "6"))  # 시트 한 장당 타일 수
+CONTACT_SHEET_MAX_SHEETS = 2
+
+def _build_contact_sheets(sorted_images: list) -> list[bytes] | None:
+    """
+    시간순 프레임을 번호 타일(1부터)로 배치한 JPEG 시트 1~2장. 시트 크기는 detail 규칙에 맞춤
+    (low: 512, high: 1024). 타일 수가 시트 2장을 넘거나 Pillow가 없으면 None → 개별 이미지 모드.
+    """
+    n = len(sorted_images)
+    if n < 2 or n > CONTACT_SHEET_MAX_TILES * CONTACT_SHEET_MAX_SHEETS:
+        return None
+    try:
+        import math
+        from PIL import Image, ImageDraw, ImageFont, ImageOps
+        canvas = 512 if CONTACT_SHEET_DETAIL == "low" else 1024
+        per_sheet = math.ceil(n / math.ceil(n / CONTACT_SHEET_MAX_TILES))
+        try:
+            font = ImageFont.load_default(size=max(canvas // 24, 12))
+        except TypeError:
+            font = ImageFont.load_default()
+        sheets = []
+        for start in range(0, n, per_sheet):
+            chunk = sorted_images[start:start + per_sheet]
+            cols = math.ceil(math.sqrt(len(chunk)))
+            rows = math.ceil(len(chunk) / cols)
+            tile = canvas // cols
+            sheet = Image.new("RGB", (tile * cols, tile * rows), (24, 24, 24))
+            draw = ImageDraw.Draw(sheet)
+            for k, item in enumerate(chunk):
+                raw = item.raw if isinstance(item, ImageHandle) else ImageHandle.from_b64(item).raw
+                img = Image.open(io.BytesIO(raw))
+                if img.format == "JPEG":
+                    img.draft("RGB", (tile, tile))
+                img = ImageOps.exif_transpose(img).convert("RGB")
+                img.thumbnail((tile - 4, tile - 4))
+                x0, y0 = (k % cols) * tile, (k // cols) * tile
+                sheet.paste(img, (x0 + (tile - img.size[0]) // 2, y0 + (tile - img.size[1]) // 2))
+                label = str(start + k + 1)
+                pad = max(tile // 40, 3)
+                box = draw.textbbox((0, 0), label, font=font)
+                draw.rectangle([x0, y0, x0 + box[2] + pad * 2, y0 + box[3] + pad * 2], fill=(255, 221, 0))
+                draw.text((x0 + pad, y0 + pad), label, fill=(0, 0, 0), font=font)
+            out = io.BytesIO()
+            sheet.save(out, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+            sheets.append(out.getvalue())
+        return sheets
+    except Exception as e:
+        print(f"contact sheet 생성 실패(개별 모드 사용): {e}")
+        return None
+
 # ---------------- 1) 분석: 이미지 → 구조화 JSON ----------------
-def analyze_images(images: list[str] | list[dict], photos_summary: list[dict] | None = None) -> dict | None:
+def analyze_images(images: list[str] | list[dict] | list[ImageHandle], photos_summary: list[dict] | None = None,
+                   contact_sheet: bool | None = None) -> dict | None:
     """
     당신은 사진을 세밀하게 분석하는 도우미입니다.
     각 사진에서 보이는 내용(음식, 배경, 사람 등)을 요약하고,
     텍스트(메뉴판, 상표, 라벨 등)가 실제로 보이는지 여부와 내용을 명시적으로 기술하세요.
     그리고 각 사진에 대해 실내/실외, 시간단서, 장소단서, 흐름단서를 추출하세요.
     """
+    return _run_steps(_analyze_images_steps(images, photos_summary, contact_sheet))
+
+def _analyze_images_steps(images, photos_summary=None, contact_sheet=None):
     if not images:
         return None
 
@@ -593,11 +2565,14 @@ def analyze_images(images: list[str] | list[dict], photos_summary: list[dict] |
                 dt_ps = _parse_any_dt(ps_time)
                 if dt_ps: dt = dt_ps; src = "photosSummary"
 
+        if dt is None and isinstance(img_data, ImageHandle):
+            dt_exif = img_data.meta.get("datetime")
+            if dt_exif: dt = dt_exif; src = "exif_fallback"
+
         if dt is None and isinstance(img_data, str) and img_data and img_data.startswith("data:image"):
             try:
-                image_data = img_data.split(",")[1] if "," in img_data else img_data
-                img_bytes = base64.b64decode(image_data)
-                dt_exif = _read_exif_datetime_from_bytes(img_bytes)
+                # 헤더 구간만 디코드해서 EXIF/XMP 확인 (전체 base64 디코드 없음)
+                dt_exif = read_image_meta_from_data_url(img_data).get("datetime")
                 if dt_exif: dt = dt_exif; src = "exif_fallback"
             except Exception as e:
                 print(f"[{idx}] data URL EXIF 추출 실패: {e}")
@@ -709,13 +2684,28 @@ def analyze_images(images: list[str] | list[dict], photos_summary: list[dict] |
         )
         max_tok = 800
 
-    content = [{"type":"text","text": prompt}]
-    for data_url in sorted_images:
-        url = data_url if isinstance(data_url, str) and data_url.startswith("data:image") else f"data:image/jpeg;base64,{data_url}"
-        detail = "high" if len(sorted_images) == 1 else "low"
-        content.append({"type":"image_url","image_url":{"url": url, "detail": detail}})
+    # 다중 사진 contact sheet 모드: 번호 타일로 합친 1~2장만 전송 (frames/index 계약은 동일)
+    use_sheet = VISION_CONTACT_SHEET if contact_sheet is None else contact_sheet
+    sheets = (yield ("call", _build_contact_sheets, (sorted_images,))) if (use_sheet and len(sorted_images) > 1) else None
+    if sheets:
+        prompt += (
+            f"\n**입력 형식**: 사진 {len(sorted_images)}장을 번호가 적힌 타일로 모은 합본 이미지 {len(sheets)}장입니다. "
+            f"타일 번호 1~{len(sorted_images)}가 촬영시각 순서이며, frames는 타일 번호 순서대로 정확히 {len(sorted_images)}개를 출력하세요. "
+            "타일 번호 표식과 타일 경계는 관찰 대상이 아닙니다."
+        )
+
+    # 해시/디스크 캐시/base64 인코딩은 CPU·파일 작업이라 "call" 단계로 (비동기 경로에서 루프를 막지 않게)
+    variant = "single" if len(sorted_images) == 1 else ("multi_sheet" if sheets else "multi")
+    cache_key = (yield ("call", _vision_cache_key, (sorted_images, variant, MODEL_VISION))) if VISION_CACHE_ENABLED else None
+    if cache_key:
+        cached = yield ("call", vision_cache.get, (cache_key,))
+        if cached is not None:
+            print(f"[analyze_images] vision cache hit {cache_key[:12]} ({variant})")
+            return _finalize_analysis(cached, date_info_iso, ordering_debug, sorted_images)
 
-    r = throttled_chat_completion(
+    content = yield ("call", _vision_content, (prompt, sheets, sorted_images))
+
+    r = yield ("chat", dict(
         model=MODEL_VISION,
         temperature=0.0,
         max_tokens=max_tok,
@@ -724,7 +2714,7 @@ def analyze_images(images: list[str] | list[dict], photos_summary: list[dict] |
             {"role":"system","content": sys},
             {"role":"user","content": content}
         ]
-    )
+    ))
 
     # [추가] Vision 단계 내장 content_filter 감지
     try:
@@ -742,12 +2732,13 @@ def analyze_images(images: list[str] | list[dict], photos_summary: list[dict] |
         for f in frames:
             f["summary"] = clean_inline(f.get("summary",""))
             f["elements"] = [clean_inline(x) for x in (f.get("elements") or []) if x]
-        data["date_sequence"] = date_info_iso
-        data["ordering_debug"] = ordering_debug
-        data["sorted_images"] = sorted_images  # [추가] multi-enrich용
-        # --- 글로벌 음식 후보 융합 추가 ---
-        data["food_fusion"] = fuse_food_candidates(data)
-        return data
+        if sheets and len(frames) != len(sorted_images):
+            # 타일-프레임 대응이 깨지면 개별 이미지 모드로 다시 분석
+            print(f"[analyze_images] contact sheet frames 불일치 ({len(frames)} != {len(sorted_images)}) → 개별 모드 재시도")
+            return (yield from _analyze_images_steps(images, photos_summary=photos_summary, contact_sheet=False))
+        if cache_key and frames:
+            yield ("call", vision_cache.put, (cache_key, data))
+        return _finalize_analysis(data, date_info_iso, ordering_debug, sorted_images)
     except Exception as e:
         raw = r.choices[0].message.content if r and r.choices else ""
         if raw:
@@ -757,14 +2748,171 @@ def analyze_images(images: list[str] | list[dict], photos_summary: list[dict] |
         print("분석 JSON 파싱 실패:", e)
         return None
 
+def _vision_content(prompt: str, sheets: list[bytes] | None, sorted_images: list) -> list[dict]:
+    """Vision 요청 content: 프롬프트 + contact sheet(있으면) 또는 이미지별 data URL."""
+    content = [{"type":"text","text": prompt}]
+    for sheet in sheets or []:
+        url = f"data:image/jpeg;base64,{base64.b64encode(sheet).decode('ascii')}"
+        content.append({"type":"image_url","image_url":{"url": url, "detail": CONTACT_SHEET_DETAIL}})
+    for data_url in ([] if sheets else sorted_images):
+        if isinstance(data_url, ImageHandle):
+            url = data_url.data_url
+        else:
+            url = data_url if isinstance(data_url, str) and data_url.startswith("data:image") else f"data:image/jpeg;base64,{data_url}"
+        detail = getattr(data_url, "detail", None) or ("high" if len(sorted_images) == 1 else "low")
+        content.append({"type":"image_url","image_url":{"url": url, "detail": detail}})
+    return content
+
+def _finalize_analysis(data: dict, date_info_iso: list[str], ordering_debug: list[dict], sorted_images: list) -> dict:
+    """모델 출력(또는 캐시 값)에 요청별 정보(날짜 시퀀스/정렬 디버그/이미지)와 음식 융합을 붙인다."""
+    data["date_sequence"] = date_info_iso
+    data["ordering_debug"] = ordering_debug
+    data["sorted_images"] = sorted_images  # [추가] multi-enrich용
+    # --- 글로벌 음식 후보 융합 추가 ---
+    data["food_fusion"] = fuse_food_candidates(data)
+    return data
+
+def analyze_journey(images: list[dict], photos_summary: list[dict] | None, scenes: list[list[int]]) -> dict | None:
+    """
+    장면별로 analyze_images를 병렬 호출하고(동시성은 _io_pool/레이트 리미터가 제한) 결과를 하나로 합친다.
+    장면은 시간순이고 각 결과도 장면 안에서 시간순이므로 frames/date_sequence를 이어 붙이면 전체 순서가 유지된다.
+    한 장면의 실패(레이트 리밋/타임아웃 등)는 그 장면만 비우고, 모든 장면이 실패했을 때만 오류를 올린다.
+    """
+    if not images or not scenes:
+        return None
+
+    futures = [_io_pool.submit(analyze_images, *args) for args in _journey_scene_inputs(images, photos_summary, scenes)]
+    results = []
+    for fut in futures:
+        try:
+            results.append(fut.result())
+        except Exception as e:
+            results.append(e)
+    return _merge_journey_parts(_journey_scene_results(results))
+
+def _journey_scene_results(results: list) -> list[dict | None]:
+    """장면별 결과(예외 포함) → 실패 장면은 None. 전부 실패면 첫 예외를 다시 던진다 (RateLimitError → 429)."""
+    errors = [(k, r) for k, r in enumerate(results) if isinstance(r, BaseException)]
+    for k, e in errors:
+        print(f"[analyze_journey] 장면 {k + 1} 분석 실패: {e!r}")
+    if errors and len(errors) == len(results):
+        raise errors[0][1]
+    return [None if isinstance(r, BaseException) else r for r in results]
+
+def _journey_scene_inputs(images: list[dict], photos_summary: list[dict] | None, scenes: list[list[int]]) -> list[tuple]:
+    out = []
+    for sc in scenes:
+        ps = [photos_summary[i] if i < len(photos_summary) else {} for i in sc] if photos_summary else None
+        out.append(([images[i] for i in sc], ps))
+    return out
+
+def _merge_journey_parts(parts: list[dict | None]) -> dict | None:
+    """장면별 분석 결과를 시간순으로 이어 붙인다. 한 장면이라도 unsafe면 그 결과를 그대로 돌려준다."""
+    unsafe = next((p for p in parts if p and p.get("unsafe")), None)
+    if unsafe:
+        return unsafe
+
+    merged: dict = {"frames": [], "date_sequence": [], "ordering_debug": [], "sorted_images": []}
+    scene_info = []
+    times_of_day = []
+    for k, part in enumerate(parts):
+        if not part:
+            scene_info.append({"scene": k + 1, "frames": 0, "error": "analysis_failed"})
+            continue
+        frames = part.get("frames") or []
+        for f in frames:
+            f["scene"] = k + 1
+        # date_sequence/sorted_images는 입력 이미지 수 기준이라 모델이 돌려준 frames 수와 다를 수 있다.
+        # 장면마다 frames 길이에 맞춰야 뒤 장면의 날짜/이미지가 밀리지 않는다 (모자라면 장면 마지막 날짜로 채움).
+        dates = list(part.get("date_sequence") or [])[:len(frames)]
+        dates += [dates[-1] if dates else ""] * (len(frames) - len(dates))
+        imgs = list(part.get("sorted_images") or [])[:len(frames)]
+        imgs += [None] * (len(frames) - len(imgs))
+        merged["frames"].extend(frames)
+        merged["date_sequence"].extend(dates)
+        merged["ordering_debug"].extend({**d, "scene": k + 1} for d in part.get("ordering_debug") or [])
+        merged["sorted_images"].extend(imgs)
+        dominant = (part.get("global") or {}).get("dominant_time")
+        if dominant and dominant != "불명":
+            times_of_day.append(dominant)
+        seq = [d for d in dates if d]
+        scene_info.append({"scene": k + 1, "frames": len(frames), "start": seq[0] if seq else "", "end": seq[-1] if seq else ""})
+    if not merged["frames"]:
+        return None
+
+    for i, f in enumerate(merged["frames"], 1):
+        f["index"] = i
+    merged["global"] = {
+        "dominant_time": max(set(times_of_day), key=times_of_day.count) if times_of_day else "불명",
+        "movement": "있음" if len(scene_info) > 1 else "불명",
+        "scenes": scene_info,
+    }
+    merged["food_fusion"] = fuse_food_candidates(merged)
+    return merged
+
+# ---------------- journey 초안 입력 (장면 요약) ----------------
+def _journey_digest(analysis: dict | None) -> dict | None:
+    """
+    journey 분석(장면당 최대 JOURNEY_FRAMES_PER_SCENE 프레임)을 장면당 프레임 하나로 접는다.
+    초안/보정/문체 검사는 이 요약으로 돌아 <f{i}> 블록 수와 문장 수가 장면 수를 따른다.
+    장면 정보가 없거나 이미 장면당 한 프레임이면 그대로 돌려준다.
+    """
+    frames = (analysis or {}).get("frames") or []
+    if not frames or any(f.get("scene") is None for f in frames):
+        return analysis
+    groups: OrderedDict[int, list[int]] = OrderedDict()
+    for i, f in enumerate(frames):
+        groups.setdefault(f["scene"], []).append(i)
+    if len(groups) == len(frames):
+        return analysis
+
+    def _first(fs, key, unknown=("불명", "unknown")):
+        return next((f.get(key) for f in fs if f.get(key) and f.get(key) not in unknown), None)
+
+    dates = analysis.get("date_sequence") or []
+    out_frames, out_dates = [], []
+    for k, (scene, idxs) in enumerate(groups.items(), 1):
+        fs = [frames[i] for i in idxs]
+        food = next((f for f in fs if f.get("has_food") and f.get("food_structured")), None)
+        texts = list(dict.fromkeys((f.get("visible_text") or "").strip() for f in fs if (f.get("visible_text") or "").strip()))
+        out_frames.append({
+            "index": k,
+            "scene": scene,
+            "summary": " / ".join(f.get("summary") for f in fs if f.get("summary")),
+            "indoor_outdoor": _first(fs, "indoor_outdoor") or "unknown",
+            "time_hint": _first(fs, "time_hint") or "불명",
+            "place_hint": _first(fs, "place_hint") or "",
+            "flow": _first(fs, "flow") or "불명",
+            "has_food": any(f.get("has_food") is True for f in fs),
+            "food_structured": (food or {}).get("food_structured"),
+            "visible_text": " ".join(texts),
+            "elements": [x for f in fs for x in (f.get("elements") or [])],
+        })
+        out_dates.append(dates[idxs[0]] if idxs[0] < len(dates) else "")
+    return {**analysis, "frames": out_frames, "date_sequence": out_dates, "sorted_images": [], "journey_digest": True}
+
+def _sentence_range(analysis: dict | None) -> tuple[int, int]:
+    """초안 문장 수 범위: 단일 3~4, 다중 5~7, 장면이 5개를 넘으면 장면마다 한 문장 이상 들어가도록 늘린다."""
+    n = len((analysis or {}).get("frames") or [])
+    if n <= 1:
+        return 3, 4
+    if n <= 5:
+        return 5, 7
+    return n, n + 3
+
 # ---------------- 2) 초안 ----------------
-def draft_diary(analysis: dict | None, tone: str, category_hint: str, text_model: str = MODEL_TEXT) -> str:
+def draft_diary(analysis: dict | None, tone: str, category_hint: str, text_model: str = MODEL_TEXT,
+                cancel: Event | None = None) -> str:
     """
     핵심: 설명문이 아니라 '말하듯' 쓰기. 짧고 긴 문장 섞기.
     '30대 일기 톤.
     """
+    return _run_steps(_draft_diary_steps(analysis, tone, category_hint, text_model), cancel)
+
+def _draft_diary_steps(analysis: dict | None, tone: str, category_hint: str, text_model: str = MODEL_TEXT):
     if not analysis:
         return ""
+    analysis = _journey_digest(analysis)
     frames = analysis.get("frames") or []
     global_info = analysis.get("global") or {}
     date_sequence = analysis.get("date_sequence") or []
@@ -830,7 +2978,8 @@ def draft_diary(analysis: dict | None, tone: str, category_hint: str, text_model
     dom_time = global_info.get("dominant_time","불명")
     movement = global_info.get("movement","불명")
     header = f"[흐름] 시각:{dom_time} 이동:{movement}"
-    length_rule = "5~7문장" if (category_hint == "journey_multi" or len(frames) > 1) else "3~4문장"
+    lo, hi = _sentence_range(analysis) if len(frames) > 1 else ((5, 7) if category_hint == "journey_multi" else (3, 4))
+    length_rule = f"{lo}~{hi}문장"
 
     sys = (
         "당신은 20~30대가 쓰는 한국어 일기를 잘 쓰는 작가입니다. "
@@ -1009,22 +3158,19 @@ visible_text에 메뉴명이 실제로 보이면 confidence와 무관하게 그
 
 모든 <f{{i}}>블록 사이에는 연결어 1개 이상을 둔다.
 """
-    r = throttled_chat_completion(
+    r = yield ("chat", dict(
         model=text_model,
         temperature=0.20,
         top_p=0.9,
-        max_tokens=600,
+        max_tokens=max(600, hi * 60),
         messages=[
             {"role":"system","content": sys},
             {"role":"user","content": user}
         ]
-    )
+    ))
     draft = (r.choices[0].message.content or "").strip()
 
-    draft = clean_inline(draft)
-    draft = replace_proper_nouns_if_no_visible_text(analysis, draft)
-    draft = simplify_food_enumeration(draft)  # 필요 시 제거 또는 조건부 실행
-    draft = soften_report_tone(draft)
+    draft = _postprocess_draft(analysis, draft)
 
     # 태그 기반 재배열 시도
     reordered = _reorder_by_tags(draft, n_frames=len(frames), date_sequence=date_sequence)
@@ -1044,6 +3190,9 @@ def _norm(x: str) -> str:
     return re.sub(r"\s+", " ", (x or "").strip())
 
 def select_draft_via_cross_validation(analysis: dict, tone: str, category_hint: str) -> tuple[str, dict]:
+    if CV_PARALLEL and ALT_TEXT_MODEL and ALT_TEXT_MODEL != MODEL_TEXT:
+        return _select_draft_parallel(analysis, tone, category_hint)
+
     primary = draft_diary(analysis, tone, category_hint, text_model=MODEL_TEXT)
     used = "primary"
     alt = None
@@ -1053,16 +3202,7 @@ def select_draft_via_cross_validation(analysis: dict, tone: str, category_hint:
     if ALT_TEXT_MODEL and ALT_TEXT_MODEL != MODEL_TEXT:
         try:
             alt = draft_diary(analysis, tone, category_hint, text_model=ALT_TEXT_MODEL)
-            debug["alt_len"] = len(alt)
-            if _norm(alt) == _norm(primary):
-                debug["same"] = True
-                used = "primary"
-                return primary, debug
-            else:
-                debug["same"] = False
-                used = "alt"
-                debug["used"] = used
-                return alt, debug
+            return _pick_cv_draft(primary, alt, debug)
         except Exception as e:
             debug["alt_error"] = str(e)
             return primary, debug
@@ -1070,12 +3210,57 @@ def select_draft_via_cross_validation(analysis: dict, tone: str, category_hint:
         debug["note"] = "ALT_TEXT_MODEL is same as primary or unset"
         return primary, debug
 
+def _pick_cv_draft(primary: str, alt: str, debug: dict) -> tuple[str, dict]:
+    debug["alt_len"] = len(alt)
+    if _norm(alt) == _norm(primary):
+        debug["same"] = True
+        return primary, debug
+    debug["same"] = False
+    debug["used"] = "alt"
+    return alt, debug
+
+def _select_draft_parallel(analysis: dict, tone: str, category_hint: str) -> tuple[str, dict]:
+    """
+    기본/ALT 초안을 동시에 요청한다. 선택 규칙(_norm 비교)은 순차 모드와 동일.
+    시작 후 CV_ALT_DEADLINE_SECONDS 안에 ALT가 돌아오지 않으면 기본 초안을 채택.
+    마감 시 ALT에 취소 신호를 보내 리미터 대기/재시도/다음 호출은 멈추지만, 이미 보낸 HTTP 요청은
+    동기 클라이언트로는 끊을 수 없어 응답이 올 때까지 슬롯과 토큰 예약을 쥔다 (debug["alt_in_flight"]).
+    """
+    started = time.monotonic()
+    alt_cancel = Event()
+    fut_primary = _io_pool.submit(draft_diary, analysis, tone, category_hint, MODEL_TEXT)
+    fut_alt = _io_pool.submit(draft_diary, analysis, tone, category_hint, ALT_TEXT_MODEL, alt_cancel)
+
+    primary = fut_primary.result()
+    debug = {"primary_len": len(primary), "alt_len": 0, "used": "primary", "same": None,
+             "primary_model": MODEL_TEXT, "alt_model": ALT_TEXT_MODEL, "mode": "parallel"}
+    try:
+        remaining = max(CV_ALT_DEADLINE_SECONDS - (time.monotonic() - started), 0.0)
+        alt = fut_alt.result(timeout=remaining)
+    except FutureTimeoutError:
+        alt_cancel.set()
+        debug["alt_error"] = "deadline_exceeded"
+        debug["alt_deadline_s"] = CV_ALT_DEADLINE_SECONDS
+        debug["alt_in_flight"] = not fut_alt.cancel()  # True면 보낸 요청이 끝날 때까지 할당량을 쓴다
+        return primary, debug
+    except Exception as e:
+        debug["alt_error"] = str(e)
+        return primary, debug
+    debug["elapsed_s"] = round(time.monotonic() - started, 3)
+    return _pick_cv_draft(primary, alt, debug)
+
 # ---------------- 3) 보정 ----------------
-def refine_diary(analysis: dict | None, draft: str, tone: str, category_hint: str) -> str:
+def refine_diary(analysis: dict | None, draft: str, tone: str, category_hint: str, on_delta=None) -> str:
+    return _run_steps(_refine_diary_steps(analysis, draft, tone, category_hint, on_delta))
+
+def _refine_diary_steps(analysis: dict | None, draft: str, tone: str, category_hint: str, on_delta=None):
     if not draft:
         return ""
+    analysis = _journey_digest(analysis)
     frames = analysis.get("frames") or [] if analysis else []
     length_rule = "54문장"
+    if analysis and analysis.get("journey_digest"):
+        length_rule = "{}~{}문장".format(*_sentence_range(analysis))
 
     sys = "당신은 말하듯 쓰는 텍스트를 다듬는 한국어 에디터입니다."
     user = f"""
@@ -1173,16 +3358,21 @@ time_hint가 '불명'인 프레임에서 생성된 시간단어를 모두 삭제
 
 한 단락만. 불필요한 수식어 축소. 관찰 나열 금지.
 """
-    r = throttled_chat_completion(
+    req = dict(
         model=MODEL_TEXT,
         temperature=0.15,
-        max_tokens=700,
+        max_tokens=max(700, _sentence_range(analysis)[1] * 60),
         messages=[
             {"role":"system","content": sys},
             {"role":"user","content": user}
         ]
     )
-    final_text = (r.choices[0].message.content or "").strip()
+    if on_delta is not None:
+        # 스트리밍: 원문 조각을 그대로 흘려보내고, 정리된 최종본은 호출자가 따로 전달
+        final_text = (yield ("chat_stream", req, on_delta))[0].strip()
+    else:
+        r = yield ("chat", req)
+        final_text = (r.choices[0].message.content or "").strip()
     final_text = clean_inline(final_text)
     final_text = soften_report_tone(final_text)
     return final_text
@@ -1209,16 +3399,27 @@ REPORT_PATTERNS = [
 def soften_report_tone(text: str) -> str:
     if not text:
         return text
-    t = text
-    for p in TRIM_PHRASES:
-        t = t.replace(p, "")
-    for pat, rep in REPORT_PATTERNS:
-        t = re.sub(pat, rep, t)
-    t = re.sub(r"(있었다\.)\s+(있었다\.)", r"\1 ", t)
+    t = _text_engine("trim").apply(text)
+    t = _text_engine("report").apply(t)
     return t.strip()
 
+def _postprocess_draft(analysis: dict | None, draft: str) -> str:
+    """
+    clean_inline → replace_proper_nouns_if_no_visible_text → simplify_food_enumeration → soften_report_tone와 같은 결과.
+    proper/food/trim은 한 엔진으로 합쳐 3번만 훑는다 (_text_rules 참고).
+    """
+    t = clean_inline(draft)
+    if not t:
+        return t
+    stages = ("food", "trim") if (not analysis or _any_visible_text(analysis)) else ("proper", "food", "trim")
+    t = _text_engine(*stages).apply(t)
+    return _text_engine("report").apply(t).strip()
+
 # ---------------- 이미지 없을 때(요약 단서) ----------------
 def generate_from_lines(lines: list[str], tone: str) -> str:
+    return _run_steps(_generate_from_lines_steps(lines, tone))
+
+def _generate_from_lines_steps(lines: list[str], tone: str):
     cat = decide_category_from_lines(lines)
     sys = "당신은 20~30대가 쓰는 한국어 일기를 잘 쓰는 작가입니다."
     user = f"""
@@ -1241,7 +3442,7 @@ def generate_from_lines(lines: list[str], tone: str) -> str:
 
 한 단락만 출력.
 """
-    r = throttled_chat_completion(
+    r = yield ("chat", dict(
         model=MODEL_TEXT,
         temperature=0.35,
         max_tokens=600,
@@ -1249,7 +3450,7 @@ def generate_from_lines(lines: list[str], tone: str) -> str:
             {"role":"system","content": sys},
             {"role":"user","content": user}
         ]
-    )
+    ))
     text = (r.choices[0].message.content or "").strip()
     text = soften_report_tone(clean_inline(text))
     return text
@@ -1261,6 +3462,289 @@ FALLBACKS = [
     "별스러운 건 없었지만, 손끝에 남은 촉각이 오래 갔다.",
 ]
 
+# ---------------- 스트리밍 이벤트 싱크 ----------------
+_stream_local = local()  # 스트리밍 요청을 처리하는 스레드에서만 emit이 설정됨
+
+def _emit(event: str, data: dict) -> None:
+    """스트리밍 응답 중이면 단계 이벤트를 내보낸다. 일반 요청에서는 아무것도 하지 않는다."""
+    sink = getattr(_stream_local, "emit", None)
+    if sink is not None:
+        sink(event, data)
+
+def _streaming() -> bool:
+    return getattr(_stream_local, "emit", None) is not None
+
+def _emit_analysis_events(analysis: dict | None) -> None:
+    if not _streaming() or not analysis:
+        return
+    _emit("ordering", {"date_sequence": analysis.get("date_sequence") or [], "ordering_debug": analysis.get("ordering_debug") or []})
+    _emit("observations", {"frames": analysis.get("frames") or []})
+
+# ---------------- 로컬 문체 검사 (초안/보정 프롬프트의 기계적 규칙) ----------------
+_SENT_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+")
+_TIME_WORD_RE = re.compile(r"오전|정오|오후|저녁|밤(?=[\s,.에은이을도]|$)")  # '밤'은 단독 낱말만 (밤하늘·군밤 제외)
+_CONNECTIVE_RE = re.compile(r"그래서|때문에|덕분에|하지만|그리고|그러다가|그런데|그러나|면서|는데")
+STYLE_BANNED_WORDS = [
+    # 의성어·과장 (초안/보정 공통)
+    "지글지글", "노릇노릇", "바삭", "촉촉", "입안 가득", "코끝", "스며들", "감돌", "간질이", "한껏", "가득", "벅차",
+    "특별했다", "미소가 지어졌다",
+    # 직접 감정어 / 관찰동사 / 금지구
+    "기뻤다", "즐거웠다", "괜히", "보였다", "보였던", "눈에 들어왔다", "가지런히 놓인 모습", "생각에 잠겼다", "조용히 앉아",
+]
+_STYLE_BANNED_RE = re.compile("|".join(map(re.escape, STYLE_BANNED_WORDS + BAN_WORDS_INLINE)))
+
+def _style_len(sent: str) -> int:
+    """문장 글자 수: 공백 포함, 끝 문장부호 제외."""
+    return len(sent.strip().rstrip(".!?…"))
+
+def check_diary_style(text: str, analysis: dict | None = None) -> dict:
+    """
+    초안이 프롬프트의 기계적 규칙을 지키는지 로컬에서 검사. 모델 호출 없음.
+    반환: {"ok": bool, "violations": [{"rule": ..., ...}], "stats": {...}}
+    """
+    sents = [x.strip() for x in _SENT_SPLIT_RE.split((text or "").strip()) if x.strip()]
+    lens = [_style_len(x) for x in sents]
+    analysis = _journey_digest(analysis)
+    frames = (analysis or {}).get("frames") or []
+    violations: list[dict] = []
+
+    if not sents:
+        return {"ok": False, "violations": [{"rule": "empty"}], "stats": {"sentences": 0}}
+
+    # 문장 수: 단일 3~4, 다중 5~7 (journey는 장면 수에 따라 늘어남, _sentence_range)
+    lo, hi = _sentence_range(analysis)
+    if not lo <= len(sents) <= hi:
+        violations.append({"rule": "sentence_count", "count": len(sents), "expected": [lo, hi]})
+
+    # 문장 첫머리 시간단어 금지
+    starts = [i for i, x in enumerate(sents) if _TIME_WORD_RE.match(x)]
+    if starts:
+        violations.append({"rule": "time_word_at_start", "sentences": starts})
+
+    # 모든 프레임의 time_hint가 불명이면 시간단어 자체 금지
+    if frames and all((f.get("time_hint") or "불명") == "불명" for f in frames):
+        used = sorted({m.group(0) for m in _TIME_WORD_RE.finditer(text)})
+        if used:
+            violations.append({"rule": "time_word_without_hint", "words": used})
+
+    # '~했다.' 3회 연속 금지
+    run = 0
+    for i, x in enumerate(sents):
+        run = run + 1 if x.rstrip(".!?… ").endswith("했다") else 0
+        if run >= 3:
+            violations.append({"rule": "haetda_x3", "sentences": [i - 2, i - 1, i]})
+            break
+
+    # 단문(6~12자) 2개 이상, 접속어 포함 25자 이상 복합문 2개 이상
+    short = [i for i, n in enumerate(lens) if 6 <= n <= 12]
+    compound = [i for i, (x, n) in enumerate(zip(sents, lens)) if n >= 25 and _CONNECTIVE_RE.search(x)]
+    if len(short) < 2:
+        violations.append({"rule": "short_sentences_min2", "found": len(short)})
+    if len(compound) < 2:
+        violations.append({"rule": "compound_sentences_min2", "found": len(compound)})
+
+    # 12자 이하 단문이 2회 연속이면 다음 문장은 25자 이상
+    for i in range(len(lens) - 2):
+        if lens[i] <= 12 and lens[i + 1] <= 12 and lens[i + 2] < 25:
+            violations.append({"rule": "short_run_not_followed_by_long", "sentences": [i, i + 1, i + 2]})
+            break
+
+    # 마침 문장 10~16자
+    if not 10 <= lens[-1] <= 16:
+        violations.append({"rule": "closing_sentence_length", "length": lens[-1]})
+
+    banned = sorted({m.group(0) for m in _STYLE_BANNED_RE.finditer(text)})
+    if banned:
+        violations.append({"rule": "banned_words", "words": banned})
+
+    return {
+        "ok": not violations,
+        "violations": violations,
+        "stats": {"sentences": len(sents), "lengths": lens, "short": len(short), "compound": len(compound)},
+    }
+
+class _RefineStats:
+    """보정 단계 결정 누계 (프로세스 단위). cv_debug에 스킵 비율로 노출."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counts = {"total": 0, "refined": 0, "skipped_short_draft": 0, "skipped_valid_draft": 0}
+
+    def record(self, outcome: str) -> dict:
+        with self._lock:
+            self._counts["total"] += 1
+            self._counts[outcome] = self._counts.get(outcome, 0) + 1
+        return self.stats()
+
+    def stats(self) -> dict:
+        with self._lock:
+            snap = dict(self._counts)
+        total = snap["total"] or 1
+        snap["skip_rate"] = round((snap["skipped_short_draft"] + snap["skipped_valid_draft"]) / total, 3)
+        snap["valid_skip_rate"] = round(snap["skipped_valid_draft"] / total, 3)
+        return snap
+
+refine_stats = _RefineStats()
+
+def _refine_samples() -> list:
+    st = refine_stats.stats()
+    return [("snaplog_refine_decisions_total", {"outcome": k}, st[k]) for k in ("refined", "skipped_short_draft", "skipped_valid_draft")] + [
+        ("snaplog_refine_skip_ratio", {}, st["skip_rate"])]
+
+metrics.describe("snaplog_refine_decisions_total", "counter", "Refine stage decisions by outcome")
+metrics.describe("snaplog_refine_skip_ratio", "gauge", "Share of drafts that skipped the refine call")
+metrics.collect(_refine_samples)
+
+# ---------------- 초안 선택 + 보정 결정 (라우트 공용) ----------------
+def _alt_decision(analysis: dict | None) -> tuple[bool, float]:
+    """ALT 교차검증 스킵 판단 (추가). (use_alt, food_score)"""
+    food_score = _food_likelihood_score(analysis)
+    use_alt = True
+    if ALT_SKIP_IF_LOW_FOOD and (food_score < ALT_LOW_FOOD_THRESH):
+        use_alt = False
+    return use_alt, food_score
+
+def _primary_only_debug(analysis: dict | None) -> dict:
+    return {"used": "primary_only", "reason": "low_food_likelihood", "food_score": _alt_decision(analysis)[1]}
+
+def _refine_decision(selected_draft: str, analysis: dict | None) -> tuple[str, dict | None]:
+    """보정 단계 조건부 스킵 (추가). (outcome, style 검사 결과)"""
+    style = check_diary_style(selected_draft, analysis) if selected_draft else None
+    if REFINE_SKIP_IF_SHORT and len((selected_draft or "").strip()) < REFINE_MIN_CHARS:
+        outcome = "skipped_short_draft"
+    elif REFINE_SKIP_IF_VALID and style and style["ok"]:
+        # 프롬프트의 기계적 규칙을 이미 모두 지킨 초안 → MODEL_TEXT 왕복 생략
+        outcome = "skipped_valid_draft"
+    else:
+        outcome = "refined"
+    return outcome, style
+
+def _record_refine(cv_debug, outcome: str, style: dict | None) -> None:
+    if isinstance(cv_debug, dict):
+        cv_debug["refine"] = outcome
+        cv_debug["refine_stats"] = refine_stats.record(outcome)
+        if style:
+            cv_debug["style_violations"] = style["violations"]
+
+# ---------------- 라우트 공용 (Flask/ASGI) ----------------
+_UNSAFE_BODY = "부적절한 내용이 감지되어 일기를 생성하지 않았습니다."
+_NO_INPUT = {"ok": False, "error": "no_input", "message": "사진을 넣거나 최소 단서를 제공하세요."}
+_ANALYSIS_NOT_FOUND = {"ok": False, "error": "analysis_not_found", "message": "분석 결과가 만료되었습니다. 사진을 다시 올려주세요."}
+
+def _unsafe_payload(used: str, moderation) -> dict:
+    return {"ok": True, "body": _UNSAFE_BODY, "category": "general_single", "used": used, "moderation": moderation}
+
+def _apply_target_date(analysis: dict | None, target_date: str) -> None:
+    if not target_date or analysis is None:
+        return
+    try:
+        analysis["date_sequence"] = _shift_date_sequence(analysis.get("date_sequence") or [], target_date)
+        analysis["date_anchor"] = {"mode": "user_target", "target_date": target_date}
+    except Exception as _e:
+        analysis["date_anchor_error"] = str(_e)
+
+def _wants_food_enrich(analysis: dict | None) -> bool:
+    return bool(analysis) and len(analysis.get("frames") or []) > 1 and is_food_dominant_multi(analysis)
+
+def _default_category(analysis: dict | None) -> str:
+    return "journey_multi" if (analysis and len(analysis.get("frames") or []) > 1) else "general_single"
+
+def _diary_payload(analysis: dict | None, final_text: str, category_hint: str, analysis_id: str | None, cv_debug,
+                   used: str = "vision-3stage", debug: dict | None = None, extra: dict | None = None) -> dict:
+    """초안/보정 결과 → 응답 본문. 본문이 비면 FALLBACKS 문장으로 대체한다."""
+    if final_text:
+        analysis = analysis or {}
+        return {
+            "ok": True,
+            "body": final_text,
+            "category": category_hint,
+            "used": used,
+            "analysis_id": analysis_id,
+            "observations": analysis.get("frames", []),
+            "ordering_debug": analysis.get("ordering_debug", []),
+            "date_sequence": analysis.get("date_sequence", []),
+            "food_fusion": analysis.get("food_fusion", {}),  # 추가 노출
+            **(debug or {}),
+            **(extra or {}),
+            "cv_debug": cv_debug,
+        }
+    return {
+        "ok": True,
+        "body": random.choice(FALLBACKS),
+        "category": category_hint,
+        "used": "fallback",
+        "analysis_id": analysis_id,
+        **(extra or {}),
+        "cv_debug": cv_debug,
+    }
+
+def _rate_limit_payload(e: RateLimitError) -> dict:
+    msg = getattr(e, "message", None) or str(e) or "rate_limit"
+    retry_ms = None
+    body = getattr(e, "body", {}) or {}
+    err = body.get("error") if isinstance(body, dict) else {}
+    if isinstance(err, dict):
+        retry_ms = err.get("retry_after")
+    if retry_ms is None:
+        match = re.search(r"try again in\s+(\d+)\s*ms", msg, re.I)
+        if match:
+            retry_ms = int(match.group(1))
+    return {"ok": False, "error": "rate_limit", "message": msg, "retry_after_ms": retry_ms}
+
+def _summary_lines(photos: list) -> list[str]:
+    """이미지가 없을 때 photosSummary(place/time/weather/desc)를 최소 단서 줄로."""
+    lines: list[str] = []
+    for p in photos:
+        base = " ".join([(p.get("place") or "").strip(), (p.get("time") or "").strip(), (p.get("weather") or "").strip(), (p.get("desc") or "").strip()]).strip()
+        base = clean_inline(base)
+        if base: lines.append(base)
+    return lines
+
+def _summary_payload(lines: list[str], text: str) -> dict:
+    return {"ok": True, "body": text, "category": decide_category_from_lines(lines), "used": "summary-lines", "observations": lines}
+
+# ---------------- 분석 재사용 (analysis_id) ----------------
+ANALYSIS_STORE_TTL_SECONDS = float(os.getenv("SNAPLOG_ANALYSIS_TTL", "3600"))
+ANALYSIS_STORE_MAX_ITEMS = int(os.getenv("SNAPLOG_ANALYSIS_MAX_ITEMS", "512"))
+
+class _AnalysisStore:
+    """
+    비전/모더레이션/음식 보강까지 끝난 분석 결과를 analysis_id로 잠시 보관.
+    재호출 시 업로드·EXIF·Vision·모더레이션을 건너뛰고 날짜 시프트/초안/보정만 다시 돈다.
+    이미지 원본(sorted_images)은 보관하지 않는다.
+    """
+
+    def __init__(self, ttl: float, max_items: int):
+        self.ttl = ttl
+        self.max_items = max(max_items, 1)
+        self._items: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = Lock()
+
+    def put(self, analysis: dict, category_hint: str, base_date_sequence: list[str]) -> str:
+        record = {k: v for k, v in analysis.items() if k not in ("sorted_images", "date_anchor", "date_anchor_error")}
+        record["date_sequence"] = list(base_date_sequence or [])
+        record = json.loads(json.dumps(record, default=str))
+        analysis_id = uuid.uuid4().hex
+        with self._lock:
+            self._items[analysis_id] = (time.monotonic(), {"analysis": record, "category": category_hint})
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return analysis_id
+
+    def get(self, analysis_id: str) -> dict | None:
+        with self._lock:
+            item = self._items.get(analysis_id)
+            if item is None:
+                return None
+            stored_at, value = item
+            if self.ttl > 0 and time.monotonic() - stored_at > self.ttl:
+                del self._items[analysis_id]
+                return None
+            self._items.move_to_end(analysis_id)
+        return json.loads(json.dumps(value))
+
+analysis_store = _AnalysisStore(ANALYSIS_STORE_TTL_SECONDS, ANALYSIS_STORE_MAX_ITEMS)
+
 # ---------------- HTML ----------------
 @app.get("/")
 def index():
@@ -1269,351 +3753,994 @@ def index():
         return f"Error: {html_path} 가 없습니다.", 404
     return send_file(html_path)
 
-# ---------------- API ----------------
-@app.post("/api/auto-diary")
-def api_auto_dairy():
-    try:
-        # 1) multipart/form-data
-        if len(request.files) > 0:
-            tone = request.form.get("tone") or "중립"
-            target_date = (request.form.get("targetDate") or "").strip()  # [추가]
-            photos = json.loads(request.form.get("photosSummary") or "[]")
-            files = request.files.getlist("images")
-
-            # Stage1 투입 이미지 수 컷 (추가)
-            files = files[:min(len(files), STAGE1_TOP_N, MAX_IMAGES)]
-
-            images = []
-            saved_files = []
-            debug_injected = []
-            debug_meta_head = []
-
-            print(f"\n{'='*60}")
-            print(f"[multipart 업로드] {len(files)}개 파일 수신")
-            print(f"{'='*60}")
-
-            for idx, f in enumerate(files[:MAX_IMAGES]):
-                raw = f.read()
-                orig_name = secure_filename(f.filename or f"upload_{uuid.uuid4().hex}")
-                _, ext = os.path.splitext(orig_name)
-                if not ext:
-                    mime = (f.mimetype or "").lower()
-                    ext = {
-                        "image/jpeg": ".jpg",
-                        "image/jpg": ".jpg",
-                        "image/png": ".png",
-                        "image/webp": ".webp",
-                        "image/heic": ".heic",
-                        "image/heif": ".heif",
-                    }.get(mime, ".bin")
-                save_name = datetime.now().strftime("%Y%m%d_%H%M%S_%f") + "_" + orig_name
-                save_path = os.path.join(UPLOAD_DIR, save_name)
-                with open(save_path, "wb") as out:
-                    out.write(raw)
-                saved_files.append(save_path)
-
-                exif_dt = _read_exif_datetime_from_bytes(raw)
-
-                ps_time = None
-                if idx < len(photos):
-                    ps = photos[idx] or {}
-                    cand_ps_keys = ["time","takenAt","timestamp","fileCreatedAt","createdAt","created_at","sentAt","sent_at","messageTime","message_time","kakaoTime","kakao_time"]
-                    ps_time_str = next((ps.get(k) for k in cand_ps_keys if ps.get(k)), None)
-                    if ps_time_str:
-                        ps_time = _parse_any_dt(ps_time_str)
-
-                final_dt = exif_dt or ps_time or _dt_from_filename(orig_name)
-                data_url = f"data:{f.mimetype or 'image/jpeg'};base64,{base64.b64encode(raw).decode('ascii')}"
-
-                img_dict = {"data": data_url, "filename": orig_name, "originalName": orig_name, "saved_path": save_path}
-                if final_dt:
-                    img_dict["takenAt"] = final_dt.isoformat(sep=" ")
-                    img_dict["timestamp"] = int(final_dt.timestamp() * 1000)
-                    img_dict["shotAt"] = img_dict["timestamp"]
-                    img_dict["order_ts"] = img_dict["timestamp"]
-                    debug_injected.append({"i": idx, "source": "exif|ps|name", "takenAt": img_dict["takenAt"]})
-                else:
-                    debug_injected.append({"i": idx, "source": "none", "takenAt": ""})
-                images.append(img_dict)
-
-            print(f"{'='*60}\n")
+# ---------------- JSON 업로드 입력 준비 ----------------
+def _prepare_json_images(data: dict) -> dict:
+    """
+    JSON 경로 입력 준비: Stage1 선택(또는 journey 장면 계획) → 이미지 핸들/촬영시각 주입 → detail 선택.
+    업로드 디코드와 이미지 처리만 하므로 ASGI 경로에서는 스레드로 보낸다.
+    """
+    journey = _is_journey(data.get("mode"), len(data.get("images") or []))
+    images_raw = (data.get("images") or [])[:JOURNEY_MAX_FILES if journey else UPLOAD_MAX_FILES]
+    photos = data.get("photosSummary") or []
+    images_meta = data.get("imagesMeta") or []
+    # Stage1 투입 이미지 선택: 근접 중복을 접고 남은 자리는 다음 사진으로 (추가)
+    stage1_debug = None
+    scenes = None
+    if images_raw:
+        def _src_str(img):
+            v = img if isinstance(img, str) else (img.get("data") or img.get("url") or "") if isinstance(img, dict) else ""
+            return v if isinstance(v, str) else ""
+        cand_rows = []
+        cand_gps = []
+        for i, img in enumerate(images_raw):
+            meta = images_meta[i] if i < len(images_meta) and isinstance(images_meta[i], dict) else {}
+            name = (img.get("filename") or img.get("name") or "") if isinstance(img, dict) else ""
+            v = _src_str(img)
+            head_meta = read_image_meta_from_data_url(v) if v else {}
+            cand_gps.append(head_meta.get("gps"))
+            cand_rows.append((head_meta.get("datetime"), photos[i] if i < len(photos) else None, name, meta.get("shotAt")))
+        cand_times = _candidate_times(cand_rows)
+        # 핸들은 여기서 한 번만 만들고, 디코드한 바이트는 detail 선택까지 고정해 두 번 디코드하지 않는다
+        cand_handles = [
+            ImageHandle.from_b64(v, filename=(img.get("filename") or img.get("name") or "") if isinstance(img, dict) else "")
+            if (v := _src_str(img)) else None
+            for img in images_raw
+        ]
+        sources = [(lambda h=h: h.pin_raw() if h is not None else b"") for h in cand_handles]
+        if journey:
+            kept, scenes, stage1_debug = _plan_journey(sources, cand_times, cand_gps)
+        else:
+            kept, stage1_debug = _select_stage1_frames(sources, min(STAGE1_TOP_N, MAX_IMAGES), cand_times)
+        for i in set(range(len(cand_handles))) - set(kept):
+            if cand_handles[i] is not None:
+                cand_handles[i].unpin_raw()
+        images_raw = [images_raw[i] for i in kept]
+        handles_by_pos = [cand_handles[i] for i in kept]
+        photos = [photos[i] if i < len(photos) else {} for i in kept] if photos else photos
+        images_meta = [images_meta[i] if i < len(images_meta) else {} for i in kept] if images_meta else images_meta
+
+    images: list[dict] = []
+    debug_injected = []
+    debug_meta_head = [{"i": i, "shotAt": (images_meta[i] or {}).get("shotAt")} for i in range(min(len(images_meta), len(images_raw)))]
+
+    print(f"\n{'='*60}")
+    print(f"[JSON 업로드] {len(images_raw)}개 이미지 수신")
+    print(f"{'='*60}")
+
+    for i, img in enumerate(images_raw):
+        item = {"data": img} if not isinstance(img, dict) else img.copy()
+        # base64 문자열은 디코드하지 않고 핸들로 감싼다 (EXIF는 필요할 때 헤더 구간만 디코드)
+        img_src = item.get("data") or item.get("url")
+        if isinstance(img_src, str) and img_src:
+            item["data"] = handles_by_pos[i]
+            item.pop("url", None)
+        if i < len(images_meta):
+            meta = images_meta[i] or {}
+            shot = meta.get("shotAt")
+            if shot is not None:
+                try:
+                    ts_ms = None; dt = None
+                    if isinstance(shot, (int, float)):
+                        shot_int = int(shot)
+                        ts_ms = shot_int if shot_int > 10_000_000_000 else shot_int * 1000
+                        dt = datetime.fromtimestamp(ts_ms / 1000.0)
+                    elif isinstance(shot, str):
+                        dt = _parse_any_dt(shot)
+                        if dt: ts_ms = int(dt.timestamp() * 1000)
+                    if dt and ts_ms is not None:
+                        item["takenAt"]  = dt.isoformat(sep=" ")
+                        item["timestamp"]= ts_ms
+                        item["shotAt"]   = ts_ms
+                        item["order_ts"] = ts_ms
+                        debug_injected.append({"i": i, "source": "shotAt", "takenAt": item["takenAt"]})
+                    else:
+                        debug_injected.append({"i": i, "source": "shotAt_parse_fail", "takenAt": ""})
+                except Exception as e:
+                    debug_injected.append({"i": i, "source": "shotAt_exception", "err": str(e)})
+            else:
+                debug_injected.append({"i": i, "source": "no_shotAt"})
+        else:
+            debug_injected.append({"i": i, "source": "no_meta"})
+        images.append(item)
+
+    print(f"{'='*60}\n")
+
+    # 이미지별 detail 선택 (헤더/축소 디코드만 사용)
+    handles = [it.get("data") for it in images if isinstance(it.get("data"), ImageHandle)]
+    detail_debug = None
+    if handles and len(handles) == len(images):
+        details, detail_debug = _choose_vision_details([(lambda h=h: h.pin_raw()) for h in handles], scenes)
+        for h, d in zip(handles, details):
+            h.detail = d
+    for h in handles:
+        h.unpin_raw()  # 이후 단계는 data_url(원본 b64)만 쓴다
+    return {
+        "journey": journey, "images": images, "photos": photos, "scenes": scenes,
+        "stage1_debug": stage1_debug, "detail_debug": detail_debug,
+        "debug_injected": debug_injected, "debug_meta_head": debug_meta_head,
+    }
 
-            analysis = analyze_images(images, photos_summary=photos)
+# ---------------- multipart 업로드 입력 준비 ----------------
+_UPLOAD_EXT_BY_MIME = {
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/heic": ".heic",
+    "image/heif": ".heif",
+}
+
+def _prepare_multipart_images(form, files: list) -> dict:
+    """
+    multipart 경로 입력 준비: Stage1 선택(또는 journey 장면 계획) → 원본 저장/촬영시각 주입 → detail 선택 → Vision용 축소.
+    _prepare_json_images와 같은 키에 saved_files를 더해 돌려준다. 업로드 스풀을 읽으므로 요청 스레드에서 부른다.
+    """
+    photos = json.loads(form.get("photosSummary") or "[]")
+    journey = _is_journey(form.get("mode"), len(files))
+
+    # Stage1 투입 이미지 선택: 근접 중복을 접고 남은 자리는 다음 사진으로 (추가)
+    files = files[:JOURNEY_MAX_FILES if journey else UPLOAD_MAX_FILES]
+    cand_times = _candidate_times([
+        (_spool_upload(f).meta().get("datetime"), photos[i] if i < len(photos) else None, f.filename or "")
+        for i, f in enumerate(files)
+    ])
+    scenes = None
+    if journey:
+        # 장면(시간/GPS) 단위로 묶고 장면마다 대표 사진만 Vision에 보낸다
+        kept, scenes, stage1_debug = _plan_journey(
+            [_spool_upload(f).fileobj for f in files], cand_times, [_spool_upload(f).meta().get("gps") for f in files])
+    else:
+        kept, stage1_debug = _select_stage1_frames([_spool_upload(f).fileobj for f in files], min(STAGE1_TOP_N, MAX_IMAGES), cand_times)
+    files = [files[i] for i in kept]
+    photos = [photos[i] if i < len(photos) else {} for i in kept] if photos else photos
+
+    images = []
+    saved_files = []
+    request_id = uuid.uuid4().hex
+    debug_injected = []
+
+    print(f"\n{'='*60}")
+    print(f"[multipart 업로드] {len(files)}개 파일 수신")
+    print(f"{'='*60}")
+
+    # 이미지별 detail 선택 (다운스케일 전에 결정해야 high 이미지가 축소되지 않음)
+    frame_cap = len(files) if journey else MAX_IMAGES
+    details, detail_debug = _choose_vision_details([_spool_upload(f).fileobj for f in files[:frame_cap]], scenes)
+    default_detail = "high" if len(files[:frame_cap]) == 1 else "low"
+
+    for idx, f in enumerate(files[:frame_cap]):
+        spool = _spool_upload(f)  # 이미 스트리밍 중에 해시/크기 검사 완료
+        orig_name = secure_filename(f.filename or f"upload_{uuid.uuid4().hex}")
+        _, ext = os.path.splitext(orig_name)
+        if not ext:
+            ext = _UPLOAD_EXT_BY_MIME.get((f.mimetype or "").lower(), ".bin")
+        save_path = upload_store.put(spool, ext, request_id, orig_name)  # 같은 사진은 한 번만 저장
+        saved_files.append(save_path)
+
+        img_meta = spool.meta()
+        exif_dt = img_meta.get("datetime")
+
+        ps_time = None
+        if idx < len(photos):
+            ps = photos[idx] or {}
+            cand_ps_keys = ["time","takenAt","timestamp","fileCreatedAt","createdAt","created_at","sentAt","sent_at","messageTime","message_time","kakaoTime","kakao_time"]
+            ps_time_str = next((ps.get(k) for k in cand_ps_keys if ps.get(k)), None)
+            if ps_time_str:
+                ps_time = _parse_any_dt(ps_time_str)
+
+        final_dt = exif_dt or ps_time or _dt_from_filename(orig_name)
+        vision_detail = details[idx] or default_detail
+        vision_bytes, vision_mime = _prepare_vision_image(spool.fileobj(), f.mimetype, vision_detail)
+        content_sha256 = spool.sha256
+        spool.close()  # 원본은 디스크에 저장됨 → 이후에는 Vision용 바이트만 유지
+        handle = ImageHandle(raw=vision_bytes, mime=vision_mime, filename=orig_name, saved_path=save_path, meta=img_meta, detail=details[idx])
+
+        img_dict = {"data": handle, "filename": orig_name, "originalName": orig_name, "saved_path": save_path, "sha256": content_sha256}
+        if img_meta.get("gps"):
+            img_dict["gps"] = list(img_meta["gps"])
+        if img_meta.get("orientation"):
+            img_dict["orientation"] = img_meta["orientation"]
+        if final_dt:
+            img_dict["takenAt"] = final_dt.isoformat(sep=" ")
+            img_dict["timestamp"] = int(final_dt.timestamp() * 1000)
+            img_dict["shotAt"] = img_dict["timestamp"]
+            img_dict["order_ts"] = img_dict["timestamp"]
+            debug_injected.append({"i": idx, "source": "exif|ps|name", "takenAt": img_dict["takenAt"]})
+        else:
+            debug_injected.append({"i": idx, "source": "none", "takenAt": ""})
+        images.append(img_dict)
+
+    print(f"{'='*60}\n")
+    return {
+        "journey": journey, "images": images, "photos": photos, "scenes": scenes,
+        "stage1_debug": stage1_debug, "detail_debug": detail_debug,
+        "debug_injected": debug_injected, "debug_meta_head": [], "saved_files": saved_files,
+    }
 
-            # [추가] Vision 단계 content_filter에 걸린 경우 바로 차단
-            if analysis and analysis.get("unsafe"):
-                return jsonify({
-                    "ok": True,
-                    "body": "부적절한 내용이 감지되어 일기를 생성하지 않았습니다.",
-                    "category": "general_single",
-                    "used": "unsafe_filtered_vision",
-                    "moderation": analysis,
-                })
+# ---------------- 파이프라인 단계 그래프 ----------------
+class _Stage:
+    """
+    파이프라인 한 단계. fn(ctx)는 선언한 outputs 키만 담은 dict(또는 None)를 돌려주고,
+    응답을 확정하는 단계는 {"response": (status, payload)}를 돌려준다(그 뒤 단계는 돌지 않음).
+    - inputs: 이 키를 내는 단계가 모두 끝나거나 건너뛰어져야 실행 (아무 단계도 내지 않는 키는 요청 입력)
+    - skip(ctx): 입력이 준비된 시점에 평가. 참이면 건너뛰고 출력을 내지 않는다
+    - concurrent: 워커에서 돌리고 바로 다음 단계로 넘어간다 (요청 컨텍스트/_emit을 쓰지 않는 단계만)
+    """
+    __slots__ = ("name", "fn", "inputs", "outputs", "skip", "concurrent")
 
-            if target_date:  # [추가]
-                try:
-                    analysis["date_sequence"] = _shift_date_sequence(analysis.get("date_sequence") or [], target_date)
-                    analysis["date_anchor"] = {"mode": "user_target", "target_date": target_date}
-                except Exception as _e:
-                    analysis["date_anchor_error"] = str(_e)
-
-            # [추가] 안전성 필터
-            is_safe, mod_debug = is_content_safe_for_diary(analysis)
-            if not is_safe:
-                return jsonify({
-                    "ok": True,
-                    "body": "부적절한 내용이 감지되어 일기를 생성하지 않았습니다.",
-                    "category": "general_single",
-                    "used": "unsafe_filtered",
-                    "moderation": mod_debug,
-                })
-
-            frames_len = len((analysis or {}).get("frames") or [])
-
-            if analysis and frames_len > 1 and is_food_dominant_multi(analysis):
-                try:
-                    analysis = enrich_food_structured_for_multi(analysis, images=images, photos_summary=photos)
-                    category_hint = "food_multi"
-                except Exception as _e:
-                    analysis["food_multi_enrich_error"] = str(_e)
-                    category_hint = "journey_multi"
-            else:
-                category_hint = "journey_multi" if (analysis and frames_len > 1) else "general_single"
+    def __init__(self, name: str, fn, inputs=(), outputs=(), skip=None, concurrent: bool = False):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.skip = skip
+        self.concurrent = concurrent
 
-            # --- ALT 교차검증 스킵 판단 (추가) ---
-            food_score = _food_likelihood_score(analysis)
-            use_alt = True
-            if ALT_SKIP_IF_LOW_FOOD and (food_score < ALT_LOW_FOOD_THRESH):
-                use_alt = False
+class _StageGraph:
+    """
+    선언된 단계들을 입력 의존성 순서로 실행한다.
+    - 준비된 단계가 여럿이면 선언 순서대로, concurrent 단계는 뒤 단계와 겹쳐 돈다
+    - 돌릴 단계가 없으면 진행 중인 concurrent 단계가 끝나기를 기다린다
+    - 실행마다 ctx["pipeline_trace"]에 단계별 상태(ran/skipped/error)와 시작/끝 시각(ms)을 남긴다
+    run은 동기(Flask) 구동, arun은 asyncio 구동. 선언/스킵 규칙은 같고 arun은 overrides로 단계 본체만 바꾼다.
+    """
 
-            if use_alt:
-                # 교차검증 단계
-                selected_draft, cv_debug = select_draft_via_cross_validation(analysis, tone, category_hint)
+    def __init__(self, stages: list[_Stage]):
+        self.stages = list(stages)
+        if len({st.name for st in self.stages}) != len(self.stages):
+            raise ValueError("duplicate stage name")
+        self.producers: dict[str, set[str]] = {}
+        for st in self.stages:
+            for key in st.outputs:
+                self.producers.setdefault(key, set()).add(st.name)
+        # 순환 의존 검사: 모든 단계가 언젠가 준비되는지 미리 돌려 본다
+        open_names = {st.name for st in self.stages}
+        while open_names:
+            ready = {st.name for st in self.stages if st.name in open_names and self._ready(st, open_names - {st.name})}
+            if not ready:
+                raise ValueError(f"stage dependency cycle: {sorted(open_names)}")
+            open_names -= ready
+
+    def _ready(self, st: _Stage, open_names: set[str]) -> bool:
+        return not any(self.producers.get(key, set()) & open_names for key in st.inputs)
+
+    def _next_ready(self, pending: list[_Stage], running: dict) -> _Stage | None:
+        open_names = {st.name for st in pending} | {st.name for st, _ in running.values()}
+        return next((st for st in pending if self._ready(st, open_names - {st.name})), None)
+
+    def _record(self, ctx: dict, st: _Stage, status: str, started: float, ended: float, t0: float) -> None:
+        entry = {"stage": st.name, "status": status,
+                 "start_ms": round((started - t0) * 1000, 1), "end_ms": round((ended - t0) * 1000, 1)}
+        if st.concurrent and status != "skipped":
+            entry["concurrent"] = True
+        ctx["pipeline_trace"].append(entry)
+        if status == "skipped":
+            metrics.inc("snaplog_stage_skipped_total", stage=st.name)
+        else:
+            metrics.observe("snaplog_stage_seconds", ended - started, stage=st.name, status=status)
+
+    def _merge(self, ctx: dict, st: _Stage, out: dict | None) -> None:
+        for key, value in (out or {}).items():
+            if key != "response" and key not in st.outputs:
+                raise ValueError(f"stage {st.name} returned undeclared output {key!r}")
+            ctx[key] = value
+
+    @staticmethod
+    def _timed(fn, ctx: dict):
+        out = fn(ctx)
+        return out, time.monotonic()
+
+    def run(self, ctx: dict) -> dict:
+        """동기 실행. concurrent 단계는 _io_pool로 보낸다. ctx를 채워 돌려준다(응답은 ctx["response"])."""
+        ctx.setdefault("pipeline_trace", [])
+        t0 = time.monotonic()
+        pending = list(self.stages)
+        running: dict = {}  # Future → (stage, started)
+        while "response" not in ctx and (pending or running):
+            st = self._next_ready(pending, running)
+            if st is None:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    rst, started = running.pop(fut)
+                    try:
+                        out, ended = fut.result()
+                    except BaseException:
+                        self._record(ctx, rst, "error", started, time.monotonic(), t0)
+                        raise
+                    self._merge(ctx, rst, out)
+                    self._record(ctx, rst, "ran", started, ended, t0)
+                continue
+            pending.remove(st)
+            started = time.monotonic()
+            if st.skip is not None and st.skip(ctx):
+                self._record(ctx, st, "skipped", started, started, t0)
+            elif st.concurrent:
+                running[_io_pool.submit(self._timed, st.fn, ctx)] = (st, started)
             else:
-                # ALT 스킵: 기본 모델 한 번만 호출
-                selected_draft = draft_diary(analysis, tone, category_hint, text_model=MODEL_TEXT)
-                cv_debug = {"used": "primary_only", "reason": "low_food_likelihood", "food_score": food_score}
-
-            # --- 보정 단계 조건부 스킵 (추가) ---
-            if REFINE_SKIP_IF_SHORT and len((selected_draft or "").strip()) < REFINE_MIN_CHARS:
-                final_text = selected_draft
-                if isinstance(cv_debug, dict):
-                    cv_debug["refine"] = "skipped_short_draft"
+                try:
+                    out = st.fn(ctx)
+                except BaseException:
+                    self._record(ctx, st, "error", started, time.monotonic(), t0)
+                    raise
+                self._merge(ctx, st, out)
+                self._record(ctx, st, "ran", started, time.monotonic(), t0)
+        return ctx
+
+    async def arun(self, ctx: dict, overrides: dict | None = None) -> dict:
+        """
+        asyncio 실행. overrides[name]이 있으면 그 코루틴 함수로 단계를 돌린다.
+        concurrent 단계는 Task로(동기 본체면 스레드로), 응답이 정해지거나 실패하면 남은 Task는 취소한다.
+        """
+        overrides = overrides or {}
+        ctx.setdefault("pipeline_trace", [])
+        t0 = time.monotonic()
+        pending = list(self.stages)
+        running: dict = {}  # Task → (stage, started)
+
+        async def _call(st: _Stage):
+            fn = overrides.get(st.name)
+            if fn is not None:
+                out = await fn(ctx)
+            elif st.concurrent:
+                out = await asyncio.to_thread(st.fn, ctx)
             else:
-                final_text = refine_diary(analysis, selected_draft, tone, category_hint)
-
-            if final_text:
-                return jsonify({
-                    "ok": True,
-                    "body": final_text,
-                    "category": category_hint,
-                    "used": "vision-3stage",
-                    "observations": (analysis or {}).get("frames", []),
-                    "ordering_debug": (analysis or {}).get("ordering_debug", []),
-                    "date_sequence": (analysis or {}).get("date_sequence", []),
-                    "food_fusion": (analysis or {}).get("food_fusion", {}),  # 추가 노출
-                    "saved_files": saved_files,
-                    "debug_injected": debug_injected,
-                    "debug_meta_head": debug_meta_head,
-                    "cv_debug": cv_debug
-                })
-            return jsonify({
-                "ok": True,
-                "body": random.choice(FALLBACKS),
-                "category": category_hint,
-                "used": "fallback",
-                "saved_files": saved_files,
-                "cv_debug": cv_debug
-            })
-
-        # 2) JSON 경로
-        data = request.get_json(silent=True) or {}
-        tone = data.get("tone") or "중립"
-        target_date = (data.get("targetDate") or "").strip()  # [추가]
-        images_raw = (data.get("images") or [])[:MAX_IMAGES]
-        # Stage1 투입 이미지 수 컷 (추가)
-        images_raw = images_raw[:min(len(images_raw), STAGE1_TOP_N, MAX_IMAGES)]
-        photos = data.get("photosSummary") or []
-        images_meta = data.get("imagesMeta") or []
-
-        images: list[dict] = []
-        debug_injected = []
-        debug_meta_head = [{"i": i, "shotAt": (images_meta[i] or {}).get("shotAt")} for i in range(min(len(images_meta), len(images_raw)))]
-
-        print(f"\n{'='*60}")
-        print(f"[JSON 업로드] {len(images_raw)}개 이미지 수신")
-        print(f"{'='*60}")
+                out = st.fn(ctx)
+            return out, time.monotonic()
 
-        for i, img in enumerate(images_raw):
-            item = {"data": img} if not isinstance(img, dict) else img.copy()
-            if i < len(images_meta):
-                meta = images_meta[i] or {}
-                shot = meta.get("shotAt")
-                if shot is not None:
-                    try:
-                        ts_ms = None; dt = None
-                        if isinstance(shot, (int, float)):
-                            shot_int = int(shot)
-                            ts_ms = shot_int if shot_int > 10_000_000_000 else shot_int * 1000
-                            dt = datetime.fromtimestamp(ts_ms / 1000.0)
-                        elif isinstance(shot, str):
-                            dt = _parse_any_dt(shot)
-                            if dt: ts_ms = int(dt.timestamp() * 1000)
-                        if dt and ts_ms is not None:
-                            item["takenAt"]  = dt.isoformat(sep=" ")
-                            item["timestamp"]= ts_ms
-                            item["shotAt"]   = ts_ms
-                            item["order_ts"] = ts_ms
-                            debug_injected.append({"i": i, "source": "shotAt", "takenAt": item["takenAt"]})
-                        else:
-                            debug_injected.append({"i": i, "source": "shotAt_parse_fail", "takenAt": ""})
-                    except Exception as e:
-                        debug_injected.append({"i": i, "source": "shotAt_exception", "err": str(e)})
+        try:
+            while "response" not in ctx and (pending or running):
+                st = self._next_ready(pending, running)
+                if st is None:
+                    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        rst, started = running.pop(task)
+                        try:
+                            out, ended = task.result()
+                        except BaseException:
+                            self._record(ctx, rst, "error", started, time.monotonic(), t0)
+                            raise
+                        self._merge(ctx, rst, out)
+                        self._record(ctx, rst, "ran", started, ended, t0)
+                    continue
+                pending.remove(st)
+                started = time.monotonic()
+                if st.skip is not None and st.skip(ctx):
+                    self._record(ctx, st, "skipped", started, started, t0)
+                elif st.concurrent:
+                    running[asyncio.ensure_future(_call(st))] = (st, started)
                 else:
-                    debug_injected.append({"i": i, "source": "no_shotAt"})
-            else:
-                debug_injected.append({"i": i, "source": "no_meta"})
-            images.append(item)
-
-        print(f"{'='*60}\n")
-
-        if images:
-            try:
-                analysis = analyze_images(images, photos_summary=photos)
-
-                # [추가] Vision 단계 content_filter에 걸린 경우 바로 차단
-                if analysis and analysis.get("unsafe"):
-                    return jsonify({
-                        "ok": True,
-                        "body": "부적절한 내용이 감지되어 일기를 생성하지 않았습니다.",
-                        "category": "general_single",
-                        "used": "unsafe_filtered_vision",
-                        "moderation": analysis,
-                    })
-
-                if target_date:  # [추가]
                     try:
-                        analysis["date_sequence"] = _shift_date_sequence(analysis.get("date_sequence") or [], target_date)
-                        analysis["date_anchor"] = {"mode": "user_target", "target_date": target_date}
-                    except Exception as _e:
-                        analysis["date_anchor_error"] = str(_e)
-
-                # [추가] 안전성 필터
-                is_safe, mod_debug = is_content_safe_for_diary(analysis)
-                if not is_safe:
-                    return jsonify({
-                        "ok": True,
-                        "body": "부적절한 내용이 감지되어 일기를 생성하지 않았습니다.",
-                        "category": "general_single",
-                        "used": "unsafe_filtered",
-                        "moderation": mod_debug,
-                    })
-
-                frames_len = len((analysis or {}).get("frames") or [])
-
-                if analysis and frames_len > 1 and is_food_dominant_multi(analysis):
-                    try:
-                        analysis = enrich_food_structured_for_multi(analysis, images=images, photos_summary=photos)
-                        category_hint = "food_multi"
-                    except Exception as _e:
-                        analysis["food_multi_enrich_error"] = str(_e)
-                        category_hint = "journey_multi"
-                else:
-                    category_hint = "journey_multi" if (analysis and frames_len > 1) else "general_single"
+                        out, ended = await _call(st)
+                    except BaseException:
+                        self._record(ctx, st, "error", started, time.monotonic(), t0)
+                        raise
+                    self._merge(ctx, st, out)
+                    self._record(ctx, st, "ran", started, ended, t0)
+        finally:
+            for task in running:
+                task.cancel()
+        return ctx
+
+def _trace_end_ms(ctx: dict, *names: str) -> float:
+    return max((e["end_ms"] for e in ctx.get("pipeline_trace") or [] if e["stage"] in names and e["status"] == "ran"), default=0.0)
+
+# ---------------- /api/auto-diary 단계 ----------------
+SPECULATIVE_MODERATION = int(os.getenv("SNAPLOG_SPECULATIVE_MODERATION", "1"))  # 모더레이션을 초안 생성과 동시에
+
+_INGEST_OUTPUTS = ("journey", "images", "photos", "scenes", "stage1_debug", "detail_debug", "debug_injected", "debug_meta_head")
+_DRAFT_OUTPUTS = ("selected_draft", "cv_debug", "draft_error")
+
+def _json_pipeline_ctx(data: dict) -> dict:
+    """JSON 본문 → 파이프라인 요청 입력 (Flask/ASGI 공용)."""
+    return {
+        "source": "json",
+        "tone": data.get("tone") or "중립",
+        "target_date": (data.get("targetDate") or "").strip(),  # [추가]
+        "reuse_id": (data.get("analysisId") or data.get("analysis_id") or "").strip(),
+        "data": data,
+    }
 
-                # --- ALT 교차검증 스킵 판단 (추가) ---
-                food_score = _food_likelihood_score(analysis)
-                use_alt = True
-                if ALT_SKIP_IF_LOW_FOOD and (food_score < ALT_LOW_FOOD_THRESH):
-                    use_alt = False
+def _multipart_pipeline_ctx(form, files: list) -> dict:
+    return {
+        "source": "multipart",
+        "tone": form.get("tone") or "중립",
+        "target_date": (form.get("targetDate") or "").strip(),  # [추가]
+        "reuse_id": "",
+        "form": form,
+        "files": files,
+    }
 
-                if use_alt:
-                    # 교차검증 단계
-                    selected_draft, cv_debug = select_draft_via_cross_validation(analysis, tone, category_hint)
-                else:
-                    # ALT 스킵: 기본 모델 한 번만 호출
-                    selected_draft = draft_diary(analysis, tone, category_hint, text_model=MODEL_TEXT)
-                    cv_debug = {"used": "primary_only", "reason": "low_food_likelihood", "food_score": food_score}
-
-                # --- 보정 단계 조건부 스킵 (추가) ---
-                if REFINE_SKIP_IF_SHORT and len((selected_draft or "").strip()) < REFINE_MIN_CHARS:
-                    final_text = selected_draft
-                    if isinstance(cv_debug, dict):
-                        cv_debug["refine"] = "skipped_short_draft"
-                else:
-                    final_text = refine_diary(analysis, selected_draft, tone, category_hint)
-
-                if final_text:
-                    return jsonify({
-                        "ok": True,
-                        "body": final_text,
-                        "category": category_hint,
-                        "used": "vision-3stage",
-                        "observations": (analysis or {}).get("frames", []),
-                        "ordering_debug": (analysis or {}).get("ordering_debug", []),
-                        "date_sequence": (analysis or {}).get("date_sequence", []),
-                        "food_fusion": (analysis or {}).get("food_fusion", {}),  # 추가 노출
-                        "debug_injected": debug_injected,
-                        "debug_meta_head": debug_meta_head,
-                        "cv_debug": cv_debug
-                    })
-                return jsonify({
-                    "ok": True,
-                    "body": random.choice(FALLBACKS),
-                    "category": category_hint,
-                    "used": "fallback",
-                    "cv_debug": cv_debug
-                })
-            except RateLimitError as e:
-                msg = getattr(e, "message", None) or str(e) or "rate_limit"
-                retry_ms = None
-                body = getattr(e, "body", {}) or {}
-                err = body.get("error") if isinstance(body, dict) else {}
-                if isinstance(err, dict):
-                    retry_ms = err.get("retry_after")
-                if retry_ms is None:
-                    match = re.search(r"try again in\s+(\d+)\s*ms", msg, re.I)
-                    if match:
-                        retry_ms = int(match.group(1))
-                return jsonify({"ok": False, "error": "rate_limit", "message": msg, "retry_after_ms": retry_ms}), 429
-            except Exception as e:
-                traceback.print_exc()
-                category_hint = "journey_multi" if len(images) > 1 else "general_single"
-                return jsonify({"ok": True, "body": random.choice(FALLBACKS), "category": category_hint, "used": "fallback", "error": str(e)})
+def _no_images(ctx: dict) -> bool:
+    return not ctx.get("images")
+
+def _no_diary(ctx: dict) -> bool:
+    return "category_hint" not in ctx
+
+def _stage_reuse(ctx: dict) -> dict:
+    """analysis_id 재사용: 업로드/Vision/모더레이션 없이 저장된 분석으로 날짜 시프트 → 초안 → 보정만."""
+    stored = analysis_store.get(ctx["reuse_id"])
+    if not stored:
+        return {"response": (404, _ANALYSIS_NOT_FOUND)}
+    analysis = stored["analysis"]
+    _apply_target_date(analysis, ctx["target_date"])
+    return {"diary_analysis": analysis, "category_hint": stored.get("category") or "general_single",
+            "analysis_id": ctx["reuse_id"], "used": "vision-3stage-reuse"}
+
+def _stage_ingest_multipart(ctx: dict) -> dict:
+    return _prepare_multipart_images(ctx["form"], ctx["files"])
+
+def _stage_ingest_json(ctx: dict) -> dict:
+    return _prepare_json_images(ctx["data"])
+
+def _stage_summary(ctx: dict) -> dict:
+    """이미지 없으면 photosSummary로 최소 단서 생성."""
+    lines = _summary_lines(ctx.get("photos") or [])
+    if lines:
+        text = generate_from_lines(lines, ctx["tone"])
+        if text:
+            return {"response": (200, _summary_payload(lines, text))}
+    return {"response": (400, _NO_INPUT)}
+
+def _stage_vision(ctx: dict) -> dict:
+    images, photos = ctx["images"], ctx["photos"]
+    _emit("received", {"images": len(images), "journey": ctx["journey"]})
+    analysis = analyze_journey(images, photos, ctx["scenes"]) if ctx["journey"] else analyze_images(images, photos_summary=photos)
+    return _vision_outputs(ctx, analysis)
+
+def _vision_outputs(ctx: dict, analysis: dict | None) -> dict:
+    _attach_stage1_debug(analysis, ctx["stage1_debug"])
+    _attach_stage1_debug(analysis, ctx["detail_debug"])
+    # [추가] Vision 단계 content_filter에 걸린 경우 바로 차단
+    if analysis and analysis.get("unsafe"):
+        return {"response": (200, _unsafe_payload("unsafe_filtered_vision", analysis))}
+    _emit_analysis_events(analysis)
+    return {"analysis": analysis}
+
+def _stage_date_shift(ctx: dict) -> dict:
+    """targetDate 시프트 (analysis 제자리 수정). 재호출용으로 시프트 전 날짜열을 내보낸다."""
+    analysis = ctx["analysis"]
+    base_date_sequence = list((analysis or {}).get("date_sequence") or [])
+    _apply_target_date(analysis, ctx["target_date"])
+    return {"base_date_sequence": base_date_sequence}
+
+def _stage_moderation(ctx: dict) -> dict:
+    return {"moderation_verdict": is_content_safe_for_diary(ctx["analysis"])}
+
+def _enrich_copy(analysis: dict) -> dict:
+    # 보강은 frames(food_structured/visible_text)를 채우므로 사본에서 (모더레이션은 보강 전 frames로 판정)
+    return {**analysis, "frames": [dict(f) for f in analysis.get("frames") or []]}
+
+def _stage_enrich(ctx: dict) -> dict:
+    analysis = ctx["analysis"]
+    if not _wants_food_enrich(analysis):
+        return {"diary_analysis": analysis, "category_hint": _default_category(analysis)}
+    analysis = _enrich_copy(analysis)
+    try:
+        analysis = enrich_food_structured_for_multi(analysis, images=ctx["images"], photos_summary=ctx["photos"])
+        return {"diary_analysis": analysis, "category_hint": "food_multi"}
+    except Exception as _e:
+        analysis["food_multi_enrich_error"] = str(_e)
+        return {"diary_analysis": analysis, "category_hint": "journey_multi"}
 
-        # 3) 이미지 없으면 photosSummary로 최소 단서 생성
-        lines: list[str] = []
-        for p in photos:
-            base = " ".join([(p.get("place") or "").strip(), (p.get("time") or "").strip(), (p.get("weather") or "").strip(), (p.get("desc") or "").strip()]).strip()
-            base = clean_inline(base)
-            if base: lines.append(base)
+def _skip_cv(ctx: dict) -> bool:
+    return _no_diary(ctx) or not _alt_decision(ctx["diary_analysis"])[0]
 
-        if lines:
-            text = generate_from_lines(lines, tone)
-            if text:
-                return jsonify({"ok": True, "body": text, "category": decide_category_from_lines(lines), "used": "summary-lines", "observations": lines})
+def _skip_primary_only(ctx: dict) -> bool:
+    return _no_diary(ctx) or _alt_decision(ctx["diary_analysis"])[0]
 
-        return jsonify({"ok": False, "error": "no_input", "message": "사진을 넣거나 최소 단서를 제공하세요."}), 400
+def _stage_draft_cv(ctx: dict) -> dict:
+    # 실패는 바로 던지지 않고 넘긴다: 진행 중인 모더레이션 차단 판정이 우선 (refine_plan에서 다시 던짐)
+    try:
+        selected_draft, cv_debug = select_draft_via_cross_validation(ctx["diary_analysis"], ctx["tone"], ctx["category_hint"])
+    except Exception as e:
+        return {"draft_error": e}
+    return {"selected_draft": selected_draft, "cv_debug": cv_debug}
 
+def _stage_draft_primary(ctx: dict) -> dict:
+    # ALT 스킵: 기본 모델 한 번만 호출
+    try:
+        selected_draft = draft_diary(ctx["diary_analysis"], ctx["tone"], ctx["category_hint"], text_model=MODEL_TEXT)
+    except Exception as e:
+        return {"draft_error": e}
+    return {"selected_draft": selected_draft, "cv_debug": _primary_only_debug(ctx["diary_analysis"])}
+
+def _stage_moderation_gate(ctx: dict) -> dict:
+    """모더레이션 판정 확인. 투기 모드면 초안 선택 뒤, 무엇이든 내보내기 전에 확인하고 차단이면 초안을 버린다."""
+    is_safe, mod_debug = ctx["moderation_verdict"]
+    if not is_safe:
+        return {"response": (200, _unsafe_payload("unsafe_filtered", mod_debug))}
+    _emit("moderation", {"safe": True})
+    cv_debug = ctx.get("cv_debug")
+    if SPECULATIVE_MODERATION and isinstance(cv_debug, dict):
+        # 초안이 끝난 뒤에도 모더레이션을 기다린 시간 (0에 가까우면 왕복 하나가 통째로 가려진 것)
+        wait_ms = _trace_end_ms(ctx, "moderation") - _trace_end_ms(ctx, "draft_cv", "draft_primary")
+        cv_debug["moderation"] = {"mode": "speculative", "wait_ms": int(max(wait_ms, 0))}
+    return {"moderation_ok": True}
+
+def _stage_refine_plan(ctx: dict) -> dict:
+    """보정 스킵 판단. 보정하지 않으면 초안이 그대로 최종본."""
+    if ctx.get("draft_error") is not None:
+        raise ctx["draft_error"]
+    selected_draft, cv_debug = ctx["selected_draft"], ctx["cv_debug"]
+    outcome, style = _refine_decision(selected_draft, ctx["diary_analysis"])
+    _emit("draft", {"used": cv_debug.get("used") if isinstance(cv_debug, dict) else None, "refine": outcome})
+    if outcome != "refined" and selected_draft:
+        _emit("token", {"text": selected_draft})
+    _record_refine(cv_debug, outcome, style)
+    return {"refine_outcome": outcome, "final_text": selected_draft}
+
+def _stage_refine(ctx: dict) -> dict:
+    on_delta = (lambda t: _emit("token", {"text": t})) if _streaming() else None
+    return {"final_text": refine_diary(ctx["diary_analysis"], ctx["selected_draft"], ctx["tone"], ctx["category_hint"], on_delta=on_delta)}
+
+def _stage_store(ctx: dict) -> dict:
+    # 재호출(톤/날짜 변경)용으로 분석 보관 (모더레이션 통과 후에만)
+    analysis = ctx["diary_analysis"]
+    return {"analysis_id": analysis_store.put(analysis, ctx["category_hint"], ctx["base_date_sequence"]) if analysis else None}
+
+def _stage_respond(ctx: dict) -> dict:
+    debug = {"debug_injected": ctx["debug_injected"], "debug_meta_head": ctx["debug_meta_head"]} if "debug_injected" in ctx else None
+    extra = {"saved_files": ctx["saved_files"]} if "saved_files" in ctx else None
+    return {"response": (200, _diary_payload(ctx["diary_analysis"], ctx["final_text"], ctx["category_hint"], ctx.get("analysis_id"),
+                                             ctx.get("cv_debug"), used=ctx.get("used") or "vision-3stage", debug=debug, extra=extra))}
+
+# 투기 모드: 모더레이션이 보강/초안과 겹쳐 돌고 게이트가 초안 뒤에서 확인.
+# 순차 모드: 게이트 통과(moderation_ok)가 보강의 입력이라 판정 전에는 보강/초안이 시작되지 않는다.
+_DRAFT_INPUTS = ("diary_analysis", "category_hint", "tone") + (() if SPECULATIVE_MODERATION else ("moderation_ok",))
+
+auto_diary_graph = _StageGraph([
+    _Stage("reuse", _stage_reuse, inputs=("reuse_id", "target_date"),
+           outputs=("diary_analysis", "category_hint", "analysis_id", "used"), skip=lambda ctx: not ctx["reuse_id"]),
+    _Stage("ingest_multipart", _stage_ingest_multipart, inputs=("form", "files"), outputs=_INGEST_OUTPUTS + ("saved_files",),
+           skip=lambda ctx: ctx["source"] != "multipart"),
+    _Stage("ingest_json", _stage_ingest_json, inputs=("data",), outputs=_INGEST_OUTPUTS,
+           skip=lambda ctx: ctx["source"] != "json" or bool(ctx["reuse_id"])),
+    _Stage("summary", _stage_summary, inputs=("images", "photos", "tone"), skip=lambda ctx: bool(ctx.get("images") or ctx["reuse_id"])),
+    _Stage("vision", _stage_vision, inputs=("images", "photos", "scenes", "journey", "stage1_debug", "detail_debug"),
+           outputs=("analysis",), skip=_no_images),
+    _Stage("date_shift", _stage_date_shift, inputs=("analysis", "target_date"), outputs=("base_date_sequence",), skip=_no_images),
+    _Stage("moderation", _stage_moderation, inputs=("analysis",), outputs=("moderation_verdict",), skip=_no_images, concurrent=True),
+    _Stage("moderation_gate", _stage_moderation_gate,
+           inputs=("moderation_verdict",) + (_DRAFT_OUTPUTS if SPECULATIVE_MODERATION else ()),
+           outputs=("moderation_ok",), skip=lambda ctx: "moderation_verdict" not in ctx),
+    _Stage("enrich", _stage_enrich, inputs=("analysis", "images", "photos", "base_date_sequence")
+           + (() if SPECULATIVE_MODERATION else ("moderation_ok",)),
+           outputs=("diary_analysis", "category_hint"), skip=_no_images),
+    _Stage("draft_cv", _stage_draft_cv, inputs=_DRAFT_INPUTS, outputs=_DRAFT_OUTPUTS, skip=_skip_cv),
+    _Stage("draft_primary", _stage_draft_primary, inputs=_DRAFT_INPUTS, outputs=_DRAFT_OUTPUTS, skip=_skip_primary_only),
+    _Stage("refine_plan", _stage_refine_plan, inputs=_DRAFT_OUTPUTS + ("diary_analysis", "moderation_ok"),
+           outputs=("refine_outcome", "final_text"), skip=_no_diary),
+    _Stage("refine", _stage_refine, inputs=("refine_outcome", "selected_draft", "diary_analysis", "category_hint", "tone"),
+           outputs=("final_text",), skip=lambda ctx: ctx.get("refine_outcome") != "refined"),
+    _Stage("store", _stage_store, inputs=("diary_analysis", "category_hint", "base_date_sequence", "moderation_ok"),
+           outputs=("analysis_id",), skip=lambda ctx: _no_images(ctx) or _no_diary(ctx)),
+    _Stage("respond", _stage_respond,
+           inputs=("diary_analysis", "final_text", "category_hint", "analysis_id", "cv_debug", "used",
+                   "debug_injected", "debug_meta_head", "saved_files"),
+           skip=_no_diary),
+])
+
+def _pipeline_response(ctx: dict) -> tuple[int, dict]:
+    status, payload = ctx["response"]
+    return status, {**payload, "pipeline_trace": ctx["pipeline_trace"]}
+
+def _pipeline_error(ctx: dict, e: Exception) -> tuple[int, dict] | None:
+    """
+    JSON 이미지 경로에서 실패하면 레이트 리밋은 429, 나머지는 FALLBACKS 문장으로 응답 (기존 계약).
+    그 밖(multipart/재사용/입력 준비 단계)은 None → 라우트가 500으로 처리.
+    """
+    if ctx["source"] != "json" or not ctx.get("images"):
+        return None
+    if isinstance(e, RateLimitError):
+        return 429, _rate_limit_payload(e)
+    traceback.print_exc()
+    category_hint = "journey_multi" if len(ctx["images"]) > 1 else "general_single"
+    return 200, {"ok": True, "body": random.choice(FALLBACKS), "category": category_hint, "used": "fallback", "error": str(e)}
+
+# ---------------- API ----------------
+@app.post("/api/auto-diary")
+def api_auto_dairy():
+    try:
+        # multipart/form-data와 JSON(analysisId 재사용 포함) 모두 같은 단계 그래프로
+        if len(request.files) > 0:
+            ctx = _multipart_pipeline_ctx(request.form, request.files.getlist("images"))
+        else:
+            ctx = _json_pipeline_ctx(request.get_json(silent=True) or {})
+        request.environ["snaplog.pipeline_trace"] = ctx.setdefault("pipeline_trace", [])  # Server-Timing용
+        try:
+            auto_diary_graph.run(ctx)
+        except Exception as e:
+            handled = _pipeline_error(ctx, e)
+            if handled is None:
+                raise
+            status, payload = handled
+            return jsonify(payload), status
+        status, payload = _pipeline_response(ctx)
+        return jsonify(payload), status
+
+    except RequestEntityTooLarge as e:
+        return _payload_too_large(e)
     except Exception as e:
         traceback.print_exc()
         return jsonify({"ok": False, "error": str(e)}), 500
 
+STREAM_KEEPALIVE_SECONDS = float(os.getenv("SNAPLOG_STREAM_KEEPALIVE", "15"))
+
+def _detach_request_body() -> list:
+    """
+    본문 파싱(크기 제한 포함)을 요청 스레드에서 끝내고 업로드 스풀을 붙잡아 둔다.
+    뷰가 반환되면 요청 컨텍스트가 업로드 파일을 닫으므로, 작업 스레드가 끝나면 release()해야 한다.
+    """
+    spools = [_spool_upload(f) for _, f in request.files.items(multi=True)]
+    request.get_json(silent=True)
+    for sp in spools:
+        sp.hold()
+    return spools
+
+def _call_auto_diary() -> tuple[int, dict]:
+    """복사된 요청 컨텍스트 안에서 /api/auto-diary 본체를 돌려 (status, payload)로 돌려준다."""
+    resp = api_auto_dairy()
+    resp, status = resp if isinstance(resp, tuple) else (resp, getattr(resp, "status_code", 200))
+    return status, resp.get_json(silent=True) or {}
+
+@app.route("/api/auto-diary/stream", methods=["POST"])
+def api_auto_diary_stream():
+    """
+    /api/auto-diary와 같은 입력을 받아 단계 이벤트를 흘려보낸다.
+    - 이벤트: received → ordering → observations → moderation → draft → token(여러 번) → result
+    - token은 보정 모델의 원문 조각(보정 생략 시 초안 전체 1회), result.body가 정리된 최종본
+    - 기본 SSE(text/event-stream). ?format=ndjson 또는 Accept: application/x-ndjson이면 줄 단위 JSON
+    - /jobs와 같은 작업 풀에서 돈다: 대기열이 차면 503, 연결이 끊기면 작업 취소
+    """
+    ndjson = request.args.get("format") == "ndjson" or "application/x-ndjson" in (request.headers.get("Accept") or "")
+    try:
+        spools = _detach_request_body()
+    except RequestEntityTooLarge as e:
+        return _payload_too_large(e)
+
+    events: queue.Queue = queue.Queue()
+    # 작업 풀(job_manager)에서 돌린다: 동시 실행 수/대기열 상한과 제한 시간을 /jobs와 공유
+    job = job_manager.submit(copy_current_request_context(lambda job: _call_auto_diary()),
+                             on_event=lambda ev, data: events.put((ev, data)))
+    if job is None:
+        for sp in spools:
+            sp.release()
+        return _queue_full_response()
+
+    def _done(_future):
+        for sp in spools:
+            sp.release()
+        payload = job.result if job.result is not None else {"ok": False, "error": job.error}
+        events.put(("result", {"status": job.status_code or 499, **payload}))
+        events.put(None)
+
+    job.future.add_done_callback(_done)
+
+    def _format(ev: str, data: dict) -> str:
+        if ndjson:
+            return json.dumps({"event": ev, "data": data}, ensure_ascii=False) + "\n"
+        return f"event: {ev}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def _gen():
+        try:
+            while True:
+                try:
+                    item = events.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield "\n" if ndjson else ": keepalive\n\n"
+                    continue
+                if item is None:
+                    return
+                yield _format(*item)
+        except GeneratorExit:
+            # 클라이언트가 끊으면 작업도 다음 단계 경계(_emit)에서 멈춘다 (_JobAborted)
+            job_manager.cancel(job.id)
+            raise
+
+    return Response(
+        stream_with_context(_gen()),
+        mimetype="application/x-ndjson" if ndjson else "text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ---------------- 비동기 작업 (POST → job id → 폴링/롱폴링) ----------------
+JOB_WORKERS = int(os.getenv("SNAPLOG_JOB_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.getenv("SNAPLOG_JOB_QUEUE_MAX", "32"))          # 대기+실행 중 작업 상한 (넘으면 503)
+JOB_TIMEOUT_SECONDS = float(os.getenv("SNAPLOG_JOB_TIMEOUT", "180"))   # 작업별 제한 시간 (0 = 무제한)
+JOB_TTL_SECONDS = float(os.getenv("SNAPLOG_JOB_TTL", "600"))           # 끝난 작업 결과 보관 시간
+JOB_MAX_WAIT_SECONDS = float(os.getenv("SNAPLOG_JOB_MAX_WAIT", "30"))  # 롱폴링 ?wait= 상한
+
+class _JobAborted(BaseException):
+    """
+    취소/시간 초과 시 작업 스레드의 다음 단계 경계(_emit)에서 던진다.
+    라우트 곳곳의 except Exception 폴백에 잡히지 않도록 BaseException을 상속한다.
+    """
+
+class _Job:
+    __slots__ = ("id", "status", "stage", "created", "started", "finished", "deadline",
+                 "status_code", "result", "error", "partial", "cancel", "done", "future", "on_event")
+
+    def __init__(self, job_id: str, timeout: float):
+        self.id = job_id
+        self.status = "queued"  # queued → running → done | error | cancelled | timeout
+        self.stage = None
+        self.created = time.monotonic()
+        self.started = self.finished = None
+        self.deadline = self.created + timeout if timeout > 0 else None
+        self.status_code = None
+        self.result = None
+        self.error = None
+        self.partial: list[str] = []  # 보정 스트림 조각 (진행 상황 표시용)
+        self.cancel = False
+        self.done = Event()
+        self.future = None
+        self.on_event = None  # 단계 이벤트 전달 (스트리밍 라우트)
+
+class _JobManager:
+    """
+    /api/auto-diary 파이프라인을 전용 스레드 풀에서 돌린다.
+    - _io_pool과 분리: 작업 안에서 _io_pool로 다시 fan-out해도 서로 막히지 않는다
+    - 취소/시간 초과는 협조적: 스트리밍 이벤트 싱크를 작업 스레드에 걸어 단계 경계·보정 토큰마다 확인
+    - 끝난 작업은 TTL이 지나면 접근 시점에 정리
+    """
+
+    def __init__(self, workers: int, queue_max: int, timeout: float, ttl: float):
+        self.queue_max = max(queue_max, 1)
+        self.timeout = timeout
+        self.ttl = ttl
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="snaplog-job")
+        self._jobs: dict[str, _Job] = {}
+        self._lock = Lock()
+        self._counts = {"submitted": 0, "rejected": 0, "done": 0, "error": 0, "cancelled": 0, "timeout": 0}
+
+    def _sweep(self, now: float) -> None:
+        if self.ttl <= 0:
+            return
+        for jid in [j.id for j in self._jobs.values() if j.finished is not None and now - j.finished > self.ttl and not self._occupies(j)]:
+            del self._jobs[jid]
+
+    @staticmethod
+    def _occupies(job: _Job) -> bool:
+        # 시간 초과로 응답은 닫혔어도 스레드가 다음 단계 경계까지 돌고 있으면 자리를 차지한 것으로 센다
+        return job.future is None or not job.future.done()
+
+    def _active(self) -> int:
+        return sum(1 for j in self._jobs.values() if self._occupies(j))
+
+    def submit(self, fn, on_event=None) -> _Job | None:
+        """fn(job)을 예약한다. on_event(event, data)는 작업 스레드의 단계 이벤트를 받는다. 대기열이 가득 차면 None."""
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            if self._active() >= self.queue_max:
+                self._counts["rejected"] += 1
+                return None
+            job = _Job(uuid.uuid4().hex, self.timeout)
+            job.on_event = on_event
+            self._jobs[job.id] = job
+            self._counts["submitted"] += 1
+        job.future = self._pool.submit(self._run, job, fn)
+        return job
+
+    def _finish(self, job: _Job, status: str, status_code: int | None = None, result: dict | None = None, error: str | None = None) -> None:
+        with self._lock:
+            if job.finished is not None:  # 이미 취소/시간 초과로 닫힌 작업의 늦은 결과는 버린다
+                return
+            job.status, job.status_code, job.result, job.error = status, status_code, result, error
+            job.finished = time.monotonic()
+            self._counts[status] += 1
+        job.done.set()
+
+    def _checkpoint(self, job: _Job) -> None:
+        if job.cancel:
+            raise _JobAborted("cancelled")
+        if job.deadline is not None and time.monotonic() > job.deadline:
+            raise _JobAborted("timeout")
+
+    def _run(self, job: _Job, fn) -> None:
+        with self._lock:
+            if job.finished is not None:
+                return
+            job.status, job.started = "running", time.monotonic()
+
+        def _sink(event: str, data: dict) -> None:
+            if event == "token":
+                job.partial.append(data.get("text") or "")
+            else:
+                job.stage = event
+            if job.on_event is not None:
+                job.on_event(event, data)
+            self._checkpoint(job)
+
+        _stream_local.emit = _sink
+        try:
+            self._checkpoint(job)
+            status_code, payload = fn(job)
+            self._finish(job, "done" if status_code < 400 else "error", status_code, payload)
+        except _JobAborted as e:
+            reason = str(e)
+            self._finish(job, reason, 499 if reason == "cancelled" else 504, error=reason)
+        except Exception as e:
+            traceback.print_exc()
+            self._finish(job, "error", 500, error=str(e))
+        finally:
+            _stream_local.emit = None
+
+    def get(self, job_id: str) -> _Job | None:
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            job = self._jobs.get(job_id)
+        if job is not None and job.finished is None and job.deadline is not None and now > job.deadline:
+            # 단계 사이에 오래 머무는 작업도 응답은 제때 닫는다 (스레드는 다음 경계에서 멈춘다)
+            job.cancel = True
+            self._finish(job, "timeout", 504, error="timeout")
+        return job
+
+    def cancel(self, job_id: str) -> _Job | None:
+        job = self.get(job_id)
+        if job is None or job.finished is not None:
+            return job
+        job.cancel = True
+        if job.future is not None and job.future.cancel():
+            self._finish(job, "cancelled", 499, error="cancelled")  # 아직 시작 전이면 바로 닫힌다
+        return job
+
+    def wait(self, job: _Job, seconds: float) -> None:
+        if job.finished is None and seconds > 0:
+            if job.deadline is not None:
+                seconds = min(seconds, max(job.deadline - time.monotonic(), 0) + 0.05)
+            job.done.wait(seconds)
+            self.get(job.id)  # 대기 중 지난 제한 시간 반영
+
+    def snapshot(self, job: _Job) -> dict:
+        now = time.monotonic()
+        out = {
+            "ok": job.status in ("queued", "running", "done"),
+            "job_id": job.id,
+            "status": job.status,
+            "stage": job.stage,
+            "elapsed_ms": int(((job.finished or now) - job.created) * 1000),
+        }
+        if job.status == "queued":
+            with self._lock:
+                out["queue_position"] = sum(1 for j in self._jobs.values() if j.status == "queued" and j.created < job.created)
+        elif job.status == "running":
+            if job.cancel:
+                out["cancel_requested"] = True  # 다음 단계 경계에서 멈춘다
+            if job.partial:
+                out["partial"] = "".join(job.partial)
+        if job.finished is not None:
+            out["status_code"] = job.status_code
+            if job.result is not None:
+                out["result"] = job.result
+            if job.error:
+                out["error"] = job.error
+            if self.ttl > 0:
+                out["expires_in_ms"] = int(max(self.ttl - (now - job.finished), 0) * 1000)
+        return out
+
+    def stats(self) -> dict:
+        with self._lock:
+            by_status: dict[str, int] = {}
+            for j in self._jobs.values():
+                by_status[j.status] = by_status.get(j.status, 0) + 1
+            return {**self._counts, "active": self._active(), "queue_max": self.queue_max, "by_status": by_status}
+
+job_manager = _JobManager(JOB_WORKERS, JOB_QUEUE_MAX, JOB_TIMEOUT_SECONDS, JOB_TTL_SECONDS)
+
+def _queue_full_response():
+    resp = jsonify({"ok": False, "error": "queue_full", "message": "요청이 많아 잠시 후 다시 시도해주세요.", "queue_max": job_manager.queue_max})
+    resp.headers["Retry-After"] = "5"
+    return resp, 503
+
+def _job_location(job_id: str) -> str:
+    return f"/api/auto-diary/jobs/{job_id}"
+
+@app.route("/api/auto-diary/jobs", methods=["POST"])
+def api_auto_diary_jobs():
+    """
+    /api/auto-diary와 같은 입력을 받아 작업으로 예약하고 곧바로 202 + job_id를 돌려준다.
+    결과는 GET /api/auto-diary/jobs/<id>(?wait=초 롱폴링), 취소는 DELETE.
+    """
+    try:
+        spools = _detach_request_body()
+    except RequestEntityTooLarge as e:
+        return _payload_too_large(e)
+
+    def _release(_future=None):
+        for sp in spools:
+            sp.release()
+
+    job = job_manager.submit(copy_current_request_context(lambda job: _call_auto_diary()))
+    if job is None:
+        _release()
+        return _queue_full_response()
+    job.future.add_done_callback(_release)  # 실행이 끝났거나 시작 전에 취소된 경우 모두
+    resp = jsonify(job_manager.snapshot(job))
+    resp.headers["Location"] = _job_location(job.id)
+    return resp, 202
+
+@app.route("/api/auto-diary/jobs/<job_id>", methods=["GET"])
+def api_auto_diary_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "job_not_found", "message": "작업이 없거나 만료되었습니다."}), 404
+    try:
+        wait = min(max(float(request.args.get("wait") or 0), 0), JOB_MAX_WAIT_SECONDS)
+    except ValueError:
+        wait = 0
+    job_manager.wait(job, wait)
+    return jsonify(job_manager.snapshot(job))
+
+@app.route("/api/auto-diary/jobs/<job_id>", methods=["DELETE"])
+def api_auto_diary_job_cancel(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "job_not_found", "message": "작업이 없거나 만료되었습니다."}), 404
+    return jsonify(job_manager.snapshot(job))
+
+@app.errorhandler(RequestEntityTooLarge)
+def _payload_too_large(e):
+    return jsonify(_too_large_payload()), 413
+
+def _too_large_payload() -> dict:
+    return {
+        "ok": False,
+        "error": "payload_too_large",
+        "message": "업로드 용량이 너무 큽니다.",
+        "max_file_bytes": UPLOAD_MAX_FILE_BYTES,
+        "max_request_bytes": UPLOAD_MAX_REQUEST_BYTES,
+        "max_journey_request_bytes": _max_request_bytes("journey"),
+    }
+
 @app.get("/health")
 def health():
-    return {"ok": True}
+    return {"ok": True, "jobs": job_manager.stats()}
+
+# ---------------- 지표 노출 (/metrics, Server-Timing) ----------------
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+def _server_timing(trace: list | None, total_ms: float) -> str:
+    """파이프라인 트레이스 → Server-Timing 값 (실행된 단계별 dur + total)."""
+    parts = [f"{e['stage']};dur={e['end_ms'] - e['start_ms']:.1f}" for e in trace or [] if e["status"] != "skipped"]
+    parts.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(parts)
+
+@app.before_request
+def _start_request_timer():
+    request.environ["snaplog.started"] = time.monotonic()
+
+@app.after_request
+def _record_request_metrics(resp):
+    started = request.environ.get("snaplog.started")
+    if started is None:
+        return resp
+    elapsed = time.monotonic() - started
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("snaplog_http_request_seconds", elapsed, endpoint=endpoint, method=request.method, status=str(resp.status_code))
+    resp.headers["Server-Timing"] = _server_timing(request.environ.get("snaplog.pipeline_trace"), elapsed * 1000)
+    resp.headers["Timing-Allow-Origin"] = "*"
+    return resp
 
 # ---------------- CORS ----------------
 @app.after_request
 def add_cors_headers(resp):
     resp.headers["Access-Control-Allow-Origin"] = "*"
     resp.headers["Access-Control-Allow-Headers"] = "Content-Type"
-    resp.headers["Access-Control-Allow-Methods"] = "GET,POST,OPTIONS"
+    resp.headers["Access-Control-Allow-Methods"] = "GET,POST,DELETE,OPTIONS"
     resp.headers["Access-Control-Allow-Private-Network"] = "true"
     return resp
 
 @app.route("/api/auto-diary", methods=["OPTIONS"])
-def _auto_diary_preflight():
+@app.route("/api/auto-diary/stream", methods=["OPTIONS"])
+@app.route("/api/auto-diary/jobs", methods=["OPTIONS"])
+@app.route("/api/auto-diary/jobs/<job_id>", methods=["OPTIONS"])
+def _auto_diary_preflight(job_id: str | None = None):
     return ("", 200)
 
 # ---------------- 실행 ----------------
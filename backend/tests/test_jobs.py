@@ -0,0 +1,69 @@
+"""비동기 작업 관리자(_JobManager) 취소(499)/시간 초과(504)/대기열 한도 테스트 (OpenAI 호출 없음)
+
+실행 (backend/ 에서):
+    python -m pytest -q tests
+"""
+
+import os, sys, time
+from threading import Event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test-not-used")
+
+import server  # noqa: E402
+
+
+def _manager(workers=1, queue_max=4, timeout=0.0):
+    return server._JobManager(workers, queue_max, timeout, ttl=60)
+
+
+def _stepping(started: Event, steps: int = 200):
+    """단계 경계(_emit)를 짧게 반복하는 작업. 끝까지 돌면 200."""
+    def fn(job):
+        started.set()
+        for i in range(steps):
+            server._emit("stage", {"i": i})
+            time.sleep(0.01)
+        return 200, {"ok": True}
+    return fn
+
+
+def test_cancel_running_job_returns_499_at_next_stage():
+    jm = _manager()
+    started = Event()
+    job = jm.submit(_stepping(started))
+    assert started.wait(2)
+    jm.cancel(job.id)
+    assert job.done.wait(2)
+    assert (job.status, job.status_code) == ("cancelled", 499)
+    assert jm.snapshot(job)["status_code"] == 499
+
+
+def test_cancel_queued_job_returns_499_immediately():
+    jm = _manager(workers=1)
+    release = Event()
+    blocker = jm.submit(lambda job: (release.wait(5), (200, {}))[1])
+    queued = jm.submit(_stepping(Event()))
+    assert queued.status == "queued"
+    jm.cancel(queued.id)
+    assert (queued.status, queued.status_code) == ("cancelled", 499)
+    release.set()
+    assert blocker.done.wait(2) and blocker.status_code == 200
+
+
+def test_timeout_returns_504():
+    jm = _manager(timeout=0.1)
+    job = jm.submit(_stepping(Event()))
+    assert job.done.wait(2)
+    assert (job.status, job.status_code) == ("timeout", 504)
+
+
+def test_queue_full_rejects_until_capacity_frees():
+    jm = _manager(workers=1, queue_max=1)
+    release = Event()
+    first = jm.submit(lambda job: (release.wait(5), (200, {}))[1])
+    assert jm.submit(lambda job: (200, {})) is None
+    release.set()
+    assert first.done.wait(2)
+    first.future.result(timeout=2)
+    assert jm.submit(lambda job: (200, {})) is not None
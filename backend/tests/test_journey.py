@@ -0,0 +1,101 @@
+"""journey 모드 장면 병합 테스트 (OpenAI 호출 없음)
+
+실행 (backend/ 에서):
+    python -m pytest -q tests
+"""
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test-not-used")
+
+import server  # noqa: E402
+
+
+def _part(n_frames: int, dates: list[str], tag: str) -> dict:
+    return {
+        "frames": [{"index": i + 1, "summary": f"{tag}{i + 1}"} for i in range(n_frames)],
+        "date_sequence": list(dates),
+        "ordering_debug": [],
+        "sorted_images": [f"{tag}-img{i + 1}" for i in range(len(dates))],
+        "global": {"dominant_time": "오후"},
+    }
+
+
+def test_merge_aligns_dates_when_scene_returns_fewer_frames():
+    # 장면 1은 이미지 3장에 frames 2개만 돌아온 경우
+    short = _part(2, ["2025-05-01", "2025-05-01", "2025-05-01"], "a")
+    full = _part(2, ["2025-05-02", "2025-05-02"], "b")
+    merged = server._merge_journey_parts([short, full])
+
+    assert len(merged["date_sequence"]) == len(merged["frames"]) == len(merged["sorted_images"]) == 4
+    assert merged["date_sequence"] == ["2025-05-01", "2025-05-01", "2025-05-02", "2025-05-02"]
+    assert merged["sorted_images"] == ["a-img1", "a-img2", "b-img1", "b-img2"]
+    # 날짜 전환은 장면 2의 첫 프레임(3번)에서
+    assert server._day_break_positions(merged["date_sequence"]) == [(3, 1)]
+
+
+def test_merge_pads_dates_when_scene_returns_more_frames():
+    extra = _part(3, ["2025-05-01"], "a")
+    nxt = _part(1, ["2025-05-02"], "b")
+    merged = server._merge_journey_parts([extra, nxt])
+
+    assert merged["date_sequence"] == ["2025-05-01", "2025-05-01", "2025-05-01", "2025-05-02"]
+    assert merged["sorted_images"] == ["a-img1", None, None, "b-img1"]
+    assert server._food_enrich_targets({**merged, "frames": [dict(f, has_food=True) for f in merged["frames"]]}) == [0, 3]
+
+
+def test_merge_skips_failed_scene():
+    merged = server._merge_journey_parts([None, _part(1, ["2025-05-02"], "b")])
+    assert [f["scene"] for f in merged["frames"]] == [2]
+    assert merged["global"]["scenes"][0] == {"scene": 1, "frames": 0, "error": "analysis_failed"}
+
+
+def test_scene_failure_only_drops_that_scene():
+    err = TimeoutError("scene timeout")
+    parts = server._journey_scene_results([_part(1, ["2025-05-01"], "a"), err])
+    assert parts[1] is None
+    merged = server._merge_journey_parts(parts)
+    assert len(merged["frames"]) == 1
+    assert merged["global"]["scenes"][1]["error"] == "analysis_failed"
+
+
+def test_all_scenes_failing_raises_first_error():
+    first, second = TimeoutError("a"), TimeoutError("b")
+    try:
+        server._journey_scene_results([first, second])
+    except TimeoutError as e:
+        assert e is first
+    else:
+        raise AssertionError("expected the first scene error")
+
+
+def test_digest_folds_frames_per_scene():
+    frames = [
+        {"index": 1, "scene": 1, "summary": "역 도착", "time_hint": "불명", "flow": "도착"},
+        {"index": 2, "scene": 1, "summary": "역 앞 광장", "time_hint": "오전", "has_food": False},
+        {"index": 3, "scene": 2, "summary": "국수", "has_food": True, "food_structured": {"dish": "국수"}},
+    ]
+    analysis = {"frames": frames, "date_sequence": ["2025-05-01", "2025-05-01", "2025-05-02"], "sorted_images": ["x", "y", "z"]}
+    digest = server._journey_digest(analysis)
+
+    assert [f["scene"] for f in digest["frames"]] == [1, 2]
+    assert digest["frames"][0]["summary"] == "역 도착 / 역 앞 광장"
+    assert digest["frames"][0]["time_hint"] == "오전"
+    assert digest["frames"][1]["food_structured"] == {"dish": "국수"}
+    assert digest["date_sequence"] == ["2025-05-01", "2025-05-02"]
+    # 장면당 한 프레임이면 그대로
+    assert server._journey_digest(digest) is digest
+
+
+def test_sentence_range_scales_with_scenes():
+    def _a(n):
+        return {"frames": [{"index": i + 1} for i in range(n)]}
+    assert server._sentence_range(_a(1)) == (3, 4)
+    assert server._sentence_range(_a(4)) == (5, 7)
+    assert server._sentence_range(_a(12)) == (12, 15)
+
+
+def test_journey_request_cap():
+    assert server._max_request_bytes(None) == server.UPLOAD_MAX_REQUEST_BYTES
+    assert server._max_request_bytes("journey") >= server.JOURNEY_MAX_FILES * 1024 * 1024
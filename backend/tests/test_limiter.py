@@ -0,0 +1,77 @@
+"""모델별 레이트 리미터(_ModelRateLimiter) 간격/버킷/동시 실행 한도 테스트 (OpenAI 호출 없음)
+
+실행 (backend/ 에서):
+    python -m pytest -q tests
+"""
+
+import os, sys, time
+from threading import Event, Timer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test-not-used")
+
+import server  # noqa: E402
+
+
+def _limiter(rpm=6000, tpm=1_000_000, max_in_flight=8, min_interval=0.0):
+    return server._ModelRateLimiter("test-model", rpm, tpm, max_in_flight, min_interval)
+
+
+def test_min_interval_spaces_request_starts():
+    lim = _limiter(min_interval=0.05)
+    starts = []
+    for _ in range(4):
+        lim.acquire(10, max_wait=5)
+        starts.append(time.monotonic())
+        lim.release(10, 10)
+    gaps = [b - a for a, b in zip(starts, starts[1:])]
+    assert all(g >= 0.045 for g in gaps), gaps
+
+
+def test_rpm_bucket_blocks_after_burst():
+    lim = _limiter(rpm=2)  # 버킷 2개, 다음 요청은 30초 뒤
+    for _ in range(2):
+        assert lim.acquire(10, max_wait=1) < 0.05
+        lim.release(10, 10)
+    with pytest.raises(TimeoutError):
+        lim.acquire(10, max_wait=0.1)
+
+
+def test_tpm_bucket_waits_for_refill():
+    lim = _limiter(tpm=60_000)  # 초당 1000 토큰 충전
+    lim.acquire(59_900, max_wait=1)
+    lim.release(59_900, 59_900)
+    waited = lim.acquire(200, max_wait=2)  # 부족분 100토큰 → 약 0.1초
+    assert 0.05 <= waited < 1.0, waited
+
+
+def test_in_flight_slot_released_wakes_waiter():
+    lim = _limiter(max_in_flight=1)
+    lim.acquire(10, max_wait=1)
+    with pytest.raises(TimeoutError):
+        lim.acquire(10, max_wait=0.05)
+    Timer(0.1, lim.release, args=(10, 10)).start()
+    waited = lim.acquire(10, max_wait=2)
+    assert 0.05 <= waited < 1.0, waited
+
+
+def test_penalize_pushes_next_start_and_paces_after_429():
+    lim = _limiter()
+    lim.penalize(0.1, rate_limited=True)
+    assert lim._pace >= server.PACE_STEP_SECONDS
+    waited = lim.acquire(10, max_wait=2)
+    assert waited >= 0.08, waited
+
+
+def test_cancel_stops_waiting_for_a_slot():
+    lim = _limiter(max_in_flight=1)
+    lim.acquire(10, max_wait=1)
+    cancel = Event()
+    Timer(0.05, cancel.set).start()
+    started = time.monotonic()
+    with pytest.raises(server._StepsCancelled):
+        lim.acquire(10, max_wait=5, cancel=cancel)
+    assert time.monotonic() - started < 1.0
+    assert lim._in_flight == 1
@@ -0,0 +1,45 @@
+"""초안 후처리 규칙표 엔진(_text_engine/_postprocess_draft)이 기존 다중 패스(bench/legacy.py)와 같은지 검사
+
+실행 (backend/ 에서):
+    python -m pytest -q tests
+"""
+
+import os, sys
+
+_BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _BACKEND)
+sys.path.insert(0, os.path.join(_BACKEND, "bench"))
+os.environ.setdefault("OPENAI_API_KEY", "test-not-used")
+
+import server  # noqa: E402
+import legacy  # noqa: E402
+from bench_textproc import _corpus, _pipeline_legacy, _pipeline_new  # noqa: E402
+
+
+def test_pipeline_matches_legacy_on_corpus():
+    corpus = _corpus(400, 5, seed=3)
+    mismatches = [row[0] for row in corpus if _pipeline_new(*row) != _pipeline_legacy(*row)]
+    assert mismatches == []
+
+
+def test_clean_inline_matches_legacy_per_sentence():
+    sentences = [s for text, _, _ in _corpus(200, 5, seed=5) for s in server._TAG_RE.sub(" ", text).split(".")]
+    sentences += ["  앞뒤\t공백\n\n줄바꿈  ", "탭\t하나", "IMG_20240501_1203.jpg 에서", "2024-05-01 점심", ""]
+    assert [server.clean_inline(s) for s in sentences] == [legacy.clean_inline(s) for s in sentences]
+
+
+def test_proper_nouns_follow_visible_text():
+    draft = "스타벅스에서 라떼를 마시고 맥도날드 앞을 지났다."
+    blind = {"frames": [{"visible_text": ""}]}
+    seen = {"frames": [{"visible_text": "STARBUCKS"}]}
+    for analysis in (blind, seen):
+        assert server.replace_proper_nouns_if_no_visible_text(analysis, draft) == legacy.replace_proper_nouns(analysis, draft)
+    assert "카페" in server.replace_proper_nouns_if_no_visible_text(blind, draft)
+    assert server.replace_proper_nouns_if_no_visible_text(seen, draft) == draft
+
+
+def test_soften_report_tone_matches_legacy():
+    texts = ["창밖 풍경이 눈에 들어왔다. 조용히 앉아 있었다.   있었다.",
+             "향이 진하게 올라와 식욕을 자극했다. 한 입 먹고 나니 금세 배가 불렀다.",
+             "일상적인 분위기로 가득 차 있었다.", "그냥 걸었다."]
+    assert [server.soften_report_tone(t) for t in texts] == [legacy.soften_report_tone(t) for t in texts]
@@ -0,0 +1,62 @@
+"""시각 해석(_parse_any_dt/_dt_from_filename)이 기존 strptime 경로(bench/legacy.py)와 같은지 검사
+
+실행 (backend/ 에서):
+    python -m pytest -q tests
+"""
+
+import itertools, os, random, sys
+
+_BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _BACKEND)
+sys.path.insert(0, os.path.join(_BACKEND, "bench"))
+os.environ.setdefault("OPENAI_API_KEY", "test-not-used")
+
+import server  # noqa: E402
+import legacy  # noqa: E402
+
+
+def _value_shapes():
+    dates = ["2024{s}01{s}02", "2024{s}1{s}2", "2024{s}13{s}02", "2024{s}02{s}30"]
+    times = ["", "{t}10:20", "{t}10:20:30", "{t}9:05:07", "{t}10:20:30.123", "{t}10:20:30.123456",
+             "{t}10-20-30", "{t}10-20", "{t}25:00:00"]
+    tzs = ["", "Z", "+09:00", "+0900", "-05:30"]
+    for d, s in itertools.product(dates, "-./:"):
+        for dot in ("", "."):
+            for tm, t in itertools.product(times, (" ", "  ", "T", "t", "-", "")):
+                for tz in tzs:
+                    if not tm and tz:
+                        continue
+                    yield d.format(s=s) + dot + tm.format(t=t) + tz
+    yield from ["20240102_102030", "20240102102030", "1714521600", "1714521600123", "2024-01-02T10",
+                "20240102", "2024-W01-2", "", "어제 오후", "2024-01-02T10:20:30.1234567"]
+
+
+def test_resolver_matches_legacy_on_all_shapes():
+    diffs = [(v, server._parse_any_dt(v), legacy.parse_any_dt(v)) for v in _value_shapes()
+             if server._parse_any_dt(v) != legacy.parse_any_dt(v)]
+    assert diffs == []
+
+
+def test_resolver_does_not_widen_accepted_formats():
+    # 기존 경로가 거부하던 모양은 그대로 None
+    for v in ("2024/01/02", "2024.01.02", "2024-01-02 10-20-30", "2024.01.02 10:20:30.123"):
+        assert legacy.parse_any_dt(v) is None
+        assert server._parse_any_dt(v) is None
+
+
+def test_resolver_matches_legacy_on_epoch_numbers():
+    for v in (1714521600, 1714521600123, 1714521600.5):
+        assert server._parse_any_dt(v) == legacy.parse_any_dt(v)
+
+
+def test_filename_matches_legacy():
+    rnd = random.Random(3)
+    names = ["KakaoTalk_20240102_102030123.jpg", "IMG_20240102_102030.jpg", "Screenshot_2024-01-02-10-20-30.png",
+             "2024.01.02 10.20.30.jpg", "2024-01-02 10:20.jpg", "PXL_20241302_102030.jpg", "a.jpg", "",
+             "2023-01-01 10.20 IMG_20240102_101010.jpg", "20241301 101010_20240102_101010.jpg"]
+    for _ in range(500):
+        sep = lambda: rnd.choice("-_.: ")  # noqa: E731
+        names.append("x{}{:02d}{}{:02d}{}{:02d}{}{:02d}{}{:02d}.jpg".format(
+            rnd.choice(["2024", "2024" + sep()]), rnd.randint(0, 13), sep() if rnd.random() < 0.5 else "",
+            rnd.randint(0, 32), sep(), rnd.randint(0, 25), sep(), rnd.randint(0, 61), sep(), rnd.randint(0, 61)))
+    assert [n for n in names if server._dt_from_filename(n) != legacy.dt_from_filename(n)] == []